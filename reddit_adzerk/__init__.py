@@ -20,6 +20,7 @@ class Adzerk(Plugin):
     config = {
         ConfigValue.str: [
             'adzerk_engine_domain',
+            'adzerk_report_archive_dir',
         ],
 
         ConfigValue.int: [
@@ -57,6 +58,13 @@ class Adzerk(Plugin):
             'adzerk_reporting_link_group_size',
             'adzerk_reporting_campaign_group_size',
             'adzerk_reporting_timeout',
+            'adzerk_reporting_dedup_window',
+            'adzerk_api_shared_get_seconds',
+            'adzerk_retry_max_attempts',
+        ],
+
+        ConfigValue.dict(ConfigValue.str, ConfigValue.int): [
+            'adzerk_api_rate_limits',
         ],
 
     }
@@ -91,6 +99,9 @@ class Adzerk(Plugin):
         from r2.config.queues import MessageQueue
         queues.declare({
             "adzerk_q": MessageQueue(bind_to_self=True),
+            "adzerk_urgent_q": MessageQueue(bind_to_self=True),
+            "adzerk_retry_q": MessageQueue(bind_to_self=True),
+            "adzerk_dead_letter_q": MessageQueue(bind_to_self=True),
             "adzerk_reporting_q": MessageQueue(bind_to_self=True),
         })
 
@@ -1,9 +1,15 @@
+import copy
+import hashlib
 import json
 import requests
 import sys
+import threading
+import time
 
 from pylons import app_globals as g
 
+from reddit_adzerk.lib import ratelimit
+
 
 class AdzerkError(Exception):
     def __init__(self, status_code, response_body):
@@ -31,6 +37,135 @@ def handle_response(response):
         raise AdzerkError(response.status_code, response.text)
 
 
+def _request(method, url, **kwargs):
+    ratelimit.acquire("management")
+    return getattr(requests, method)(url, **kwargs)
+
+
+class SingleFlight(object):
+    """Collapses concurrent identical calls within a process into one."""
+
+    class Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+            self.waiters = 0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        """Return (`fn()`, whether the result came from another caller)."""
+        with self.lock:
+            call = self.calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self.calls[key] = self.Call()
+            else:
+                call.waiters += 1
+
+        if not is_leader:
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+        return call.result, False
+
+
+_single_flight = SingleFlight()
+
+# how often to check whether another process has fetched a shared GET
+SHARED_GET_POLL_SECONDS = 0.05
+# `Campaign.get` urls, which should be invalidated with the campaign
+GET_URL_SUFFIXES = ('', '?excludeFlights=true', '?excludeFlights=false')
+# things per page when listing page by page
+LIST_PAGE_SIZE = 500
+
+
+def _shared_get_key(url):
+    return 'azget:%s' % hashlib.md5(url).hexdigest()
+
+
+def _shared_get_lock_key(url):
+    return _shared_get_key(url) + ':lock'
+
+
+def _fetch_item(url, headers):
+    """GET an object, sharing it between processes if enabled.
+
+    With `adzerk_api_shared_get_seconds` set the response is kept in
+    gencache for that long, and while one process fetches it the others
+    wait for its response rather than making the same request.
+
+    """
+
+    ttl = g.live_config.get('adzerk_api_shared_get_seconds') or 0
+    if ttl <= 0:
+        return handle_response(_request("get", url, headers=headers))
+
+    key = _shared_get_key(url)
+    lock_key = _shared_get_lock_key(url)
+    item = g.gencache.get(key)
+    has_lock = False
+
+    if item is None:
+        has_lock = g.gencache.add(lock_key, True, time=ttl)
+
+    if item is None and not has_lock:
+        deadline = time.time() + ttl
+        while item is None and time.time() < deadline:
+            time.sleep(SHARED_GET_POLL_SECONDS)
+            item = g.gencache.get(key)
+
+    if item is not None:
+        g.stats.simple_event('adzerk.api.get.shared')
+        return item
+
+    try:
+        item = handle_response(_request("get", url, headers=headers))
+        g.gencache.set(key, item, time=ttl)
+    finally:
+        # waiters stop polling as soon as the item is set, but after a
+        # failure the next caller should fetch rather than wait out the lock
+        if has_lock:
+            g.gencache.delete(lock_key)
+    return item
+
+
+def _get_item(url, headers):
+    """GET an object, collapsing concurrent identical GETs into one."""
+    item, coalesced = _single_flight.do(url, lambda: _fetch_item(url, headers))
+    g.stats.simple_event('adzerk.api.get.%s' %
+                         ('coalesced' if coalesced else 'requested'))
+
+    # `_from_item` modifies the item, and other callers may share it
+    return copy.deepcopy(item)
+
+
+def _invalidate_shared_gets(url):
+    if not g.live_config.get('adzerk_api_shared_get_seconds'):
+        return
+
+    keys = []
+    for suffix in GET_URL_SUFFIXES:
+        keys.append(_shared_get_key(url + suffix))
+        keys.append(_shared_get_lock_key(url + suffix))
+    g.gencache.delete_multi(keys)
+
+
 class Stub(object):
     def __init__(self, Id):
         self.Id = Id
@@ -38,6 +173,9 @@ class Stub(object):
     def _to_item(self):
         return {'Id': self.Id}
 
+    def __repr__(self):
+        return '<Stub %s>' % self.Id
+
 
 class Field(object):
     def __init__(self, name, optional=False):
@@ -115,34 +253,60 @@ class Base(object):
     @classmethod
     def list(cls, params=None):
         url = '/'.join([cls._base_url, cls._name])
-        response = requests.get(url, headers=cls._headers(), params=params)
+        response = _request("get", url, headers=cls._headers(), params=params)
         content = handle_response(response)
         items = content.get('items')
         if items:
             return [cls._from_item(item) for item in items]
 
+    @classmethod
+    def iter_list(cls, params=None, page_size=LIST_PAGE_SIZE):
+        """Yield pages of things, fetching each page as it's needed."""
+        url = '/'.join([cls._base_url, cls._name])
+        page = 1
+        while True:
+            page_params = dict(params or {}, page=page, pageSize=page_size)
+            response = _request("get", url, headers=cls._headers(),
+                                params=page_params)
+            content = handle_response(response)
+            items = content.get('items')
+            if items:
+                yield [cls._from_item(item) for item in items]
+
+            if not items or page >= content.get('totalPages', page):
+                return
+            page += 1
+
+    def _parent_urls(self):
+        """Return the urls of objects whose GETs include this one."""
+        return []
+
     @classmethod
     def create(cls, **attr):
         url = '/'.join([cls._base_url, cls._name])
         thing = cls(None, **attr)
         data = thing._to_data()
-        response = requests.post(url, headers=cls._headers(), data=data)
+        response = _request("post", url, headers=cls._headers(), data=data)
         item = handle_response(response)
         if isinstance(item.get('Id'), int) and item.get('Id') < 5000:
             g.log.info('item with weird Id: %s' % response.text)
+        for parent_url in thing._parent_urls():
+            _invalidate_shared_gets(parent_url)
         return cls._from_item(item)
 
     def _send(self):
         url = '/'.join([self._base_url, self._name, str(self.Id)])
         data = self._to_data()
-        response = requests.put(url, headers=self._headers(), data=data)
+        response = _request("put", url, headers=self._headers(), data=data)
         item = handle_response(response)
+        _invalidate_shared_gets(url)
+        for parent_url in self._parent_urls():
+            _invalidate_shared_gets(parent_url)
 
     @classmethod
     def get(cls, Id):
         url = '/'.join([cls._base_url, cls._name, str(Id)])
-        response = requests.get(url, headers=cls._headers())
-        item = handle_response(response)
+        item = _get_item(url, cls._headers())
         return cls._from_item(item)
 
 
@@ -155,7 +319,7 @@ class Map(Base):
     def list(cls, ParentId):
         url = '/'.join([cls._base_url, cls.parent._name, str(ParentId),
                         cls.child._name + 's'])
-        response = requests.get(url, headers=cls._headers())
+        response = _request("get", url, headers=cls._headers())
         content = handle_response(response)
         items = content.get('items')
         if items:
@@ -167,8 +331,10 @@ class Map(Base):
                         cls.child._name])
         thing = cls(None, **attr)
         data = thing._to_data()
-        response = requests.post(url, headers=cls._headers(), data=data)
+        response = _request("post", url, headers=cls._headers(), data=data)
         item = handle_response(response)
+        _invalidate_shared_gets(
+            '/'.join([cls._base_url, cls.parent._name, str(ParentId)]))
         return cls._from_item(item)
 
     def _send(self):
@@ -176,15 +342,17 @@ class Map(Base):
                         str(getattr(self, self.parent_id_attr)),
                         self.child._name, str(self.Id)])
         data = self._to_data()
-        response = requests.put(url, headers=self._headers(), data=data)
+        response = _request("put", url, headers=self._headers(), data=data)
         item = handle_response(response)
+        _invalidate_shared_gets(url)
+        _invalidate_shared_gets('/'.join([self._base_url, self.parent._name,
+            str(getattr(self, self.parent_id_attr))]))
 
     @classmethod
     def get(cls, ParentId, Id):
         url = '/'.join([cls._base_url, cls.parent._name, str(ParentId),
                         cls.child._name, str(Id)])
-        response = requests.get(url, headers=cls._headers())
-        item = handle_response(response)
+        item = _get_item(url, cls._headers())
         return cls._from_item(item)
 
 
@@ -289,10 +457,22 @@ class Flight(Base):
                              for item in thing.CreativeMaps]
         return thing
 
+    def _parent_urls(self):
+        # campaign GETs include their flights
+        campaign_id = getattr(self, 'CampaignId', None)
+        if campaign_id is None:
+            return []
+        return ['/'.join([self._base_url, Campaign._name, str(campaign_id)])]
+
     @classmethod
     def list(cls, is_active=False):
         return super(Flight, cls).list({"isActive" : is_active})
 
+    @classmethod
+    def iter_list(cls, is_active=False, page_size=LIST_PAGE_SIZE):
+        return super(Flight, cls).iter_list({"isActive": is_active},
+                                            page_size=page_size)
+
     def _to_item(self):
         item = Base._to_item(self)
         cfm_things = item.get('CreativeMaps')
@@ -341,7 +521,7 @@ class Creative(Base):
     def list(cls, AdvertiserId):
         url = '/'.join([cls._base_url, 'advertiser', str(AdvertiserId),
                         'creatives'])
-        response = requests.get(url, headers=cls._headers())
+        response = _request("get", url, headers=cls._headers())
         content = handle_response(response)
         items = content.get('items')
         if items:
@@ -457,8 +637,7 @@ class Campaign(Base):
     def get(cls, Id, exclude_flights=False):
         url = '/'.join([cls._base_url, cls._name, str(Id)])
         url += '?excludeFlights=%s' % str(exclude_flights).lower()
-        response = requests.get(url, headers=cls._headers())
-        item = handle_response(response)
+        item = _get_item(url, cls._headers())
         return cls._from_item(item)
 
     @classmethod
@@ -501,14 +680,18 @@ class GeoTargeting(Base):
         url = '/'.join([self._base_url, 'flight', str(FlightId), self._name,
                         str(self.Id)])
         data = self._to_data()
-        response = requests.put(url, headers=self._headers(), data=data)
+        response = _request("put", url, headers=self._headers(), data=data)
         item = handle_response(response)
+        _invalidate_shared_gets('/'.join([self._base_url, 'flight',
+                                          str(FlightId)]))
 
     def _delete(self, FlightId):
         url = '/'.join([self._base_url, 'flight', str(FlightId), self._name,
                         str(self.Id), 'delete'])
-        response = requests.get(url, headers=self._headers())
+        response = _request("get", url, headers=self._headers())
         message = handle_response(response)
+        _invalidate_shared_gets('/'.join([self._base_url, 'flight',
+                                          str(FlightId)]))
 
     def __repr__(self):
         return '<GeoTargeting %s>' % (self.Id)
@@ -1,85 +1,448 @@
+from collections import namedtuple
+import operator
+import re
+
+
+MEMOIZE_MAX_SIZE = 1024
+
+DEVICE_FIELDS = (
+    'os',
+    'osVersion.major',
+    'osVersion.minor',
+    'modelName',
+    'formFactor',
+)
+
+
 def _join_queries(operator, *args):
     delimiter = ' %s ' % operator.upper()
     items = args[0] if isinstance(args[0], list) else args
     return delimiter.join(items)
 
 
-def get_version_query(version_range):
-    if not version_range:
-        return
+def _memoize(fn):
+    """Cache results of `fn` by its (hashable) positional arguments.
+
+    The cache is process local and is reset once it grows past
+    `MEMOIZE_MAX_SIZE` entries.
+
+    """
+    cache = {}
+
+    def wrapper(*args):
+        try:
+            return cache[args]
+        except KeyError:
+            pass
 
-    lower_major, lower_minor = [int(bound) for bound in version_range[0].split('.')]
+        if len(cache) >= MEMOIZE_MAX_SIZE:
+            cache.clear()
 
-    lower_template = '($device.osVersion.major = %d AND $device.osVersion.minor >= %d)'
-    upper_template = '($device.osVersion.major = %d AND $device.osVersion.minor <= %d)'
+        result = cache[args] = fn(*args)
+        return result
 
-    # if there is an upper bound
-    if version_range[1]:
-        upper_major, upper_minor = [int(bound) for bound in version_range[1].split('.')]
+    wrapper.cache = cache
+    wrapper.__name__ = fn.__name__
+    wrapper.__doc__ = fn.__doc__
+    return wrapper
 
-        lower_range = lower_template % (lower_major, lower_minor)
-        upper_range = upper_template % (upper_major, upper_minor)
 
-        major_template = '($device.osVersion.major >= %d AND $device.osVersion.major <= %d)'
+def _contains(value, substring):
+    return substring in value
 
-        # if the min and max are the same
-        if version_range[0] == version_range[1]:
-            range_query = ('($device.osVersion.major = %d AND $device.osVersion.minor = %d)' %
-                             (lower_major, lower_minor))
 
-        # if the min and max are the same major version (i.e., 5.1 & 5.9)
-        elif lower_major == upper_major:
-            range_query = _join_queries('AND', lower_range, upper_range)
+OPERATORS = {
+    '=': operator.eq,
+    '>=': operator.ge,
+    '<=': operator.le,
+    'CONTAINS': _contains,
+}
 
-        # if the min major and max major are within 1 of each other
-        elif abs(lower_major - upper_major) <= 1:
-            range_query = _join_queries('OR', lower_range, upper_range)
 
-        # if the min minor is 0
-        elif lower_minor == 0:
-            major_range = major_template % (lower_major, upper_major - 1)
-            range_query = _join_queries('OR', major_range, upper_range)
+class Term(namedtuple('Term', ['field', 'operator', 'value'])):
+    """A single `$device` comparison, e.g. `$device.os = "iOS"`."""
 
-        # everything else
+    def compile(self):
+        if isinstance(self.value, int):
+            value = '%d' % self.value
         else:
-            major_range = major_template % (lower_major + 1, upper_major - 1)
-            range_query = _join_queries('OR', major_range, lower_range, upper_range)
+            value = '"%s"' % self.value
+        return '$device.%s %s %s' % (self.field, self.operator, value)
 
-    # if there is no upper bound
-    else:
-        major_template = '($device.osVersion.major >= %d)'
+    def evaluate(self, contexts):
+        compare = OPERATORS[self.operator]
+        mask = 0
+        for value, value_mask in contexts.value_masks(self.field).items():
+            if value is not None and compare(value, self.value):
+                mask |= value_mask
+        return mask
+
+
+class All(namedtuple('All', ['nodes'])):
+    def compile(self):
+        return _join_queries('AND', [node.compile() for node in self.nodes])
+
+    def evaluate(self, contexts):
+        mask = contexts.all_mask
+        for node in self.nodes:
+            if not mask:
+                break
+            mask &= node.evaluate(contexts)
+        return mask
+
+
+class Any(namedtuple('Any', ['nodes'])):
+    def compile(self):
+        return _join_queries('OR', [node.compile() for node in self.nodes])
+
+    def evaluate(self, contexts):
+        mask = 0
+        for node in self.nodes:
+            if mask == contexts.all_mask:
+                break
+            mask |= node.evaluate(contexts)
+        return mask
+
+
+class Group(namedtuple('Group', ['node'])):
+    def compile(self):
+        return '(%s)' % self.node.compile()
+
+    def evaluate(self, contexts):
+        return self.node.evaluate(contexts)
+
+
+def _parse_version(version):
+    major, minor = [int(bound) for bound in version.strip().split('.')]
+    return major, minor
+
+
+def _major_range(lower, upper=None):
+    terms = [Term('osVersion.major', '>=', lower)]
+    if upper is not None:
+        terms.append(Term('osVersion.major', '<=', upper))
+    return Group(All(terms))
+
+
+def _minor_range(major, operator, minor):
+    return Group(All([
+        Term('osVersion.major', '=', major),
+        Term('osVersion.minor', operator, minor),
+    ]))
 
-        # if the min minor is 0
+
+def _build_version_node(lower, upper):
+    """Build the targeting tree for an inclusive (major, minor) range.
+
+    Whole major versions covered by the range are merged into a single
+    `major >= x AND major <= y` clause, so a lower bound with a minor of 0
+    never produces a redundant `minor >= 0` clause.
+
+    """
+    lower_major, lower_minor = lower
+
+    # no upper bound
+    if upper is None:
         if lower_minor == 0:
-            major_range = major_template % lower_major
-            range_query = major_range
+            return _major_range(lower_major)
 
-        # everything else
-        else:
-            major_range = major_template % (lower_major + 1)
-            lower_range = lower_template % (lower_major, lower_minor)
-            range_query = _join_queries('OR', major_range, lower_range)
+        return Any([
+            _major_range(lower_major + 1),
+            _minor_range(lower_major, '>=', lower_minor),
+        ])
+
+    upper_major, upper_minor = upper
+
+    # if the min and max are the same
+    if lower == upper:
+        return _minor_range(lower_major, '=', lower_minor)
+
+    # if the min and max are the same major version (i.e., 5.1 & 5.9)
+    if lower_major == upper_major:
+        upper_range = _minor_range(upper_major, '<=', upper_minor)
+        if lower_minor == 0:
+            return upper_range
+
+        return All([
+            _minor_range(lower_major, '>=', lower_minor),
+            upper_range,
+        ])
+
+    nodes = []
+
+    # merge every fully covered major version into one range
+    first_full_major = lower_major if lower_minor == 0 else lower_major + 1
+    last_full_major = upper_major - 1
+    if first_full_major <= last_full_major:
+        nodes.append(_major_range(first_full_major, last_full_major))
+
+    if lower_minor != 0:
+        nodes.append(_minor_range(lower_major, '>=', lower_minor))
+
+    nodes.append(_minor_range(upper_major, '<=', upper_minor))
+
+    return Any(nodes)
+
+
+@_memoize
+def _compile_version_query(lower, upper):
+    return _build_version_node(lower, upper).compile()
+
+
+def get_version_query(version_range):
+    if not version_range:
+        return
+
+    lower = _parse_version(version_range[0])
+    upper = _parse_version(version_range[1]) if version_range[1] else None
+
+    return _compile_version_query(lower, upper)
+
+
+def _canonical_devices(devices):
+    return tuple(sorted(set(device.strip() for device in devices)))
 
-    return range_query
+
+@_memoize
+def _compile_mobile_targeting_query(os_str, lookup_str, devices,
+                                    version_query):
+    nodes = [Term('os', '=', os_str)]
+
+    if devices:
+        device_terms = [Term(lookup_str, 'CONTAINS', device)
+                        for device in devices]
+        nodes.append(Group(Any(device_terms)))
+
+    query = All(nodes).compile()
+
+    if version_query:
+        query = _join_queries('AND', query, '(%s)' % version_query)
+
+    return '(%s)' % query
 
 
 def get_mobile_targeting_query(os_str='',
                                lookup_str='',
                                devices=None,
                                versions=None):
+    """Return the Zerkel query targeting an OS and its devices/versions.
 
-    queries = []
-
-    os_query = '$device.os = "%s"' % os_str
-    queries.append(os_query)
+    Devices are deduplicated and sorted so that identical targeting always
+    compiles to a byte-identical query, and `update_changed` doesn't see a
+    change in `CustomTargeting` when only the order of devices differs.
 
+    """
     if devices and versions:
-        device_queries = ['$device.%s CONTAINS "%s"' % (lookup_str, device)
-                          for device in devices]
-        device_query = '(%s)' % _join_queries('OR', device_queries)
-        version_query = '(%s)' % get_version_query(versions)
+        devices = _canonical_devices(devices)
+        version_query = get_version_query(versions)
+    else:
+        devices = ()
+        version_query = None
+
+    return _compile_mobile_targeting_query(
+        os_str, lookup_str, devices, version_query)
+
+
+class ZerkelParseError(ValueError):
+    pass
+
+
+TOKEN_RX = re.compile(r"""
+    \s*(?:
+        (?P<paren>[()])|
+        (?P<keyword>AND|OR|CONTAINS)\b|
+        (?P<field>\$device\.[A-Za-z.]+)|
+        (?P<operator>>=|<=|=)|
+        "(?P<string>[^"]*)"|
+        (?P<int>-?[0-9]+)
+    )""", re.VERBOSE)
+
+
+def _tokenize(query):
+    tokens = []
+    position = 0
+    query = query.rstrip()
+
+    while position < len(query):
+        match = TOKEN_RX.match(query, position)
+        if not match:
+            raise ZerkelParseError('unexpected input at %d: %r' %
+                                   (position, query[position:]))
+
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'field':
+            value = value[len('$device.'):]
+        elif kind == 'int':
+            value = int(value)
+        elif kind == 'keyword' and value == 'CONTAINS':
+            kind = 'operator'
+        tokens.append((kind, value))
+        position = match.end()
+
+    return tokens
+
+
+class _Parser(object):
+    """Recursive descent parser for the Zerkel subset we generate.
+
+    expression := conjunction (OR conjunction)*
+    conjunction := atom (AND atom)*
+    atom := '(' expression ')' | $device.<field> <operator> <value>
+
+    """
+
+    def __init__(self, query):
+        self.tokens = _tokenize(query)
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def take(self, kind, value=None):
+        token_kind, token_value = self.peek()
+        if token_kind != kind or (value is not None and token_value != value):
+            raise ZerkelParseError('expected %s, got %r' %
+                                   (value or kind, token_value))
+        self.position += 1
+        return token_value
+
+    def parse(self):
+        node = self.expression()
+        if self.position != len(self.tokens):
+            raise ZerkelParseError('unexpected %r' % (self.peek()[1],))
+        return node
+
+    def expression(self):
+        nodes = [self.conjunction()]
+        while self.peek() == ('keyword', 'OR'):
+            self.take('keyword', 'OR')
+            nodes.append(self.conjunction())
+        return nodes[0] if len(nodes) == 1 else Any(nodes)
+
+    def conjunction(self):
+        nodes = [self.atom()]
+        while self.peek() == ('keyword', 'AND'):
+            self.take('keyword', 'AND')
+            nodes.append(self.atom())
+        return nodes[0] if len(nodes) == 1 else All(nodes)
+
+    def atom(self):
+        if self.peek() == ('paren', '('):
+            self.take('paren', '(')
+            node = self.expression()
+            self.take('paren', ')')
+            return Group(node)
+
+        field = self.take('field')
+        op = self.take('operator')
+        kind, value = self.peek()
+        if kind not in ('string', 'int'):
+            raise ZerkelParseError('expected value, got %r' % (value,))
+        self.position += 1
+        return Term(field, op, value)
+
+
+@_memoize
+def parse_query(query):
+    """Parse a `CustomTargeting` string into a tree of Term/All/Any/Group.
+
+    An empty query targets everything and parses to an empty `All`.
+
+    """
+    if not query or not query.strip():
+        return All([])
+    return _Parser(query).parse()
+
+
+class DeviceContexts(object):
+    """A dictionary encoded, columnar batch of device contexts.
+
+    Identical contexts are stored once with a count, and each column keeps a
+    bitmask of the distinct rows holding each value, so evaluating a term
+    costs one comparison per distinct column value rather than per request.
+
+    """
+
+    def __init__(self):
+        self.columns = {field: [] for field in DEVICE_FIELDS}
+        self.counts = []
+        self._index = {}
+        self._value_masks = {}
+
+    @classmethod
+    def from_rows(cls, rows):
+        contexts = cls()
+        for row in rows:
+            contexts.add(row)
+        return contexts
+
+    def add(self, row, count=1):
+        key = tuple(row.get(field) for field in DEVICE_FIELDS)
+        i = self._index.get(key)
+        if i is None:
+            i = self._index[key] = len(self.counts)
+            for field, value in zip(DEVICE_FIELDS, key):
+                self.columns[field].append(value)
+            self.counts.append(0)
+            self._value_masks.clear()
+        self.counts[i] += count
+
+    def __len__(self):
+        return len(self.counts)
+
+    @property
+    def all_mask(self):
+        return (1 << len(self.counts)) - 1
+
+    def value_masks(self, field):
+        masks = self._value_masks.get(field)
+        if masks is None:
+            if field not in self.columns:
+                raise KeyError('unknown device field: %s' % field)
+
+            indices = {}
+            for i, value in enumerate(self.columns[field]):
+                indices.setdefault(value, []).append(i)
+
+            masks = {}
+            for value, rows in indices.items():
+                mask = 0
+                for i in rows:
+                    mask |= 1 << i
+                masks[value] = mask
+            self._value_masks[field] = masks
+        return masks
+
+    def indices(self, mask):
+        i = 0
+        while mask:
+            if mask & 1:
+                yield i
+            mask >>= 1
+            i += 1
+
+    def rows(self, mask):
+        for i in self.indices(mask):
+            yield {field: self.columns[field][i] for field in DEVICE_FIELDS}
+
+    def reach(self, mask):
+        return sum(self.counts[i] for i in self.indices(mask))
+
+
+def evaluate_query(query, contexts):
+    """Return a bitmask of the distinct `contexts` matched by `query`."""
+    return parse_query(query).evaluate(contexts)
+
+
+def estimate_reach(query, contexts):
+    """Return the number of requests in `contexts` matched by `query`."""
+    return contexts.reach(evaluate_query(query, contexts))
 
-        queries.append(device_query)
-        queries.append(version_query)
 
-    return '(%s)' % _join_queries('AND', queries)
+def query_matches(query, context):
+    """Return whether a single device context dict matches `query`."""
+    contexts = DeviceContexts.from_rows([context])
+    return bool(evaluate_query(query, contexts))
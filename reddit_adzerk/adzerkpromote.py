@@ -1,12 +1,15 @@
 from collections import namedtuple
+from contextlib import contextmanager
 import base64
 import datetime
+import hashlib
 import json
 import math
 import random
 import re
 import select
 import string
+import threading
 from urllib import quote
 
 import adzerk_api
@@ -15,6 +18,7 @@ from pylons import request
 from pylons import tmpl_context as c
 from pylons import app_globals as g
 import requests
+from sqlalchemy import and_, func, or_
 
 from r2.config import feature
 from r2.controllers import api, add_controller
@@ -60,14 +64,21 @@ from r2.models import (
     PromotionLog,
     Subreddit,
 )
-from r2.models import promo
+from r2.models import promo, traffic
 
 from r2admin.lib.irc import (
     CHANNEL_TYPES,
     queue_alert_report,
 )
 
-from reddit_adzerk.lib.cache import PromoCampaignByFlightIdCache
+from reddit_adzerk.lib import (
+    queues,
+    retry,
+)
+from reddit_adzerk.lib.cache import (
+    AdvertiserCache,
+    PromoCampaignByFlightIdCache,
+)
 from reddit_adzerk.lib.validator import (
     VSite,
 )
@@ -81,6 +92,8 @@ EMPTY_AD_TYPE = 20
 ADZERK_IMPRESSION_BUMP = 500    # add extra impressions to the number we
                                 # request from adzerk in case their count
                                 # is lower than our internal traffic tracking
+# campaigns per billable impressions query, each adds a clause
+BILLABLE_IMPRESSIONS_CHUNK_SIZE = 100
 
 AD_TYPE_FRIENDLY_NAMES = {
     LEADERBOARD_AD_TYPE: "sponsored_headline",
@@ -114,8 +127,31 @@ GOAL_TYPE_BY_COST_BASIS = {
 
 FREQUENCY_CAP_DURATION_HOURS = 24
 
+# bump to resync every flight/creative when the payloads change shape
+SYNC_FINGERPRINT_VERSION = 1
+
+ADZERK_Q = "adzerk_q"
+# deactivations skip ahead of routine syncs, every minute they wait is
+# unbillable overdelivery
+ADZERK_URGENT_Q = "adzerk_urgent_q"
+
 LOID_CREATED_COOKIE = "loidcreated"
 
+FlightPayload = namedtuple(
+    'FlightPayload', [
+        'data',
+        'keywords',
+        'site_targeting',
+        'location',
+        'needs_approval',
+        'needs_payment',
+        'is_overdelivered',
+        'is_paused',
+        'is_terminated',
+    ],
+)
+
+
 def sanitize_text(text):
     return _force_utf8(text).translate(None, DELCHARS)
 
@@ -183,6 +219,36 @@ def make_change_strings(changed):
     return map(change_to_str, changed)
 
 
+def _sync_fingerprint(*payload):
+    """Return a stable hash of what we want an adzerk object to look like."""
+    data = json.dumps([SYNC_FINGERPRINT_VERSION] + list(payload),
+                      sort_keys=True, default=repr)
+    return hashlib.sha1(data).hexdigest()
+
+
+def _is_synced(thing, attr, fingerprint, object_type):
+    """Return whether `thing` was last synced with the same payload."""
+    synced = getattr(thing, attr, None) == fingerprint
+    g.stats.simple_event('adzerk.sync.%s.%s' %
+                         (object_type, 'skipped' if synced else 'synced'))
+    if synced:
+        g.log.debug('%s unchanged, skipping %s sync' % (thing, object_type))
+    return synced
+
+
+def _clear_flight_fingerprint(campaign):
+    """Make the next sync of `campaign` send its flight again.
+
+    Used when the flight is written other than by a normal sync, so
+    `_is_synced` can't skip the sync that would put it back.
+
+    """
+
+    if getattr(campaign, 'adzerk_flight_fingerprint', None) is not None:
+        campaign.adzerk_flight_fingerprint = None
+        campaign._commit()
+
+
 def update_campaign(link, az_advertiser=None, triggered_by=None):
     """Add/update a reddit link as an Adzerk Campaign"""
     if getattr(link, 'external_campaign_id', None) is not None:
@@ -264,11 +330,6 @@ def update_campaign(link, az_advertiser=None, triggered_by=None):
 
 def update_creative(link, az_advertiser, triggered_by=None):
     """Add/update a reddit link as an Adzerk Creative"""
-    if getattr(link, 'external_creative_id', None) is not None:
-        az_creative = adzerk_api.Creative.get(link.external_creative_id)
-    else:
-        az_creative = None
-
     title = link._fullname
     url = add_sr(link.url, sr_path=False) if link.is_self else link.url
 
@@ -297,6 +358,16 @@ def update_creative(link, az_advertiser, triggered_by=None):
         'IsNoTrack': DNT_compliant,
     }
 
+    fingerprint = _sync_fingerprint(d)
+    if getattr(link, 'external_creative_id', None) is not None:
+        if _is_synced(link, 'adzerk_creative_fingerprint', fingerprint,
+                      'creative'):
+            return adzerk_api.Stub(link.external_creative_id)
+
+        az_creative = adzerk_api.Creative.get(link.external_creative_id)
+    else:
+        az_creative = None
+
     request_error = None
 
     if az_creative:
@@ -344,9 +415,11 @@ def update_creative(link, az_advertiser, triggered_by=None):
                 raise request_error
 
         link.external_creative_id = az_creative.Id
-        link._commit()
         log_text = 'created %s' % az_creative
 
+    link.adzerk_creative_fingerprint = fingerprint
+    link._commit()
+
     if log_text:
         PromotionLog.add(link, log_text)
         g.log.info(log_text)
@@ -354,11 +427,25 @@ def update_creative(link, az_advertiser, triggered_by=None):
     return az_creative
 
 
+def get_advertiser(author, full=False):
+    """Return the adzerk advertiser for `author` or None if there isn't one.
+
+    Without `full` this is a `Stub` of the stored id, which is all that
+    syncs need, so no request is made.
+
+    """
+
+    advertiser_id = getattr(author, 'external_advertiser_id', None)
+    if advertiser_id is None:
+        return None
+
+    if full:
+        return AdvertiserCache.get(advertiser_id)
+    return adzerk_api.Stub(advertiser_id)
+
+
 def update_advertiser(author, triggered_by=None):
-    if getattr(author, 'external_advertiser_id', None) is not None:
-        az_advertiser = adzerk_api.Advertiser.get(author.external_advertiser_id)
-    else:
-        az_advertiser = None
+    az_advertiser = get_advertiser(author)
 
     if az_advertiser:
         return az_advertiser
@@ -383,7 +470,7 @@ def update_advertiser(author, triggered_by=None):
             request_error=request_error,
         )
 
-        # re-raise after sending event to requeue item.
+        # re-raise after sending event so the item is retried.
         if request_error:
             raise request_error
 
@@ -406,17 +493,13 @@ def flight_is_active(needs_approval, is_paused, needs_payment, is_terminated,
 
     return not is_inactive
 
-def update_flight(link, campaign, triggered_by=None):
-    """Add/update a reddit campaign as an Adzerk Flight"""
-    if getattr(campaign, 'external_flight_id', None) is not None:
-        az_flight = adzerk_api.Flight.get(campaign.external_flight_id)
-    else:
-        az_flight = None
+def get_flight_payload(link, campaign):
+    """Return what the Adzerk Flight for a reddit campaign should look like.
 
-    # backwards compatability
-    if campaign.platform == "mobile":
-        campaign.platform = "mobile_web"
-        campaign._commit()
+    Geotargeting and site targeting are returned separately from the Flight
+    fields in `data` because existing flights update them differently.
+
+    """
 
     campaign_overdelivered = is_overdelivered(campaign)
     delayed_start = campaign.start_date + datetime.timedelta(minutes=15)
@@ -559,7 +642,84 @@ def update_flight(link, campaign, triggered_by=None):
             'IsExclude': False,
             'ZoneId': None,
         }]
+    else:
+        site_targeting = None
+
+    # special handling for location conversions between reddit and adzerk
+    if campaign.location:
+        campaign_country = campaign.location.country
+        campaign_region = campaign.location.region
+        if campaign.location.metro:
+            campaign_metro = int(campaign.location.metro)
+        else:
+            campaign_metro = None
+        location = (campaign_country, campaign_region, campaign_metro)
+    else:
+        location = None
+
+    return FlightPayload(
+        data=d,
+        keywords=keywords,
+        site_targeting=site_targeting,
+        location=location,
+        needs_approval=campaign_needs_approval,
+        needs_payment=campaign_needs_payment,
+        is_overdelivered=campaign_overdelivered,
+        is_paused=campaign_is_paused,
+        is_terminated=campaign_is_terminated,
+    )
+
+
+def update_flight(link, campaign, triggered_by=None, force=False):
+    """Add/update a reddit campaign as an Adzerk Flight
+
+    The sync is skipped if the payload hasn't changed since the last one,
+    unless `force` is passed.
+
+    """
+
+    if force:
+        # a forced sync that fails part way mustn't leave the old
+        # fingerprint looking current
+        _clear_flight_fingerprint(campaign)
+
+    with billable_impressions_batch([campaign]):
+        return _update_flight(link, campaign, triggered_by, force)
+
 
+def _update_flight(link, campaign, triggered_by, force):
+    # backwards compatability
+    if campaign.platform == "mobile":
+        campaign.platform = "mobile_web"
+        campaign._commit()
+
+    payload = get_flight_payload(link, campaign)
+    d = payload.data
+    keywords = payload.keywords
+    site_targeting = payload.site_targeting
+    location = payload.location
+    if location:
+        campaign_country, campaign_region, campaign_metro = location
+    campaign_needs_approval = payload.needs_approval
+    campaign_needs_payment = payload.needs_payment
+    campaign_overdelivered = payload.is_overdelivered
+    campaign_is_paused = payload.is_paused
+    campaign_is_terminated = payload.is_terminated
+
+    # skip the sync entirely if nothing we send to adzerk has changed since
+    # the last successful one.
+    fingerprint = _sync_fingerprint(
+        dict(d, Keywords=sorted(keywords)), site_targeting, location)
+    if getattr(campaign, 'external_flight_id', None) is not None:
+        if not force and _is_synced(campaign, 'adzerk_flight_fingerprint',
+                                    fingerprint, 'flight'):
+            return adzerk_api.Stub(campaign.external_flight_id)
+
+        az_flight = adzerk_api.Flight.get(campaign.external_flight_id)
+    else:
+        az_flight = None
+
+    if site_targeting:
         if az_flight:
             site_targeting[0]['FlightId'] = az_flight.Id
 
@@ -584,15 +744,6 @@ def update_flight(link, campaign, triggered_by=None):
             'SiteZoneTargeting': [],
         })
 
-    # special handling for location conversions between reddit and adzerk
-    if campaign.location:
-        campaign_country = campaign.location.country
-        campaign_region = campaign.location.region
-        if campaign.location.metro:
-            campaign_metro = int(campaign.location.metro)
-        else:
-            campaign_metro = None
-
     if az_flight and az_flight.GeoTargeting:
         # special handling for geotargeting of existing flights
         # can't update geotargeting through the Flight endpoint, do it manually
@@ -669,14 +820,14 @@ def update_flight(link, campaign, triggered_by=None):
                 request_error=request_error,
             )
 
-            # re-raise after sending event to requeue item.
+            # re-raise after sending event so the item is retried.
             if request_error:
                 raise request_error
 
         change_strs = make_change_strings(changed)
 
         if campaign_overdelivered:
-            billable = promote.get_billable_impressions(campaign)
+            billable = get_billable_impressions(campaign)
             over_str = 'overdelivered %s/%s' % (billable, campaign.impressions)
             change_strs.append(over_str)
 
@@ -701,7 +852,7 @@ def update_flight(link, campaign, triggered_by=None):
                 request_error=request_error,
             )
 
-            # re-raise after sending event to requeue item.
+            # re-raise after sending event so the item is retried.
             if request_error:
                 raise request_error
 
@@ -715,9 +866,10 @@ def update_flight(link, campaign, triggered_by=None):
         PromotionLog.add(link, log_text)
         g.log.info(log_text)
 
+    campaign.adzerk_flight_fingerprint = fingerprint
     if campaign_overdelivered:
         campaign.external_flight_overdelivered = True
-        campaign._commit()
+    campaign._commit()
 
     return az_flight
 
@@ -780,22 +932,21 @@ def update_cfmap(link, campaign, triggered_by):
 
 def update_adzerk(link, campaign=None):
     g.log.debug('queuing update_adzerk %s %s' % (link, campaign))
-    msg = json.dumps({
+    queues.add_item(ADZERK_Q, {
         'action': 'update_adzerk',
         'link': link._fullname,
         'campaign': campaign._fullname if campaign else None,
         'triggered_by': c.user._fullname if c.user else None,
     })
-    amqp.add_item('adzerk_q', msg)
 
 
 def deactivate_orphaned_flight(az_flight_id):
     g.log.debug("queuing deactivate_orphaned_flight %d" % az_flight_id)
 
-    amqp.add_item("adzerk_q", json.dumps({
+    queues.add_item(ADZERK_URGENT_Q, {
         "action": "deactivate_orphaned_flight",
         "flight": az_flight_id,
-    }))
+    })
 
 
 def _update_adzerk(link, campaign, triggered_by):
@@ -820,12 +971,11 @@ def _update_adzerk(link, campaign, triggered_by):
 
 def deactivate_overdelivered(link, campaign):
     g.log.debug('queuing deactivate_overdelivered %s %s' % (link, campaign))
-    msg = json.dumps({
+    queues.add_item(ADZERK_URGENT_Q, {
         'action': 'deactivate_overdelivered',
         'link': link._fullname,
         'campaign': campaign._fullname,
     })
-    amqp.add_item('adzerk_q', msg)
 
 
 def _deactivate_overdelivered(link, campaign):
@@ -849,14 +999,27 @@ def _deactivate_orphaned_flight(flight_id):
         az_flight.IsActive = False
         az_flight._send()
 
+        # if a campaign does have the flight, its next sync reactivates it
+        campaign_fullname = PromoCampaignByFlightIdCache.get(flight_id)
+        if campaign_fullname:
+            campaign = PromoCampaign._by_fullname(campaign_fullname,
+                                                  data=True)
+            _clear_flight_fingerprint(campaign)
+
 
 @hooks.on('promote.make_daily_promotions')
 def deactivate_overdelivered_campaigns(offset=0):
-    for campaign, link in promote.get_scheduled_promos(offset=offset):
+    promos = [
+        (campaign, link)
+        for campaign, link in promote.get_scheduled_promos(offset=offset)
         if (promote.is_live_promo(link, campaign) and
-                not getattr(campaign, 'external_flight_overdelivered', False) and
-                is_overdelivered(campaign)):
-            deactivate_overdelivered(link, campaign)
+            not getattr(campaign, 'external_flight_overdelivered', False))
+    ]
+
+    with billable_impressions_batch(campaign for campaign, link in promos):
+        for campaign, link in promos:
+            if is_overdelivered(campaign):
+                deactivate_overdelivered(link, campaign)
 
 
 @hooks.on('promote.edit_promotion')
@@ -893,19 +1056,106 @@ def delete_campaign(link, campaign):
     update_adzerk(link, campaign)
 
 
+_billable_impressions = threading.local()
+
+
+def _can_overdeliver(campaign):
+    return (campaign.cost_basis == promo.PROMOTE_COST_BASIS.fixed_cpm and
+            not campaign.is_house)
+
+
+@contextmanager
+def billable_impressions_batch(campaigns):
+    """Look up billable impressions for `campaigns` at once.
+
+    Lookups inside the block reuse them, and remember any others. Nested
+    batches share the outermost one's lookups.
+
+    """
+
+    memo = getattr(_billable_impressions, 'memo', None)
+    is_outermost = memo is None
+    if is_outermost:
+        memo = _billable_impressions.memo = {}
+
+    try:
+        campaigns = [campaign for campaign in campaigns
+                     if _can_overdeliver(campaign) and
+                        campaign._fullname not in memo]
+        if campaigns:
+            memo.update(get_billable_impressions_multi(campaigns))
+        yield
+    finally:
+        if is_outermost:
+            _billable_impressions.memo = None
+
+
+def get_billable_impressions_multi(campaigns):
+    """Return the billable impressions of `campaigns` by fullname.
+
+    Counts what `promote.get_billable_impressions` does, the hourly
+    `TargetedImpressionsByCodename` rows over each campaign's traffic dates,
+    with one grouped query per `BILLABLE_IMPRESSIONS_CHUNK_SIZE` campaigns.
+
+    """
+
+    now = datetime.datetime.now(g.tz)
+    impressions = {}
+    date_ranges = []
+    for campaign in campaigns:
+        impressions[campaign._fullname] = 0
+        start, end = promote.get_traffic_dates(campaign)
+        if start > now:
+            continue
+        date_ranges.append((campaign._fullname, start.replace(tzinfo=None),
+                            end.replace(tzinfo=None)))
+
+    cls = traffic.TargetedImpressionsByCodename
+    for i in xrange(0, len(date_ranges), BILLABLE_IMPRESSIONS_CHUNK_SIZE):
+        chunk = date_ranges[i:i + BILLABLE_IMPRESSIONS_CHUNK_SIZE]
+        q = (traffic.Session.query(cls.codename, func.sum(cls.pageview_count))
+                .filter(cls.interval == "hour")
+                .filter(or_(*[and_(cls.codename == codename,
+                                   cls.date >= start,
+                                   cls.date <= end)
+                              for codename, start, end in chunk]))
+                .group_by(cls.codename))
+        for codename, total in q:
+            impressions[codename] = int(total or 0)
+
+    return impressions
+
+
+def get_billable_impressions(campaign):
+    memo = getattr(_billable_impressions, 'memo', None)
+    if memo is not None and campaign._fullname in memo:
+        return memo[campaign._fullname]
+
+    impressions = get_billable_impressions_multi([campaign])[
+        campaign._fullname]
+    if memo is not None:
+        memo[campaign._fullname] = impressions
+    return impressions
+
+
 def is_overdelivered(campaign):
-    if (campaign.cost_basis != promo.PROMOTE_COST_BASIS.fixed_cpm or
-            campaign.is_house):
+    if not _can_overdeliver(campaign):
         return False
 
-    billable_impressions = promote.get_billable_impressions(campaign)
+    billable_impressions = get_billable_impressions(campaign)
     return billable_impressions >= campaign.impressions + ADZERK_IMPRESSION_BUMP
 
 
-def process_adzerk():
-    @g.stats.amqp_processor('adzerk_q')
-    def _handle_adzerk(msg):
-        data = json.loads(msg.body)
+def process_adzerk(queue=ADZERK_Q):
+    """Consume sync messages from `queue`.
+
+    Deactivations are queued to `ADZERK_URGENT_Q` so they don't wait behind
+    bulk edits on `ADZERK_Q`, run this with `queue=ADZERK_URGENT_Q` to
+    consume them. Both lanes take every action.
+
+    """
+
+    def _sync(data):
         g.log.debug('data: %s' % data)
 
         action = data.get('action')
@@ -931,7 +1181,12 @@ def process_adzerk():
         elif action == 'deactivate_overdelivered':
             _deactivate_overdelivered(link, campaign)
 
-    amqp.consume_items('adzerk_q', _handle_adzerk, verbose=False)
+    @g.stats.amqp_processor(queue)
+    def _handle_adzerk(msg):
+        # failed syncs are retried later rather than redelivered right away
+        retry.handle_with_retries(queue, msg, _sync)
+
+    amqp.consume_items(queue, _handle_adzerk, verbose=False)
 
 AdzerkResponse = namedtuple(
     'AdzerkResponse', [
@@ -985,6 +1240,15 @@ class BlankCreativeResponse(object):
             self.body = body
 
 
+def adzerk_engine_url():
+    # allow the domain to specify a scheme so the engine can be pointed at
+    # a local stand-in (see `reddit_adzerk.tests.emulator`).
+    domain = g.adzerk_engine_domain
+    if "://" not in domain:
+        domain = "https://%s" % domain
+    return "%s/api/v2" % domain
+
+
 def adzerk_request(
     keywords, properties, user_id, placement_names,
     platform="desktop",
@@ -1035,7 +1299,7 @@ def adzerk_request(
     if user_id:
         data["user"] = {"key": user_id}
 
-    url = 'https://%s/api/v2' % g.adzerk_engine_domain
+    url = adzerk_engine_url()
     headers = {
         'content-type': 'application/json',
         'user-agent': request.headers.get('User-Agent'),
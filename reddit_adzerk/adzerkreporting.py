@@ -8,9 +8,17 @@ A cron job is used to queue reports for promos that are currently
 serving, or served the day before.  The queue blocks until a
 report can be retrived until moving on to the next item.  If a
 report is pending for more than `adzerk_reporting_timeout` it is
-assumed to have failed and is generated.
+assumed to have failed, and the message is retried with a backoff (see
+`reddit_adzerk.lib.retry`).
+
+Identical report requests are collapsed: a message is only queued, and
+only processed, once per (action, ids, date window) while it's in flight.
+The claims are released once the message is processed, and expire after
+`adzerk_reporting_dedup_window` seconds in case it's lost.
 """
 
+import calendar
+import hashlib
 import itertools
 import json
 import math
@@ -45,8 +53,21 @@ from reddit_adzerk import (
     adzerk_api,
     report,
 )
+from reddit_adzerk.lib import (
+    archive,
+    queues,
+    retry,
+)
 
 RETRY_SLEEP_SECONDS = 3
+DEFAULT_DEDUP_WINDOW_SECONDS = 60 * 60
+
+# reports are grouped to take about this fraction of `adzerk_reporting_timeout`
+REPORT_TARGET_TIMEOUT_RATIO = 0.25
+# seconds to generate and process a report per flight per day, until measured
+DEFAULT_REPORT_SECONDS_PER_FLIGHT_DAY = 0.01
+REPORT_COST_RATE_WEIGHT = 0.2
+REPORT_COST_RATE_TTL = 60 * 60 * 24 * 7
 
 Session = scoped_session(sessionmaker(bind=engine))
 
@@ -66,59 +87,203 @@ def queue_promo_reports():
         campaigns.add(campaign)
         campaigns_by_link[link].add(campaign)
 
-    links = [(link, link_campaigns) for link, link_campaigns in campaigns_by_link.items()]
+    now = datetime.utcnow().replace(tzinfo=pytz.utc)
+
+    # pack links and campaigns into groups whose reports cost about the
+    # same, see `_pack_by_cost`.
+    sized_links = []
+    for link, link_campaigns in campaigns_by_link.iteritems():
+        start, end = _get_link_report_range([link], link_campaigns, now)
+        sized_links.append(((link, link_campaigns), start, end,
+                            len(link_campaigns)))
+
+    link_groups = _pack_by_cost(
+        sized_links,
+        target_cost=_get_target_cost("generate_daily_link_reports"),
+        max_size=g.live_config.get("adzerk_reporting_link_group_size", 50),
+    )
+
+    sized_campaigns = []
+    for campaign in campaigns:
+        start, end = _get_campaign_report_range([campaign], now)
+        sized_campaigns.append((campaign, start, end, 1))
+
+    campaign_groups = _pack_by_cost(
+        sized_campaigns,
+        target_cost=_get_target_cost("generate_lifetime_campaign_reports"),
+        max_size=g.live_config.get("adzerk_reporting_campaign_group_size", 100),
+    )
+
+    for group in campaign_groups:
+        _generate_promo_reports(group)
 
-    # sort and group links together in `adzerk_reporting_link_group_size` sized groups
-    def sort_links(items):
-        link, link_campaigns = items
-        start, end = _get_campaigns_date_range(link_campaigns)
+    for group in link_groups:
+        _generate_link_reports({
+            "links": [link for link, link_campaigns in group],
+            "campaigns": [campaign for link, link_campaigns in group
+                          for campaign in link_campaigns],
+        })
 
-        return start
+    amqp.worker.join()
 
-    links = sorted(links, key=sort_links)
-    link_groups = defaultdict(lambda: defaultdict(list))
 
-    for i, items in enumerate(links):
-        link, link_campaigns = items
-        group = i / g.live_config.get("adzerk_reporting_link_group_size", 50)
-        link_groups[group]["links"].append(link)
-        link_groups[group]["campaigns"] = link_groups[group]["campaigns"] + list(link_campaigns)
+def _to_timestamp(date):
+    return calendar.timegm(date.utctimetuple())
 
-    # sort and group campaigns together in `adzerk_reporting_campaign_group_size` sized groups
-    campaigns = sorted(campaigns, key=lambda c: c.start_date)
-    campaigns_groups = defaultdict(list)
 
-    for i, campaign in enumerate(campaigns):
-        group = i / g.live_config.get("adzerk_reporting_campaign_group_size", 100)
-        campaigns_groups[group].append(campaign)
+def _report_days(start, end):
+    return max(1, int(math.ceil((end - start).total_seconds() / 86400.)))
 
-    for group, items in campaigns_groups.items():
-        _generate_promo_reports(items)
 
-    for group, items in link_groups.items():
-        _generate_link_reports(items)
+def _pack_by_cost(sized_items, target_cost, max_size):
+    """Group items so that each group's report costs about `target_cost`.
 
-    amqp.worker.join()
+    `sized_items` is a list of (item, start, end, flights). A report covers
+    every day between the earliest start and latest end of its items for all
+    of their flights, so it costs days in range * flights. Items are sorted
+    by start date and added to the current group until the next one would
+    push it over `target_cost` or `max_size` items. An item costing more than
+    `target_cost` gets a group to itself.
+
+    """
+
+    groups = []
+    group = []
+    group_start = group_end = None
+    group_flights = 0
+
+    for item, start, end, flights in sorted(sized_items, key=lambda i: i[1]):
+        if group:
+            cost = (_report_days(min(group_start, start), max(group_end, end)) *
+                    (group_flights + flights))
+
+            if cost > target_cost or len(group) >= max_size:
+                groups.append(group)
+                group = []
+
+        if not group:
+            group_start, group_end = start, end
+            group_flights = 0
+
+        group.append(item)
+        group_start = min(group_start, start)
+        group_end = max(group_end, end)
+        group_flights += flights
+
+    if group:
+        groups.append(group)
+
+    return groups
+
+
+def _report_cost_rate_key(action):
+    return "azreport:cost_rate:%s" % action
+
+
+def _get_target_cost(action):
+    """Return the cost (flight days) of a report that runs in target time.
+
+    The target is a fraction of `adzerk_reporting_timeout`, converted to
+    flight days with the seconds per flight day measured from previous
+    reports.
+
+    """
+
+    timeout = g.live_config.get("adzerk_reporting_timeout", 500)
+    target_seconds = timeout * REPORT_TARGET_TIMEOUT_RATIO
+    rate = (g.gencache.get(_report_cost_rate_key(action)) or
+            DEFAULT_REPORT_SECONDS_PER_FLIGHT_DAY)
+
+    return max(1, int(target_seconds / rate))
+
+
+def _record_report_cost(action, cost, seconds):
+    """Update the moving average of seconds per flight day for `action`."""
+    key = _report_cost_rate_key(action)
+    rate = seconds / float(cost)
+    previous = g.gencache.get(key)
+
+    if previous:
+        rate = (REPORT_COST_RATE_WEIGHT * rate +
+                (1 - REPORT_COST_RATE_WEIGHT) * previous)
+
+    g.gencache.set(key, rate, time=REPORT_COST_RATE_TTL)
+
+
+def _get_dedup_window():
+    return g.live_config.get("adzerk_reporting_dedup_window",
+                             DEFAULT_DEDUP_WINDOW_SECONDS)
+
+
+def _dedup_key(stage, action, ids, start, end):
+    ids_hash = hashlib.md5(",".join(str(i) for i in sorted(ids))).hexdigest()
+    return "azreport:%s:%s:%s:%s:%s" % (stage, action, ids_hash, start, end)
+
+
+def _claim_report(stage, action, ids, start, end):
+    """Claim `stage` of the report of `ids` between `start` and `end`.
+
+    The claim lasts until it's released, or for the dedup window at most.
+    Returns the claimed key, or None if the report was already claimed.
+
+    """
+
+    key = _dedup_key(stage, action, ids, start, end)
+
+    if g.gencache.add(key, True, time=_get_dedup_window()):
+        return key
+
+    g.log.info("skipping duplicate %s %s (%s)" % (stage, action, key))
+    g.stats.simple_event("adzerk.reporting.dedup.%s" % stage)
+    return None
+
+
+def _release_report(dedup_keys):
+    """Allow the report claimed with `dedup_keys` to run again."""
+    if dedup_keys:
+        g.gencache.delete_multi(dedup_keys)
+
+
+def _queue_report_message(action, ids, window, **data):
+    # reports are deduplicated by day, the window's end moves with `now`
+    start, end = (date.strftime("%Y-%m-%d") for date in window)
+    dedup_key = _claim_report("queue", action, ids, start, end)
+    if not dedup_key:
+        return
+
+    data["action"] = action
+    data["start"] = start
+    data["end"] = end
+    # released by the consumer once it's processed
+    data["dedup_key"] = dedup_key
+    queues.add_item("adzerk_reporting_q", data)
 
 
 def _generate_link_reports(items):
     links = items["links"]
     campaigns = items["campaigns"]
+    now = datetime.utcnow().replace(tzinfo=pytz.utc)
 
     g.log.info("queuing report for link %s" % ",".join(l._fullname for l in links))
-    amqp.add_item("adzerk_reporting_q", json.dumps({
-        "action": "generate_daily_link_reports",
-        "link_ids": [l._id for l in links],
-        "campaign_ids": [c._id for c in campaigns],
-    }))
+    _queue_report_message(
+        "generate_daily_link_reports",
+        ids=[l._id for l in links],
+        window=_get_link_report_range(links, campaigns, now),
+        link_ids=[l._id for l in links],
+        campaign_ids=[c._id for c in campaigns],
+    )
 
 
 def _generate_promo_reports(campaigns):
+    now = datetime.utcnow().replace(tzinfo=pytz.utc)
+
     g.log.info("queuing report for campaigns %s" % ",".join(c._fullname for c in campaigns))
-    amqp.add_item("adzerk_reporting_q", json.dumps({
-        "action": "generate_lifetime_campaign_reports",
-        "campaign_ids": [c._id for c in campaigns],
-    }))
+    _queue_report_message(
+        "generate_lifetime_campaign_reports",
+        ids=[c._id for c in campaigns],
+        window=_get_campaign_report_range(campaigns, now),
+        campaign_ids=[c._id for c in campaigns],
+    )
 
 
 def _get_campaigns_date_range(campaigns):
@@ -203,16 +368,8 @@ def _get_flight_id(report_fragment):
     return report_fragment.get("Grouping", {}).get("OptionId", None)
 
 
-def _handle_generate_daily_link_reports(link_ids, campaign_ids):
-    now = datetime.utcnow()
-    links = Link._byID(link_ids, data=True, return_dict=False)
-    campaigns = PromoCampaign._byID(campaign_ids, data=True, return_dict=False)
-
-    if not campaigns:
-        return
-
+def _get_link_report_range(links, campaigns, now):
     links_start, links_end = _get_campaigns_date_range(campaigns)
-    now = now.replace(tzinfo=pytz.utc)
     links_start = links_start.replace(tzinfo=pytz.utc)
     links_end = links_end.replace(tzinfo=pytz.utc)
 
@@ -233,10 +390,93 @@ def _handle_generate_daily_link_reports(link_ids, campaign_ids):
 
     end = min([now, links_end])
 
+    return start, end
+
+
+def _get_campaign_report_range(campaigns, now):
+    start = min(c.start_date for c in campaigns).replace(tzinfo=pytz.utc)
+    end = max(c.end_date for c in campaigns).replace(tzinfo=pytz.utc)
+
+    end = min([now, end])
+
+    return start, end
+
+
+def _split_link_reports(links, campaigns, now):
+    """Split links into reports that only cover each link's own range.
+
+    Links are reported from their own watermark (`last_daily_report_run`
+    less the 24hr preliminary window), so links starting on the same day
+    share a report and a link that is far behind gets one to itself.
+
+    Returns a list of (links, campaigns, start, end).
+
+    """
+
+    campaigns_by_link_id = defaultdict(list)
+    for campaign in campaigns:
+        campaigns_by_link_id[campaign.link_id].append(campaign)
+
+    reports_by_day = {}
+    for link in links:
+        link_campaigns = campaigns_by_link_id.get(link._id)
+        if not link_campaigns:
+            continue
+
+        start, end = _get_link_report_range([link], link_campaigns, now)
+        day = start.date()
+
+        if day in reports_by_day:
+            report_links, report_campaigns, report_start, report_end = \
+                reports_by_day[day]
+            start = min(start, report_start)
+            end = max(end, report_end)
+        else:
+            report_links, report_campaigns = [], []
+
+        report_links.append(link)
+        report_campaigns.extend(link_campaigns)
+        reports_by_day[day] = (report_links, report_campaigns, start, end)
+
+    return [reports_by_day[day] for day in sorted(reports_by_day)]
+
+
+def _handle_generate_daily_link_reports(link_ids, campaign_ids):
+    now = datetime.utcnow()
+    links = Link._byID(link_ids, data=True, return_dict=False)
+    campaigns = PromoCampaign._byID(campaign_ids, data=True, return_dict=False)
+
+    if not campaigns:
+        return
+
+    now = now.replace(tzinfo=pytz.utc)
+
+    # run every report before failing the message, the retry only has to
+    # catch up on the failed links since the others' watermarks moved
+    failed = []
+    for report_links, report_campaigns, start, end in _split_link_reports(
+            links, campaigns, now):
+        try:
+            _generate_daily_link_report(
+                report_links, report_campaigns, start, end)
+        except report.ReportFailedException as e:
+            g.log.error(e)
+            failed.extend(l._fullname for l in report_links)
+
+    if failed:
+        raise report.ReportFailedException(
+            "link reports failed (%s)" % ",".join(failed))
+
+
+def _generate_daily_link_report(links, campaigns, start, end):
     link_fullnames = ",".join([l._fullname for l in links])
     g.log.info("generating report for link %s (%s-%s)" % (
         link_fullnames, start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')))
 
+    # a message can be split into several reports, each one is timed (and
+    # times out) from when it was queued rather than from the first
+    report_start = time.time()
+    queued_date = datetime.utcnow().replace(tzinfo=pytz.utc)
     report_id = report.queue_report(
         start=start,
         end=end,
@@ -249,29 +489,27 @@ def _handle_generate_daily_link_reports(link_ids, campaign_ids):
     g.log.info("processing report for link (%s/%s)" %
         (link_fullnames, report_id))
 
-    try:
-        _process_daily_link_reports(
-            links=links,
-            report_id=report_id,
-            queued_date=now,
-        )
+    _process_daily_link_reports(
+        links=links,
+        report_id=report_id,
+        queued_date=queued_date,
+        report_window=(start, end),
+    )
 
-        g.log.info("successfully processed report for link (%s/%s)" %
-            (link_fullnames, report_id))
-    except report.ReportFailedException as e:
-        g.log.error(e)
-        # retry if report failed
-        _generate_link_reports(links)
+    g.log.info("successfully processed report for link (%s/%s)" %
+        (link_fullnames, report_id))
+    _record_report_cost(
+        "generate_daily_link_reports",
+        cost=_report_days(start, end) * len(campaigns),
+        seconds=time.time() - report_start,
+    )
 
 
 def _handle_generate_lifetime_campaign_reports(campaign_ids):
     now = datetime.utcnow()
     campaigns = PromoCampaign._byID(campaign_ids, data=True, return_dict=False)
-    start = min(c.start_date for c in campaigns).replace(tzinfo=pytz.utc)
-    end = max(c.end_date for c in campaigns).replace(tzinfo=pytz.utc)
     now = now.replace(tzinfo=pytz.utc)
-
-    end = min([now, end])
+    start, end = _get_campaign_report_range(campaigns, now)
 
     campaign_fullnames = ",".join(c._fullname for c in campaigns)
 
@@ -287,51 +525,71 @@ def _handle_generate_lifetime_campaign_reports(campaign_ids):
         } for c in campaigns],
     )
 
-    try:
-        _process_lifetime_campaign_reports(
-            campaigns=campaigns,
-            report_id=report_id,
-            queued_date=now,
-        )
+    _process_lifetime_campaign_reports(
+        campaigns=campaigns,
+        report_id=report_id,
+        queued_date=now,
+        report_window=(start, end),
+    )
 
-        g.log.info("successfully processed report for campaigns (%s/%s)" %
-            (campaign_fullnames, report_id))
-    except report.ReportFailedException as e:
-        g.log.error(e)
-        # retry if report failed
-        _generate_promo_reports(campaigns)
+    g.log.info("successfully processed report for campaigns (%s/%s)" %
+        (campaign_fullnames, report_id))
+    _record_report_cost(
+        "generate_lifetime_campaign_reports",
+        cost=_report_days(start, end) * len(campaigns),
+        seconds=time.time() - _to_timestamp(now),
+    )
 
 
-def _process_lifetime_campaign_reports(campaigns, report_id, queued_date):
+def _fetch_report(report_id, queued_date, kind, fullnames):
     """
-    Processes report for the lifetime of the campaigns.
+    Fetches a queued report.
 
     Exponentially backs off on retries, throws on timeout.
     """
 
     attempt = 1
-    campaign_fullnames = ",".join(c._fullname for c in campaigns)
 
     while True:
         try:
-            report_result = report.fetch_report(report_id)
-            break
+            return report.fetch_report(report_id)
         except report.ReportPendingException as e:
             timeout = (datetime.utcnow().replace(tzinfo=pytz.utc) -
                 timedelta(seconds=g.live_config.get("adzerk_reporting_timeout", 500)))
 
             if queued_date < timeout:
-                raise report.ReportFailedException("campign reports timed out (%s/%s)" %
-                    (campaign_fullnames, report_id))
+                raise report.ReportFailedException("%s reports timed out (%s/%s)" %
+                    (kind, fullnames, report_id))
             else:
                 sleep_time = math.pow(RETRY_SLEEP_SECONDS, attempt)
                 attempt = attempt + 1
 
-                g.log.warning("campaign reports still pending, retrying in %d seconds (%s/%s)" %
-                    (sleep_time, campaign_fullnames, report_id))
+                g.log.warning("%s reports still pending, retrying in %d seconds (%s/%s)" %
+                    (kind, sleep_time, fullnames, report_id))
 
                 time.sleep(sleep_time)
 
+
+def _process_lifetime_campaign_reports(campaigns, report_id, queued_date,
+                                       report_window=None):
+    """
+    Processes report for the lifetime of the campaigns.
+
+    Exponentially backs off on retries, throws on timeout. The report is
+    archived if `report_window` is passed.
+    """
+
+    campaign_fullnames = ",".join(c._fullname for c in campaigns)
+    report_result = _fetch_report(report_id, queued_date, "campaign",
+                                  campaign_fullnames)
+
+    if report_window:
+        _archive_report(report_id, report_result, report_window,
+            action="generate_lifetime_campaign_reports",
+            campaign_ids=[c._id for c in campaigns],
+            queued_date=queued_date.isoformat(),
+        )
+
     report_records = report_result.get("Records", None)
     campaigns_by_fullname = {c._fullname: c for c in campaigns}
 
@@ -362,15 +620,91 @@ def _process_lifetime_campaign_reports(campaigns, report_id, queued_date):
             campaign_values["clicks"] = campaign_values["clicks"] + clicks
             campaign_values["spent_pennies"] = campaign_values["spent_pennies"] + (spent * 100.)
 
-    for campaign, values in campaign_results.items():
-        campaign.adserver_spent_pennies = values["spent_pennies"]
-        campaign.adserver_impressions = values["impressions"]
-        campaign.adserver_clicks = values["clicks"]
+    _commit_lifetime_campaign_metrics(campaign_results, report_id, queued_date)
+
+
+def _commit_lifetime_campaign_metrics(campaign_results, report_id, queued_date):
+    """
+    Writes lifetime metrics for all campaigns in a report.
+
+    Campaigns whose metrics haven't changed since the last report aren't
+    committed at all, their report watermarks stay where they were. Returns
+    the number of commits skipped.
+    """
+
+    skipped = 0
+    for campaign, values in campaign_results.iteritems():
+        metrics = {
+            "adserver_spent_pennies": values["spent_pennies"],
+            "adserver_impressions": values["impressions"],
+            "adserver_clicks": values["clicks"],
+        }
+
+        if all(getattr(campaign, attr, None) == value
+               for attr, value in metrics.iteritems()):
+            skipped += 1
+            continue
+
+        for attr, value in metrics.iteritems():
+            setattr(campaign, attr, value)
         campaign.last_lifetime_report = report_id
         campaign.last_lifetime_report_run = queued_date
-
         campaign._commit()
 
+    committed = len(campaign_results) - skipped
+    g.stats.simple_event("adzerk.reporting.lifetime_commit.committed",
+                         delta=committed)
+    g.stats.simple_event("adzerk.reporting.lifetime_commit.skipped",
+                         delta=skipped)
+    g.log.info("committed %d campaigns, skipped %d with unchanged metrics "
+               "(%s)" % (committed, skipped, report_id))
+
+    return skipped
+
+
+def _archive_report(report_id, report_result, report_window, **metadata):
+    if not archive.get_archive_dir():
+        return
+
+    start, end = report_window
+    try:
+        archive.archive_report(report_id, report_result, start, end,
+            metadata=metadata)
+    except (IOError, OSError) as e:
+        # the archive is best effort, the report is still processed
+        g.log.warning("failed to archive report %s: %s" % (report_id, e))
+
+
+def replay_daily_link_reports(paths=None):
+    """
+    Reprocesses archived daily link reports without fetching them again.
+
+    Replays every archived daily link report if `paths` isn't passed, e.g.
+
+        paster run $REDDIT_INI -c 'from reddit_adzerk.adzerkreporting import replay_daily_link_reports; replay_daily_link_reports()'
+    """
+
+    if paths is None:
+        paths = archive.list_archives()
+
+    for path in paths:
+        report_result, archived = archive.load_report(path)
+        metadata = archived["metadata"]
+
+        if metadata.get("action") != "generate_daily_link_reports":
+            continue
+
+        links = Link._byID(metadata["link_ids"], data=True, return_dict=False)
+        g.log.info("replaying report for link (%s/%s)" %
+            (",".join(l._fullname for l in links), archived["report_id"]))
+
+        _process_daily_link_reports(
+            links=links,
+            report_id=archived["report_id"],
+            queued_date=parse_date(metadata["queued_date"]),
+            report_result=report_result,
+        )
+
 
 def _reporting_factory():
     return dict(
@@ -379,35 +713,29 @@ def _reporting_factory():
         spent_pennies=0,
     )
 
-def _process_daily_link_reports(links, report_id, queued_date):
+def _process_daily_link_reports(links, report_id, queued_date,
+                                report_window=None, report_result=None,
+                                update_watermarks=True):
     """
     Processes report grouped by day and flight.
 
-    Exponentially backs off on retries, throws on timeout.
+    Exponentially backs off on retries, throws on timeout. The report is
+    archived if `report_window` is passed, and isn't fetched if
+    `report_result` is passed. Rows for the whole report are written in
+    one transaction.
     """
 
-    link_fullnames = ",".join([l._fullname for l in links])
-    attempt = 1
-
-    while True:
-        try:
-            report_result = report.fetch_report(report_id)
-            break
-        except report.ReportPendingException as e:
-            timeout = (datetime.utcnow().replace(tzinfo=pytz.utc) -
-                timedelta(seconds=g.live_config.get("adzerk_reporting_timeout", 500)))
+    if report_result is None:
+        link_fullnames = ",".join([l._fullname for l in links])
+        report_result = _fetch_report(report_id, queued_date, "link",
+                                      link_fullnames)
 
-            if queued_date < timeout:
-                raise report.ReportFailedException("link reports timed out (%s/%s)" %
-                    (link_fullnames, report_id))
-            else:
-                sleep_time = math.pow(RETRY_SLEEP_SECONDS, attempt)
-                attempt = attempt + 1
-
-                g.log.warning("link reports still pending, retrying in %d seconds (%s/%s)" %
-                    (sleep_time, link_fullnames, report_id))
-
-                time.sleep(sleep_time)
+        if report_window:
+            _archive_report(report_id, report_result, report_window,
+                action="generate_daily_link_reports",
+                link_ids=[l._id for l in links],
+                queued_date=queued_date.isoformat(),
+            )
 
     g.log.debug(report_result)
 
@@ -469,6 +797,7 @@ def _process_daily_link_reports(links, report_id, queued_date):
                 codename=campaign._fullname,
                 date=date,
                 subreddit=subreddit,
+                commit=False,
                 **values
             )
 
@@ -476,38 +805,75 @@ def _process_daily_link_reports(links, report_id, queued_date):
             _insert_daily_link_reporting(
                 codename=link._fullname,
                 date=date,
+                commit=False,
                 **values
             )
 
-    link.last_daily_report = report_id
-    link.last_daily_report_run = queued_date
-    link._commit()
+    Session.commit()
+
+    if not update_watermarks:
+        return
+
+    # every link in the report has been processed up to `queued_date`, but
+    # don't move watermarks back when replaying archived reports.
+    for link in links:
+        last_run = getattr(link, "last_daily_report_run", None)
+        if last_run and last_run > queued_date:
+            continue
+
+        link.last_daily_report = report_id
+        link.last_daily_report_run = queued_date
+        link._commit()
 
 
 def process_report_q():
-    @g.stats.amqp_processor('adzerk_reporting_q')
-    def _processor(message):
-        data = json.loads(message.body)
+    def _process(data):
         action = data.get("action")
 
         if action == "generate_daily_link_reports":
-            _handle_generate_daily_link_reports(
+            handler = _handle_generate_daily_link_reports
+            kwargs = dict(
                 link_ids=data.get("link_ids"),
                 campaign_ids=data.get("campaign_ids"),
             )
+            ids = kwargs["link_ids"]
         elif action == "generate_lifetime_campaign_reports":
-            _handle_generate_lifetime_campaign_reports(
+            handler = _handle_generate_lifetime_campaign_reports
+            kwargs = dict(
                 campaign_ids=data.get("campaign_ids"),
             )
+            ids = kwargs["campaign_ids"]
         else:
             g.log.warning("adzerk_reporting_q: unknown action - \"%s\"" % action)
+            return
+
+        process_key = _claim_report("process", action, ids,
+                                    data.get("start"), data.get("end"))
+        if not process_key:
+            return
+
+        # messages queued before they carried their queue key only release
+        # the processing claim
+        dedup_keys = filter(None, [data.get("dedup_key"), process_key])
+
+        try:
+            handler(**kwargs)
+        finally:
+            # the claims only cover the report while it's in flight. if it
+            # failed `handle_with_retries` schedules the retry with a backoff
+            # or dead letters it
+            _release_report(dedup_keys)
+
+    @g.stats.amqp_processor('adzerk_reporting_q')
+    def _processor(message):
+        retry.handle_with_retries("adzerk_reporting_q", message, _process)
 
     amqp.consume_items("adzerk_reporting_q", _processor, verbose=False)
 
 
 def _insert_daily_link_reporting(
         codename, date, impressions,
-        clicks, spent_pennies):
+        clicks, spent_pennies, commit=True):
 
     date = date.replace(
         hour=0,
@@ -543,12 +909,14 @@ def _insert_daily_link_reporting(
     Session.merge(clicks_row)
     Session.merge(impressions_row)
     Session.merge(spent_row)
-    Session.commit()
+
+    if commit:
+        Session.commit()
 
 
 def _insert_daily_campaign_reporting(
         codename, date, impressions,
-        clicks, spent_pennies, subreddit=None):
+        clicks, spent_pennies, subreddit=None, commit=True):
 
     date = date.replace(
         hour=0,
@@ -587,4 +955,7 @@ def _insert_daily_campaign_reporting(
     Session.merge(clicks_row)
     Session.merge(impressions_row)
     Session.merge(spent_row)
-    Session.commit()
+
+    if commit:
+        Session.commit()
+
@@ -0,0 +1,232 @@
+"""
+Backfill daily link traffic for a date range.
+
+`queue_promo_reports` only reports on promos served yesterday and today.
+This regenerates traffic for any date range, for a selection of links
+and/or campaigns (a campaign selects its whole link, since link reports
+cover all of a link's flights):
+
+    paster run $REDDIT_INI -c 'from reddit_adzerk.backfill import backfill_link_reports; backfill_link_reports("2016-01-01", "2016-02-01", link_ids=[1234], checkpoint_path="/tmp/backfill.json")'
+
+Links are packed into cost balanced reports with the same estimates the
+reporting queue uses, and up to `concurrency` reports are generated and
+polled at a time. Rows are written on the calling thread, one transaction
+per report, and link watermarks are left alone. Links are added to the
+checkpoint file as their reports are written, so running again with the
+same checkpoint and date range resumes where a previous run stopped. A
+checkpoint from a different date range isn't resumed.
+"""
+
+import json
+import os
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+
+import pytz
+from dateutil.parser import parse as parse_date
+from pylons import app_globals as g
+
+from r2.models import (
+    Link,
+    PromoCampaign,
+)
+
+from reddit_adzerk import (
+    adzerkreporting,
+    report,
+)
+
+BACKFILL_CONCURRENCY = 4
+
+
+def _to_utc(date):
+    if isinstance(date, basestring):
+        date = parse_date(date)
+
+    if date.tzinfo is None:
+        return date.replace(tzinfo=pytz.utc)
+    return date.astimezone(pytz.utc)
+
+
+def load_checkpoint(path, start, end):
+    """Return the ids of links already backfilled between `start` and `end`.
+
+    Raises ValueError if the checkpoint was saved for another date range.
+
+    """
+
+    if not path or not os.path.exists(path):
+        return set()
+
+    with open(path) as f:
+        checkpoint = json.load(f)
+
+    window = (checkpoint.get("start"), checkpoint.get("end"))
+    if window != (start.isoformat(), end.isoformat()):
+        raise ValueError("checkpoint %s is for %s-%s, not %s-%s" % (
+            path, window[0], window[1], start.isoformat(), end.isoformat()))
+
+    return set(checkpoint["completed_link_ids"])
+
+
+def save_checkpoint(path, start, end, completed_link_ids):
+    if not path:
+        return
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "completed_link_ids": sorted(completed_link_ids),
+        }, f)
+    os.rename(tmp_path, path)
+
+
+def _get_backfill_reports(link_ids, campaign_ids, start, end, completed):
+    """Return (links, campaigns, start, end) for each report to generate."""
+    link_ids = set(link_ids or [])
+    if campaign_ids:
+        campaigns = PromoCampaign._byID(campaign_ids, data=True,
+                                        return_dict=False)
+        link_ids.update(c.link_id for c in campaigns)
+
+    link_ids -= completed
+    if not link_ids:
+        return []
+
+    campaigns_by_link_id = {}
+    for campaign in PromoCampaign._query(
+            PromoCampaign.c.link_id.in_(list(link_ids)), data=True):
+        campaigns_by_link_id.setdefault(campaign.link_id, []).append(campaign)
+
+    links = Link._byID(list(link_ids), data=True, return_dict=False)
+
+    sized_links = []
+    for link in sorted(links, key=lambda l: l._id):
+        link_campaigns = campaigns_by_link_id.get(link._id)
+        if not link_campaigns:
+            continue
+
+        links_start, links_end = adzerkreporting._get_campaigns_date_range(
+            link_campaigns)
+        link_start = max(start, links_start.replace(tzinfo=pytz.utc))
+        link_end = min(end, links_end.replace(tzinfo=pytz.utc))
+
+        if link_start >= link_end:
+            continue
+
+        sized_links.append(((link, link_campaigns, link_start, link_end),
+                            link_start, link_end, len(link_campaigns)))
+
+    groups = adzerkreporting._pack_by_cost(
+        sized_links,
+        target_cost=adzerkreporting._get_target_cost(
+            "generate_daily_link_reports"),
+        max_size=g.live_config.get("adzerk_reporting_link_group_size", 50),
+    )
+
+    reports = []
+    for group in groups:
+        reports.append((
+            [link for link, _, _, _ in group],
+            [campaign for _, link_campaigns, _, _ in group
+             for campaign in link_campaigns],
+            min(link_start for _, _, link_start, _ in group),
+            max(link_end for _, _, _, link_end in group),
+        ))
+
+    return reports
+
+
+def _generate_report(backfill_report):
+    """Queue a report and wait for it, run on the worker threads."""
+    links, campaigns, start, end = backfill_report
+    link_fullnames = ",".join(l._fullname for l in links)
+
+    try:
+        queued_date = datetime.utcnow().replace(tzinfo=pytz.utc)
+        report_id = report.queue_report(
+            start=start,
+            end=end,
+            groups=["optionId", "day"],
+            parameters=[{
+                "campaignId": l.external_campaign_id,
+            } for l in links],
+        )
+        report_result = adzerkreporting._fetch_report(
+            report_id, queued_date, "link", link_fullnames)
+    except Exception as e:
+        g.log.error("backfill report failed for link %s: %r" %
+            (link_fullnames, e))
+        return backfill_report, None, None, None
+
+    return backfill_report, report_id, queued_date, report_result
+
+
+def backfill_link_reports(start, end, link_ids=None, campaign_ids=None,
+                          concurrency=BACKFILL_CONCURRENCY,
+                          checkpoint_path=None):
+    """Regenerate daily link traffic between `start` and `end`.
+
+    Returns counts of reports and links written, and the ids of links
+    whose reports failed (these aren't checkpointed). Raises ValueError if
+    `checkpoint_path` is from a backfill of another date range.
+
+    """
+
+    start = _to_utc(start)
+    # the checkpoint keeps the requested range, `end` moves until it's past
+    requested_end = _to_utc(end)
+    end = min(requested_end, datetime.utcnow().replace(tzinfo=pytz.utc))
+    completed = load_checkpoint(checkpoint_path, start, requested_end)
+
+    reports = _get_backfill_reports(link_ids, campaign_ids, start, end,
+                                    completed)
+    g.log.info("backfilling %d reports (%s-%s), %d links already done" % (
+        len(reports), start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d'),
+        len(completed)))
+
+    written_reports = 0
+    written_links = 0
+    failed_link_ids = []
+
+    pool = ThreadPool(max(1, min(concurrency, len(reports))))
+    try:
+        results = pool.imap_unordered(_generate_report, reports)
+        for backfill_report, report_id, queued_date, report_result in results:
+            links, campaigns, report_start, report_end = backfill_report
+
+            if report_result is None:
+                failed_link_ids.extend(l._id for l in links)
+                continue
+
+            adzerkreporting._archive_report(
+                report_id, report_result, (report_start, report_end),
+                action="generate_daily_link_reports",
+                link_ids=[l._id for l in links],
+                queued_date=queued_date.isoformat(),
+            )
+            adzerkreporting._process_daily_link_reports(
+                links=links,
+                report_id=report_id,
+                queued_date=queued_date,
+                report_result=report_result,
+                update_watermarks=False,
+            )
+
+            completed.update(l._id for l in links)
+            save_checkpoint(checkpoint_path, start, requested_end, completed)
+            written_reports += 1
+            written_links += len(links)
+    finally:
+        pool.terminate()
+
+    g.log.info("backfilled %d links in %d reports, %d links failed" % (
+        written_links, written_reports, len(failed_link_ids)))
+
+    return {
+        "reports": written_reports,
+        "links": written_links,
+        "failed_link_ids": failed_link_ids,
+    }
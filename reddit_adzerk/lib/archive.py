@@ -0,0 +1,200 @@
+"""
+Archive of raw adzerk report results.
+
+Reports are stored column by column rather than as adzerk's list of record
+dicts: each key of the records, and of the details within them, becomes a
+column, and string columns are dictionary encoded. Reports are dominated by
+repeated dates, titles and ids so this compresses well with gzip. Keys
+with `None` values are read back as missing.
+
+Archives are written to `adzerk_report_archive_dir` (archiving is off if it
+isn't set) under a directory per date window, e.g.
+
+    <archive dir>/20160101-20160108/<report id>.json.gz
+
+"""
+
+import gzip
+import json
+import os
+
+from pylons import app_globals as g
+
+ARCHIVE_VERSION = 1
+
+
+def get_archive_dir():
+    return getattr(g, "adzerk_report_archive_dir", None)
+
+
+def _window_name(start, end):
+    return "%s-%s" % (start.strftime("%Y%m%d"), end.strftime("%Y%m%d"))
+
+
+def get_archive_path(report_id, start, end, archive_dir=None):
+    archive_dir = archive_dir or get_archive_dir()
+    return os.path.join(archive_dir, _window_name(start, end),
+                        "%s.json.gz" % report_id)
+
+
+def _flatten(row):
+    flat = {}
+    for key, value in row.iteritems():
+        if isinstance(value, dict):
+            for subkey, subvalue in value.iteritems():
+                flat["%s.%s" % (key, subkey)] = subvalue
+        else:
+            flat[key] = value
+    return flat
+
+
+def _unflatten(flat):
+    row = {}
+    for key, value in flat.iteritems():
+        if "." in key:
+            key, subkey = key.split(".", 1)
+            row.setdefault(key, {})[subkey] = value
+        else:
+            row[key] = value
+    return row
+
+
+def _encode_column(values):
+    if all(value is None or isinstance(value, basestring) for value in values):
+        codes_by_value = {}
+        codes = []
+        for value in values:
+            codes.append(codes_by_value.setdefault(value, len(codes_by_value)))
+        dictionary = sorted(codes_by_value, key=codes_by_value.get)
+        return {"dictionary": dictionary, "codes": codes}
+    return {"values": values}
+
+
+def _decode_column(column):
+    if "dictionary" in column:
+        dictionary = column["dictionary"]
+        return [dictionary[code] for code in column["codes"]]
+    return column["values"]
+
+
+def _to_columns(rows):
+    names = sorted(set(name for row in rows for name in row))
+    return {
+        name: _encode_column([row.get(name) for row in rows])
+        for name in names
+    }
+
+
+def _from_columns(columns, count):
+    decoded = {name: _decode_column(column)
+               for name, column in columns.iteritems()}
+    rows = []
+    for i in xrange(count):
+        rows.append(_unflatten({
+            name: values[i] for name, values in decoded.iteritems()
+            if values[i] is not None
+        }))
+    return rows
+
+
+def encode_report(report_result):
+    """Return the columnar form of a report result."""
+    records = []
+    details = []
+    detail_records = []
+
+    for i, record in enumerate(report_result.get("Records") or []):
+        record = dict(record)
+        for detail in record.pop("Details", None) or []:
+            details.append(_flatten(detail))
+            detail_records.append(i)
+        records.append(_flatten(record))
+
+    return {
+        "records": {
+            "count": len(records),
+            "columns": _to_columns(records),
+        },
+        "details": {
+            "count": len(details),
+            "record": detail_records,
+            "columns": _to_columns(details),
+        },
+    }
+
+
+def decode_report(encoded):
+    """Return the report result for the columnar form of a report."""
+    records = _from_columns(encoded["records"]["columns"],
+                            encoded["records"]["count"])
+    details = _from_columns(encoded["details"]["columns"],
+                            encoded["details"]["count"])
+
+    for record in records:
+        record["Details"] = []
+    for record_index, detail in zip(encoded["details"]["record"], details):
+        records[record_index]["Details"].append(detail)
+
+    return {"Records": records}
+
+
+def archive_report(report_id, report_result, start, end, metadata=None,
+                   archive_dir=None):
+    """Write a report result to the archive, returns the path written.
+
+    Returns `None` if archiving is off.
+
+    """
+
+    archive_dir = archive_dir or get_archive_dir()
+    if not archive_dir:
+        return None
+
+    path = get_archive_path(report_id, start, end, archive_dir=archive_dir)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    archived = {
+        "version": ARCHIVE_VERSION,
+        "report_id": report_id,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "metadata": metadata or {},
+        "report": encode_report(report_result),
+    }
+
+    # write then rename so readers never see a partial archive
+    tmp_path = path + ".tmp"
+    with gzip.open(tmp_path, "wb") as f:
+        json.dump(archived, f, separators=(",", ":"))
+    os.rename(tmp_path, path)
+
+    return path
+
+
+def load_report(path):
+    """Return (report result, archive metadata) for an archived report."""
+    with gzip.open(path, "rb") as f:
+        archived = json.load(f)
+
+    if archived.get("version") != ARCHIVE_VERSION:
+        raise ValueError("unknown report archive version %r (%s)" %
+            (archived.get("version"), path))
+
+    report_result = decode_report(archived.pop("report"))
+    return report_result, archived
+
+
+def list_archives(archive_dir=None):
+    """Return the paths of all archived reports, oldest window first."""
+    archive_dir = archive_dir or get_archive_dir()
+    paths = []
+    for window in sorted(os.listdir(archive_dir)):
+        window_dir = os.path.join(archive_dir, window)
+        if not os.path.isdir(window_dir):
+            continue
+        paths.extend(os.path.join(window_dir, name)
+                     for name in sorted(os.listdir(window_dir))
+                     if name.endswith(".json.gz"))
+    return paths
@@ -1,7 +1,11 @@
+import datetime
+
 from pylons import app_globals as g
 
 from r2.models import PromoCampaign
 
+from reddit_adzerk import adzerk_api
+
 
 class PromoCampaignByFlightIdCache():
     @classmethod
@@ -13,6 +17,12 @@ class PromoCampaignByFlightIdCache():
         key = cls._cache_key(campaign.external_flight_id)
         g.gencache.set(key, campaign._fullname, time=60*60*24, noreply=True)
 
+    @classmethod
+    def add_multi(cls, campaigns):
+        mapping = {cls._cache_key(campaign.external_flight_id):
+                   campaign._fullname for campaign in campaigns}
+        g.gencache.set_multi(mapping, time=60*60*24)
+
     @classmethod
     def get(cls, flight_id):
         fullname = g.gencache.get(cls._cache_key(flight_id), stale=True)
@@ -33,3 +43,77 @@ class PromoCampaignByFlightIdCache():
                 return None
         else:
             return fullname
+
+
+class LocationReportPartialCache():
+    """Daily location inventory partials by (keyword, location scope, day).
+
+    Each partial is a `ColumnarReport` of the day grouped by location code
+    (`None` for the unscoped total). Adzerk can still correct a day's numbers
+    for `CORRECTION_DAYS`, so the inventory window ends that many days ago.
+    Partials up to then are final, later ones are only kept briefly.
+
+    """
+
+    CORRECTION_DAYS = 2
+    FINAL_TTL = 60*60*24*21
+    RECENT_TTL = 60*60
+
+    @classmethod
+    def _cache_key(cls, keyword, scope, date):
+        return "azloccol:%s:%s:%s" % (keyword, scope or "base",
+                                      date.isoformat())
+
+    @classmethod
+    def get_multi(cls, keyword, scope, dates):
+        keys = {cls._cache_key(keyword, scope, date): date for date in dates}
+        cached = g.gencache.get_multi(keys.keys(), stale=True)
+        return {keys[key]: partial for key, partial in cached.iteritems()}
+
+    @classmethod
+    def set_multi(cls, keyword, scope, partials, today=None):
+        today = today or datetime.datetime.now(g.tz).date()
+        last_final = today - datetime.timedelta(days=cls.CORRECTION_DAYS)
+
+        final = {}
+        recent = {}
+        for date, partial in partials.iteritems():
+            key = cls._cache_key(keyword, scope, date)
+            if date <= last_final:
+                final[key] = partial
+            else:
+                recent[key] = partial
+
+        if final:
+            g.gencache.set_multi(final, time=cls.FINAL_TTL)
+        if recent:
+            g.gencache.set_multi(recent, time=cls.RECENT_TTL)
+
+
+class AdvertiserCache():
+    """Full adzerk advertisers by id.
+
+    Syncs only need an advertiser's `Id`, which is stored on the account, so
+    this is only for callers that need the rest of the advertiser.
+
+    """
+
+    @classmethod
+    def _cache_key(cls, advertiser_id):
+        return "azadvertiser:%s" % advertiser_id
+
+    @classmethod
+    def get(cls, advertiser_id):
+        key = cls._cache_key(advertiser_id)
+        item = g.gencache.get(key, stale=True)
+
+        if not item:
+            az_advertiser = adzerk_api.Advertiser.get(advertiser_id)
+            item = az_advertiser._to_item()
+            g.gencache.set(key, item, time=60*60)
+
+        return adzerk_api.Advertiser._from_item(dict(item))
+
+    @classmethod
+    def delete(cls, advertiser_id):
+        g.gencache.delete(cls._cache_key(advertiser_id))
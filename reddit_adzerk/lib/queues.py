@@ -0,0 +1,53 @@
+"""
+Enqueue timestamps for adzerk_q and adzerk_reporting_q messages.
+
+Messages are stamped with the time they're queued. When a consumer picks
+one up it records how long the message waited as
+`adzerk.queue_lag.<queue>.<action>`, and once the handler succeeds, how
+long it took from being queued to being handled, retries included, as
+`adzerk.queue_handled.<queue>.<action>`. For the sync queues this is the
+time from an edit to adzerk accepting it.
+
+Retried messages are also stamped when they're put back on their queue,
+so their lag doesn't include the retry delay.
+
+"""
+
+import json
+import time
+
+from pylons import app_globals as g
+
+from r2.lib import amqp
+
+
+def add_item(queue, data):
+    """Queue `data` as json, stamped with the time it was queued."""
+    data = dict(data, enqueued_at=time.time())
+    amqp.add_item(queue, json.dumps(data))
+
+
+def _record_since(stat, queue, data, since):
+    # messages queued before they were stamped
+    if since is None:
+        return
+
+    action = data.get("action") or "unknown"
+    # clocks on the queuing and consuming hosts can disagree a little
+    ms = max(0, (time.time() - since) * 1000)
+    g.stats.simple_timing("adzerk.%s.%s.%s" % (stat, queue, action), ms)
+
+
+def requeue_item(queue, data):
+    """Put a retried message back on `queue`, stamped with the time."""
+    data = dict(data, requeued_at=time.time())
+    amqp.add_item(queue, json.dumps(data))
+
+
+def record_lag(queue, data):
+    since = data.get("requeued_at", data.get("enqueued_at"))
+    _record_since("queue_lag", queue, data, since)
+
+
+def record_handled(queue, data):
+    _record_since("queue_handled", queue, data, data.get("enqueued_at"))
@@ -0,0 +1,125 @@
+"""
+Shared rate limits for adzerk API calls.
+
+The adzerk_q and adzerk_reporting_q consumers and the cron jobs all use the
+same API key, so the token buckets live in gencache where every process
+sees them. Each class of endpoint ("management" for the object API,
+"report" for queued and instant reports) gets a budget of calls per second
+from the `adzerk_api_rate_limits` live config. A bucket holds a budget of
+tokens per one second window, taken with an atomic incr of the window's
+counter, and is refilled by moving on to the next window. Callers that
+find it empty sleep until then.
+
+`LocalCounters` stands in for gencache in tests and single process scripts.
+
+"""
+
+import random
+import threading
+import time
+
+from pylons import app_globals as g
+
+DEFAULT_RATE_LIMITS = {
+    "management": 10,
+    "report": 2,
+}
+WINDOW_SECONDS = 1
+# spread out callers woken for the same window
+WAKE_JITTER_SECONDS = 0.1
+
+
+class LocalCounters(object):
+    """An in process stand-in for the gencache counters."""
+
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def add(self, key, value, time=0):
+        with self.lock:
+            if key in self.counts:
+                return False
+            self.counts[key] = value
+            return True
+
+    def incr(self, key, delta=1):
+        with self.lock:
+            if key not in self.counts:
+                return None
+            self.counts[key] += delta
+            return self.counts[key]
+
+
+class TokenBucket(object):
+    def __init__(self, name, rate, counters, window=WINDOW_SECONDS,
+                 clock=time.time, sleep=time.sleep):
+        self.name = name
+        self.rate = rate
+        self.counters = counters
+        self.window = window
+        self.clock = clock
+        self.sleep = sleep
+
+    def _key(self, window_start):
+        return "azrl:%s:%d" % (self.name, window_start)
+
+    def try_acquire(self):
+        """Take a token, returns 0 or the seconds until the next refill."""
+        now = self.clock()
+        window_start = int(now // self.window) * self.window
+        key = self._key(window_start)
+
+        self.counters.add(key, 0, time=self.window * 2 + 1)
+        count = self.counters.incr(key)
+
+        # if the counter is unavailable don't stop all adzerk calls
+        if count is None or count <= self.rate * self.window:
+            return 0
+        return window_start + self.window - now
+
+    def acquire(self):
+        """Take a token, waiting for one if needed. Returns seconds waited."""
+        waited = 0.
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return waited
+
+            wait += random.uniform(0, WAKE_JITTER_SECONDS)
+            self.sleep(wait)
+            waited += wait
+
+
+_local_counters = None
+
+
+def use_local_counters(counters=None):
+    """Keep the buckets in this process rather than in gencache."""
+    global _local_counters
+    _local_counters = counters or LocalCounters()
+    return _local_counters
+
+
+def get_rate_limit(endpoint_class):
+    limits = g.live_config.get("adzerk_api_rate_limits") or {}
+    return limits.get(endpoint_class, DEFAULT_RATE_LIMITS.get(endpoint_class))
+
+
+def acquire(endpoint_class):
+    """Wait for a token for a call to an `endpoint_class` endpoint."""
+    rate = get_rate_limit(endpoint_class)
+    if not rate or rate <= 0:
+        return 0
+
+    counters = _local_counters or g.gencache
+    bucket = TokenBucket(endpoint_class, rate, counters)
+
+    timer = g.stats.get_timer("adzerk.ratelimit.%s" % endpoint_class)
+    timer.start()
+    waited = bucket.acquire()
+    timer.stop()
+
+    if waited:
+        g.stats.simple_event("adzerk.ratelimit.%s.throttled" % endpoint_class)
+    return waited
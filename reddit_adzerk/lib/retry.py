@@ -0,0 +1,187 @@
+"""
+Delayed retries for the adzerk_q and adzerk_reporting_q consumers.
+
+Raising from a consumer makes amqp redeliver the message straight away, so
+a flight adzerk keeps rejecting, or an adzerk outage, turns into a hot loop.
+Consumers run their handlers with `handle_with_retries` instead, which
+acks the failed message and:
+
+* dead letters it if the error is permanent: a 4xx response (other than
+  timeouts and rate limits), a missing thing or a malformed message
+* otherwise puts it on `adzerk_retry_q` to be retried after an exponential
+  delay, and dead letters it after `adzerk_retry_max_attempts` attempts
+
+The `requeue_adzerk_retries` job moves retries that are due back to their
+queue every minute. Dead letters wait on `adzerk_dead_letter_q` until
+`requeue_dead_letters` is run.
+
+"""
+
+import json
+import time
+
+from pylons import app_globals as g
+
+from r2.lib import amqp
+from r2.lib.db.thing import NotFound
+
+from reddit_adzerk import adzerk_api
+from reddit_adzerk.lib import queues
+
+RETRY_Q = "adzerk_retry_q"
+DEAD_LETTER_Q = "adzerk_dead_letter_q"
+
+RETRY_BASE_SECONDS = 60
+RETRY_MAX_SECONDS = 60 * 60
+DEFAULT_MAX_ATTEMPTS = 8
+# adzerk client errors that are worth trying again
+TRANSIENT_STATUS_CODES = (408, 429)
+PERMANENT_ERRORS = (NotFound, KeyError, ValueError)
+
+
+def is_permanent_error(error):
+    """Return whether retrying can't fix `error`."""
+    if isinstance(error, adzerk_api.AdzerkError):
+        try:
+            status_code = int(error.status_code)
+        except (TypeError, ValueError):
+            return False
+
+        return (400 <= status_code < 500 and
+                status_code not in TRANSIENT_STATUS_CODES)
+
+    return isinstance(error, PERMANENT_ERRORS)
+
+
+def get_retry_delay(attempt):
+    """Return the seconds to wait before retrying after `attempt` failed."""
+    return min(RETRY_BASE_SECONDS * 2 ** (attempt - 1), RETRY_MAX_SECONDS)
+
+
+def get_max_attempts():
+    return (g.live_config.get("adzerk_retry_max_attempts") or
+            DEFAULT_MAX_ATTEMPTS)
+
+
+def dead_letter(queue, body, error, attempt):
+    amqp.add_item(DEAD_LETTER_Q, json.dumps({
+        "queue": queue,
+        "body": body,
+        "attempt": attempt,
+        "error": repr(error),
+        "failed_at": time.time(),
+    }))
+    g.stats.simple_event("adzerk.retry.%s.dead_lettered" % queue)
+
+
+def schedule_retry(queue, data, attempt):
+    delay = get_retry_delay(attempt)
+    data = dict(data, attempt=attempt + 1)
+
+    amqp.add_item(RETRY_Q, json.dumps({
+        "queue": queue,
+        "retry_at": time.time() + delay,
+        "body": json.dumps(data),
+    }))
+    g.stats.simple_event("adzerk.retry.%s.scheduled" % queue)
+    return delay
+
+
+def handle_with_retries(queue, message, handler):
+    """Call `handler` with a message's data, retrying later if it fails.
+
+    The attempt number is kept in the data as "attempt".
+
+    """
+
+    try:
+        data = json.loads(message.body)
+    except ValueError as e:
+        g.log.error("%s: malformed message %r" % (queue, message.body))
+        dead_letter(queue, message.body, e, attempt=1)
+        return
+
+    queues.record_lag(queue, data)
+
+    try:
+        handler(data)
+    except Exception as e:
+        attempt = data.get("attempt", 1)
+        g.log.exception("%s: attempt %d of %r failed" % (queue, attempt, data))
+
+        if is_permanent_error(e):
+            g.stats.simple_event("adzerk.retry.%s.permanent" % queue)
+            dead_letter(queue, message.body, e, attempt)
+        elif attempt >= get_max_attempts():
+            dead_letter(queue, message.body, e, attempt)
+        else:
+            delay = schedule_retry(queue, data, attempt)
+            g.log.warning("%s: retrying %r in %d seconds" %
+                (queue, data, delay))
+    else:
+        queues.record_handled(queue, data)
+
+
+def requeue_retries():
+    """Move retries that are due back to their queues."""
+    now = time.time()
+    counts = {"requeued": 0, "waiting": 0}
+
+    def _handle(items, chan):
+        for item in items:
+            retry = json.loads(item.body)
+            if retry["retry_at"] <= now:
+                queues.requeue_item(retry["queue"], json.loads(retry["body"]))
+                counts["requeued"] += 1
+            else:
+                amqp.add_item(RETRY_Q, item.body)
+                counts["waiting"] += 1
+
+        # make sure the messages are sent before the batch is acked
+        amqp.worker.join()
+
+    amqp.handle_items(RETRY_Q, _handle, limit=100, drain=True, verbose=False)
+
+    g.stats.simple_event("adzerk.retry.requeued", delta=counts["requeued"])
+    g.log.info("requeued %(requeued)d adzerk retries, %(waiting)d waiting" %
+        counts)
+    return counts
+
+
+def requeue_dead_letters(queue=None):
+    """Move dead letters back to their queue for a fresh set of attempts.
+
+    Only dead letters from `queue` are moved if it's passed.
+
+    """
+
+    counts = {"requeued": 0, "kept": 0}
+
+    def _handle(items, chan):
+        for item in items:
+            dead = json.loads(item.body)
+            if queue and dead["queue"] != queue:
+                amqp.add_item(DEAD_LETTER_Q, item.body)
+                counts["kept"] += 1
+                continue
+
+            try:
+                data = json.loads(dead["body"])
+            except ValueError:
+                # malformed messages can't be retried
+                amqp.add_item(DEAD_LETTER_Q, item.body)
+                counts["kept"] += 1
+                continue
+
+            data.pop("attempt", None)
+            queues.add_item(dead["queue"], data)
+            counts["requeued"] += 1
+
+        amqp.worker.join()
+
+    amqp.handle_items(DEAD_LETTER_Q, _handle, limit=100, drain=True,
+                      verbose=False)
+
+    g.log.info("requeued %(requeued)d adzerk dead letters, %(kept)d kept" %
+        counts)
+    return counts
@@ -3,6 +3,8 @@ import requests
 
 from pylons import app_globals as g
 
+from reddit_adzerk.lib import ratelimit
+
 
 COUNTRIES_URL = 'https://api.adzerk.net/v1/countries'
 HEADERS = {
@@ -20,6 +22,7 @@ def get_locations(exclude_regions_without_metros=True):
 
     """
 
+    ratelimit.acquire("management")
     response = requests.get(COUNTRIES_URL, headers=HEADERS)
 
     if not (200 <= response.status_code <= 299):
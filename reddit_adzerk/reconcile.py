@@ -0,0 +1,463 @@
+"""
+Reconcile adzerk's flights with reddit's campaigns.
+
+`deactivate_orphaned_flights` pages through the active adzerk flights,
+finds the ones that no longer belong to a `PromoCampaign` and deactivates
+them, so ad requests don't have to discover them while serving:
+
+    paster run $REDDIT_INI -c 'from reddit_adzerk.reconcile import deactivate_orphaned_flights; deactivate_orphaned_flights()'
+
+A flight is orphaned if no campaign has its id as `external_flight_id` and
+its adzerk campaign is one this plugin created for a link that isn't an
+external promo. Flights in the blank campaigns, or in adzerk campaigns that
+were set up outside of reddit, are left alone.
+
+`reconcile_flights` checks that the active flights, and the flights of
+today's scheduled campaigns, look the way `update_flight` would make them:
+
+    paster run $REDDIT_INI -c 'from reddit_adzerk.reconcile import reconcile_flights; reconcile_flights(dry_run=True)'
+
+Desired payloads are built page by page on the calling process and diffed
+against adzerk's flights by a pool of worker processes. Only drifted
+flights are synced again, through the rate limited adzerk api, and the
+drift is counted per field. Fields that adzerk's listing leaves out aren't
+compared.
+
+"""
+
+import itertools
+import re
+from multiprocessing import Pool
+
+from pylons import app_globals as g
+
+from r2.lib import promote
+from r2.models import (
+    Link,
+    PromoCampaign,
+)
+from r2admin.lib.irc import (
+    CHANNEL_TYPES,
+    queue_alert_report,
+)
+
+from reddit_adzerk import (
+    adzerk_api,
+    adzerkpromote,
+)
+from reddit_adzerk.lib.cache import PromoCampaignByFlightIdCache
+
+QUERY_CHUNK_SIZE = 500
+DEACTIVATE_BATCH_SIZE = 50
+# stop rather than deactivate most of the inventory if the campaign lookups
+# come back wrong
+MAX_ORPHANED_RATIO = 0.2
+MIN_ORPHANED_TO_CHECK = 10
+DRIFT_WORKERS = 4
+DRIFT_CHUNK_SIZE = 50
+# bound how much a run can change
+MAX_DRIFT_UPDATES = 500
+ADZERK_DATE_RE = re.compile(r"/Date\((-?[0-9]+)")
+
+
+def _chunks(items, size):
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+
+def get_campaigns_by_flight_id(flight_ids):
+    """Return the campaigns with `external_flight_id` in `flight_ids`."""
+    campaigns_by_flight_id = {}
+    for chunk in _chunks(list(flight_ids), QUERY_CHUNK_SIZE):
+        q = PromoCampaign._query(
+            PromoCampaign.c.external_flight_id.in_(chunk),
+            data=True,
+        )
+        for campaign in q:
+            campaigns_by_flight_id[campaign.external_flight_id] = campaign
+    return campaigns_by_flight_id
+
+
+def _get_links_by_campaign_id(az_campaign_ids):
+    """Return the links whose `external_campaign_id` is in `az_campaign_ids`.
+
+    These are the adzerk campaigns this plugin created.
+
+    """
+
+    links_by_campaign_id = {}
+    for chunk in _chunks(list(az_campaign_ids), QUERY_CHUNK_SIZE):
+        q = Link._query(Link.c.external_campaign_id.in_(chunk), data=True)
+        for link in q:
+            links_by_campaign_id[link.external_campaign_id] = link
+    return links_by_campaign_id
+
+
+def find_orphaned_flights(az_flights):
+    """Return the flights in `az_flights` that have no campaign.
+
+    Only flights in adzerk campaigns created for links that aren't external
+    promos can be orphaned.
+
+    """
+
+    campaigns_by_flight_id = get_campaigns_by_flight_id(
+        az_flight.Id for az_flight in az_flights)
+
+    # the ad request path looks campaigns up by flight id
+    PromoCampaignByFlightIdCache.add_multi(campaigns_by_flight_id.values())
+
+    blank_campaign_ids = set(g.blank_campaign_ids)
+    candidates = [az_flight for az_flight in az_flights
+                  if az_flight.Id not in campaigns_by_flight_id and
+                  az_flight.CampaignId not in blank_campaign_ids]
+    if not candidates:
+        return []
+
+    links_by_campaign_id = _get_links_by_campaign_id(
+        set(az_flight.CampaignId for az_flight in candidates))
+    orphaned = []
+    for az_flight in candidates:
+        link = links_by_campaign_id.get(az_flight.CampaignId)
+        if link is not None and not promote.is_external(link):
+            orphaned.append(az_flight)
+    return orphaned
+
+
+def deactivate_orphaned_flights(dry_run=False):
+    """Deactivate active adzerk flights that have no campaign.
+
+    Returns the ids of the orphaned flights.
+
+    """
+
+    num_flights = 0
+    orphaned_ids = []
+    for az_flights in adzerk_api.Flight.iter_list(is_active=True):
+        num_flights += len(az_flights)
+        orphaned_ids.extend(az_flight.Id
+                            for az_flight in find_orphaned_flights(az_flights))
+
+    g.log.info("found %d orphaned flights of %d active flights" %
+        (len(orphaned_ids), num_flights))
+    g.stats.simple_event("adzerk.reconcile.orphaned_flights",
+                         delta=len(orphaned_ids))
+
+    if not orphaned_ids or dry_run:
+        return orphaned_ids
+
+    max_orphaned = max(MIN_ORPHANED_TO_CHECK, MAX_ORPHANED_RATIO * num_flights)
+    if len(orphaned_ids) > max_orphaned:
+        msg = ("Not deactivating %d of %d active adzerk flights, too many "
+               "look orphaned" % (len(orphaned_ids), num_flights))
+        g.log.error(msg)
+        queue_alert_report(
+            msg,
+            channel_name=adzerkpromote.ADS_ALERT_CHANNEL,
+            channel_method=CHANNEL_TYPES.SLACK,
+        )
+        return orphaned_ids
+
+    deactivated = []
+    for batch in _chunks(orphaned_ids, DEACTIVATE_BATCH_SIZE):
+        for flight_id in batch:
+            try:
+                adzerkpromote._deactivate_orphaned_flight(flight_id)
+            except adzerk_api.AdzerkError as e:
+                g.log.error("couldn't deactivate orphaned flight %d: %r" %
+                    (flight_id, e))
+            else:
+                deactivated.append(flight_id)
+
+        g.log.info("deactivated %d of %d orphaned flights" %
+            (len(deactivated), len(orphaned_ids)))
+
+    queue_alert_report(
+        "Deactivated %d orphaned adzerk flights: %s" % (
+            len(deactivated), ", ".join(str(i) for i in deactivated)),
+        channel_name=adzerkpromote.ADS_ALERT_CHANNEL,
+        channel_method=CHANNEL_TYPES.SLACK,
+    )
+
+    return orphaned_ids
+
+
+def _is_unset(value):
+    return value is None or value is False or value == "" or value == []
+
+
+def _values_match(desired, actual):
+    """Return whether adzerk's `actual` value is what we'd send."""
+    if isinstance(desired, dict):
+        return (isinstance(actual, dict) and
+                all(_values_match(value, actual.get(key))
+                    for key, value in desired.iteritems()))
+
+    if isinstance(desired, list):
+        return (isinstance(actual, list) and len(desired) == len(actual) and
+                all(_values_match(d, a) for d, a in zip(desired, actual)))
+
+    if _is_unset(desired) or _is_unset(actual):
+        return _is_unset(desired) and _is_unset(actual)
+
+    if isinstance(desired, float) or isinstance(actual, float):
+        try:
+            return abs(float(desired) - float(actual)) < 0.005
+        except (TypeError, ValueError):
+            return False
+
+    return desired == actual
+
+
+def _date_ms(value):
+    match = ADZERK_DATE_RE.match(value or "")
+    return int(match.group(1)) if match else value
+
+
+def _keyword_set(value):
+    return set(line for line in (value or "").split("\n") if line)
+
+
+def diff_flight(desired, actual):
+    """Return the fields where adzerk's flight differs from `desired`.
+
+    `desired` has the `data`, `site_targeting` and `location` of a
+    `FlightPayload` and `actual` the fields adzerk returned for the flight.
+    This runs on the worker processes so both are plain dicts.
+
+    """
+
+    drifted = []
+
+    for field, value in desired["data"].iteritems():
+        if field not in actual:
+            continue
+
+        if field == "Keywords":
+            matches = _keyword_set(value) == _keyword_set(actual[field])
+        elif field in ("StartDate", "EndDate"):
+            matches = _date_ms(value) == _date_ms(actual[field])
+        else:
+            matches = _values_match(value, actual[field])
+
+        if not matches:
+            drifted.append(field)
+
+    if "SiteZoneTargeting" in actual:
+        actual_targeting = [
+            {key: value for key, value in target.iteritems()
+             if key not in ("Id", "FlightId")}
+            for target in actual["SiteZoneTargeting"] or []
+        ]
+        if not _values_match(desired["site_targeting"] or [],
+                             actual_targeting):
+            drifted.append("SiteZoneTargeting")
+
+    if "GeoTargeting" in actual:
+        location = desired["location"]
+        if location:
+            country, region, metro = location
+            expected = [{
+                "CountryCode": country,
+                "Region": region,
+                "MetroCode": metro,
+                "IsExclude": False,
+            }]
+        else:
+            expected = []
+
+        if not _values_match(expected, actual["GeoTargeting"] or []):
+            drifted.append("GeoTargeting")
+
+    return drifted
+
+
+def _diff_task(task):
+    flight_id, desired, actual = task
+    return flight_id, diff_flight(desired, actual)
+
+
+def _flight_fields(az_flight):
+    return {
+        field: getattr(az_flight, field)
+        for field in az_flight._fields
+        if field != "CreativeMaps" and hasattr(az_flight, field)
+    }
+
+
+def _get_diff_tasks(az_flights, campaigns_by_flight_id, links_by_id):
+    tasks = []
+    with adzerkpromote.billable_impressions_batch(
+            campaigns_by_flight_id.itervalues()):
+        for az_flight in az_flights:
+            campaign = campaigns_by_flight_id[az_flight.Id]
+            link = links_by_id[campaign.link_id]
+            payload = adzerkpromote.get_flight_payload(link, campaign)
+            desired = {
+                "data": payload.data,
+                "site_targeting": payload.site_targeting,
+                "location": payload.location,
+            }
+            tasks.append((az_flight.Id, desired, _flight_fields(az_flight)))
+    return tasks
+
+
+def _iter_active_flight_pages(seen):
+    """Yield (flights, campaigns by flight id, links by id) for each page.
+
+    Orphaned flights are left out, and the ids of all flights are added to
+    `seen`.
+
+    """
+
+    for az_flights in adzerk_api.Flight.iter_list(is_active=True):
+        seen.update(az_flight.Id for az_flight in az_flights)
+        campaigns_by_flight_id = get_campaigns_by_flight_id(
+            az_flight.Id for az_flight in az_flights)
+        if not campaigns_by_flight_id:
+            continue
+
+        links_by_id = Link._byID(
+            list(set(c.link_id for c in campaigns_by_flight_id.itervalues())),
+            data=True, return_dict=True)
+        az_flights = [az_flight for az_flight in az_flights
+                      if az_flight.Id in campaigns_by_flight_id]
+        yield az_flights, campaigns_by_flight_id, links_by_id
+
+
+def _iter_scheduled_flight_pages(seen, missing):
+    """Yield pages for the scheduled campaigns missing from the listing.
+
+    These are campaigns whose flights adzerk has inactive, so their pages
+    should be taken after the active ones. Campaigns that have no flight
+    are added to `missing` as (link, campaign).
+
+    """
+
+    inactive = []
+    for campaign, link in promote.get_scheduled_promos(offset=0):
+        if promote.is_external(link):
+            continue
+
+        flight_id = getattr(campaign, "external_flight_id", None)
+        if flight_id is None:
+            missing.append((link, campaign))
+        elif flight_id not in seen:
+            az_flight = adzerk_api.Flight.get(flight_id)
+            if az_flight:
+                inactive.append((az_flight, campaign, link))
+
+    for page in _chunks(inactive, adzerk_api.LIST_PAGE_SIZE):
+        yield (
+            [az_flight for az_flight, _, _ in page],
+            {az_flight.Id: campaign for az_flight, campaign, _ in page},
+            {link._id: link for _, _, link in page},
+        )
+
+
+def _sync_flight(link, campaign):
+    if getattr(campaign, "external_flight_id", None) is None:
+        adzerkpromote._update_adzerk(link, campaign, triggered_by=None)
+        return
+
+    with g.make_lock("adzerk_update", "adzerk-" + link._fullname):
+        adzerkpromote.update_flight(link, campaign, force=True)
+
+
+def reconcile_flights(workers=DRIFT_WORKERS, dry_run=False,
+                      max_updates=MAX_DRIFT_UPDATES):
+    """Find flights that have drifted from their campaigns and sync them.
+
+    Returns a report with the number of flights checked, drift counts per
+    field, and the campaigns that were synced or failed to sync. At most
+    `max_updates` flights are synced.
+
+    """
+
+    report = {
+        "flights": 0,
+        "missing": 0,
+        "drifted": 0,
+        "fields": {},
+        "synced": [],
+        "failed": [],
+    }
+    to_sync = []
+
+    seen = set()
+    missing = []
+    pages = itertools.chain(
+        _iter_active_flight_pages(seen),
+        _iter_scheduled_flight_pages(seen, missing),
+    )
+
+    pool = Pool(workers) if workers > 1 else None
+    pending = []
+    try:
+        for az_flights, campaigns_by_flight_id, links_by_id in pages:
+            tasks = _get_diff_tasks(az_flights, campaigns_by_flight_id,
+                                    links_by_id)
+            report["flights"] += len(tasks)
+
+            # diff this page while the next one is fetched and built
+            if pool:
+                results = pool.map_async(_diff_task, tasks,
+                                         chunksize=DRIFT_CHUNK_SIZE)
+            else:
+                results = map(_diff_task, tasks)
+            pending.append((results, campaigns_by_flight_id, links_by_id))
+
+        for results, campaigns_by_flight_id, links_by_id in pending:
+            if pool:
+                results = results.get()
+
+            for flight_id, drifted in results:
+                if not drifted:
+                    continue
+
+                report["drifted"] += 1
+                for field in drifted:
+                    report["fields"][field] = report["fields"].get(field, 0) + 1
+
+                campaign = campaigns_by_flight_id[flight_id]
+                to_sync.append((links_by_id[campaign.link_id], campaign))
+                g.log.info("flight %s for %s drifted: %s" %
+                    (flight_id, campaign, ", ".join(sorted(drifted))))
+    finally:
+        if pool:
+            pool.terminate()
+
+    # campaigns that never got a flight
+    report["missing"] = len(missing)
+    to_sync.extend(missing)
+
+    for field, count in report["fields"].iteritems():
+        g.stats.simple_event("adzerk.reconcile.drift.%s" % field, delta=count)
+    g.stats.simple_event("adzerk.reconcile.drifted", delta=report["drifted"])
+
+    g.log.info("%(drifted)d of %(flights)d flights drifted, "
+               "%(missing)d campaigns have no flight" % report)
+    for field, count in sorted(report["fields"].iteritems()):
+        g.log.info("    %s: %d" % (field, count))
+
+    if dry_run:
+        return report
+
+    if len(to_sync) > max_updates:
+        g.log.warning("syncing %d of %d drifted flights" %
+            (max_updates, len(to_sync)))
+
+        # let the campaigns' next syncs fix the rest
+        for link, campaign in to_sync[max_updates:]:
+            adzerkpromote._clear_flight_fingerprint(campaign)
+
+    for link, campaign in to_sync[:max_updates]:
+        try:
+            _sync_flight(link, campaign)
+        except Exception as e:
+            g.log.error("couldn't sync %s: %r" % (campaign, e))
+            report["failed"].append(campaign._fullname)
+        else:
+            report["synced"].append(campaign._fullname)
+
+    return report
@@ -1,7 +1,12 @@
+from array import array
 from collections import defaultdict, namedtuple
+from itertools import izip
+from multiprocessing.pool import ThreadPool
 import datetime
 import json
+import operator
 import requests
+import time
 
 from pylons import app_globals as g
 
@@ -12,6 +17,8 @@ from r2.models.promo_metrics import LocationPromoMetrics
 from r2.models.subreddit import Frontpage
 
 from reddit_adzerk import adzerk_api
+from reddit_adzerk.lib import ratelimit
+from reddit_adzerk.lib.cache import LocationReportPartialCache
 
 # https://github.com/adzerk/adzerk-api/wiki/Reporting-API
 
@@ -28,6 +35,11 @@ ReportTuple = namedtuple('ReportTuple', ['date', 'impressions', 'clicks'])
 AZ_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 FRONTPAGE_NAME = "-reddit.com"
 
+# location scopes included in the inventory, `None` is the unscoped total
+LOCATION_SCOPES = (None, 'countryCode', 'metroCode')
+LOCATION_REPORT_WORKERS = 3
+LOCATION_REPORT_TIMEOUT_SECONDS = 300
+
 
 class ReportPendingException(Exception):
     pass
@@ -82,6 +94,7 @@ def queue_report(start, end, groups=None, parameters=None):
     }
 
     criteria = "criteria=%s" % json.dumps(data)
+    ratelimit.acquire("report")
     response = requests.post(adzerk_endpoint("report/queue"), headers=HEADERS, data=criteria)
     content = adzerk_api.handle_response(response)
 
@@ -91,6 +104,7 @@ def queue_report(start, end, groups=None, parameters=None):
 
 
 def fetch_report(report_id):
+    ratelimit.acquire("report")
     response = requests.get(adzerk_endpoint("report/queue/%s" % report_id), headers=HEADERS)
     report_data = adzerk_api.handle_response(response)
 
@@ -107,8 +121,107 @@ def fetch_report(report_id):
         return report_data["Result"]
 
 
-def get_report(start, end, date_grouping='day', additional_groups=None,
-               filters=None):
+class ColumnarReport(object):
+    """A report stored as parallel typed columns rather than tuples.
+
+    Group keys are dictionary encoded into `group_ids`, and dates are stored
+    as ordinals, so a report with thousands of rows is a handful of arrays.
+
+    """
+
+    def __init__(self):
+        self.groups = []
+        self._group_ids_by_key = {}
+        self.group_ids = array('l')
+        self.start_dates = array('l')
+        self.end_dates = array('l')
+        self.impressions = array('l')
+        self.clicks = array('l')
+
+    def __len__(self):
+        return len(self.group_ids)
+
+    def _group_id(self, group):
+        group_id = self._group_ids_by_key.get(group)
+        if group_id is None:
+            group_id = self._group_ids_by_key[group] = len(self.groups)
+            self.groups.append(group)
+        return group_id
+
+    def append(self, group, start, end, impressions, clicks):
+        group_id = self._group_id(group)
+        self.group_ids.append(group_id)
+        self.start_dates.append(start.toordinal())
+        self.end_dates.append(end.toordinal())
+        self.impressions.append(impressions)
+        self.clicks.append(clicks)
+
+    def _reduce(self, column, reducer):
+        values = [None] * len(self.groups)
+        for group_id, value in izip(self.group_ids, getattr(self, column)):
+            current = values[group_id]
+            values[group_id] = value if current is None else reducer(current, value)
+        return {self.groups[group_id]: value
+                for group_id, value in enumerate(values)}
+
+    def extend(self, other):
+        """Append all of the rows of `other`, a `ColumnarReport`."""
+        group_ids = [self._group_id(group) for group in other.groups]
+        self.group_ids.extend(group_ids[group_id]
+                              for group_id in other.group_ids)
+        self.start_dates.extend(other.start_dates)
+        self.end_dates.extend(other.end_dates)
+        self.impressions.extend(other.impressions)
+        self.clicks.extend(other.clicks)
+
+    def group_min(self, column='impressions'):
+        """Return a dict of group to the smallest value of `column`."""
+        return self._reduce(column, min)
+
+    def group_sum(self, column='impressions'):
+        """Return a dict of group to the total of `column`."""
+        return self._reduce(column, operator.add)
+
+    def map_groups(self, fn):
+        """Replace each group with `fn(group)`, merging groups that collide."""
+        groups = []
+        group_ids_by_key = {}
+        new_group_ids = array('l')
+        for group in self.groups:
+            group = fn(group)
+            group_id = group_ids_by_key.get(group)
+            if group_id is None:
+                group_id = group_ids_by_key[group] = len(groups)
+                groups.append(group)
+            new_group_ids.append(group_id)
+
+        if len(groups) != len(self.groups):
+            self.group_ids = array('l', (new_group_ids[group_id]
+                                         for group_id in self.group_ids))
+        self.groups = groups
+        self._group_ids_by_key = group_ids_by_key
+
+    def rows(self):
+        """Yield (group, start, end, impressions, clicks) for each row."""
+        fromordinal = datetime.date.fromordinal
+        for group_id, start, end, impressions, clicks in izip(
+                self.group_ids, self.start_dates, self.end_dates,
+                self.impressions, self.clicks):
+            yield (self.groups[group_id], fromordinal(start),
+                   fromordinal(end), impressions, clicks)
+
+    def to_items(self):
+        """Return a dict of group to a list of `ReportItem`s."""
+        report = defaultdict(list)
+        for group, start, end, impressions, clicks in self.rows():
+            report[group].append(ReportItem(start=start, end=end,
+                                            impressions=impressions,
+                                            clicks=clicks))
+        return report
+
+
+def get_columnar_report(start, end, date_grouping='day',
+                        additional_groups=None, filters=None, timeout=None):
     additional_groups = additional_groups or []
     groups = [date_grouping] + additional_groups
     filters = filters or []
@@ -122,14 +235,16 @@ def get_report(start, end, date_grouping='day', additional_groups=None,
 
     criteria = "criteria=%s" % json.dumps(data)
 
-    response = requests.post(adzerk_endpoint("report"), headers=HEADERS, data=criteria)
+    ratelimit.acquire("report")
+    response = requests.post(adzerk_endpoint("report"), headers=HEADERS,
+                             data=criteria, timeout=timeout)
 
     if not (200 <= response.status_code <= 299):
         raise ValueError('response %s' % response.status_code)
 
     az_report = json.loads(response.text)
     records_by_date = az_report['Records']
-    report = defaultdict(list) # branch by group then list by date
+    report = ColumnarReport()
 
     for records in records_by_date:
         start = az_to_date(records['FirstDate'])
@@ -138,15 +253,27 @@ def get_report(start, end, date_grouping='day', additional_groups=None,
         for by_group in records_by_group:
             group = tuple(case_insensitive_get(by_group['Grouping'], name)
                           for name in additional_groups)
-            impressions = by_group['Impressions']
-            clicks = by_group['Clicks']
-            item = ReportItem(start=start, end=end, impressions=impressions,
-                              clicks=clicks)
-            report[group].append(item)
+            report.append(group, start, end, by_group['Impressions'],
+                          by_group['Clicks'])
     return report
 
 
-def get_location_report(start, end, location_scope=None, keywords=None):
+def get_report(start, end, date_grouping='day', additional_groups=None,
+               filters=None, timeout=None):
+    report = get_columnar_report(start, end, date_grouping=date_grouping,
+                                 additional_groups=additional_groups,
+                                 filters=filters, timeout=timeout)
+    return report.to_items() # branch by group then list by date
+
+
+def get_location_columnar_report(start, end, location_scope=None,
+                                 keywords=None, timeout=None):
+    """Return a `ColumnarReport` grouped by (keyword[, location]).
+
+    Keywords in the groups have the frontpage name demangled.
+
+    """
+
     groups = ['keyword']
     if location_scope:
         groups.append(location_scope)
@@ -154,37 +281,166 @@ def get_location_report(start, end, location_scope=None, keywords=None):
     keywords = keywords or [Frontpage.name] # default to frontpage
     keywords = map(mangle_frontpage_name, keywords)
     filters = [{'keyword': keyword} for keyword in keywords]
-    basic_report = get_report(start, end, date_grouping='day',
-                              additional_groups=groups, filters=filters)
+    report = get_columnar_report(start, end, date_grouping='day',
+                                 additional_groups=groups, filters=filters,
+                                 timeout=timeout)
+
+    report.map_groups(
+        lambda group: (demangle_frontpage_name(group[0]),) + group[1:])
+    return report
+
+
+def get_location_report(start, end, location_scope=None, keywords=None,
+                        timeout=None):
+    columnar_report = get_location_columnar_report(
+        start, end, location_scope=location_scope, keywords=keywords,
+        timeout=timeout)
 
     # put the report into a nicer format
     report = defaultdict(dict)
-    for group, items in basic_report.iteritems():
-        keyword = demangle_frontpage_name(group[0])
-
-        # convert to list of ReportTuples
-        items = [ReportTuple(item.start, item.impressions, item.clicks)
-                 for item in items]
+    for group, start, end, impressions, clicks in columnar_report.rows():
+        keyword = group[0]
+        item = ReportTuple(start, impressions, clicks)
 
         if location_scope:
             location = group[1]
-            report[keyword][location] = items
+            report[keyword].setdefault(location, []).append(item)
         else:
-            report[keyword] = items
+            report.setdefault(keyword, []).append(item)
     return report
 
 
+def get_location_reports(start, end, keywords=None, scopes=LOCATION_SCOPES,
+                         workers=LOCATION_REPORT_WORKERS,
+                         timeout=LOCATION_REPORT_TIMEOUT_SECONDS):
+    """Fetch a location report for each scope concurrently.
+
+    Reports are fetched by a pool of at most `workers` threads and each one
+    must complete within `timeout` seconds. Returns a dict of scope to
+    `ColumnarReport`.
+
+    """
+
+    def fetch(scope):
+        scope_name = scope or "base"
+        timer = g.stats.get_timer("adzerk.location_report.%s" % scope_name)
+        timer.start()
+        report_start = time.time()
+        try:
+            return get_location_columnar_report(
+                start, end, location_scope=scope, keywords=keywords,
+                timeout=timeout)
+        finally:
+            timer.stop()
+            g.log.info("fetched %s location report in %.2fs" %
+                       (scope_name, time.time() - report_start))
+
+    pool = ThreadPool(max(1, min(workers, len(scopes))))
+    try:
+        results = [(scope, pool.apply_async(fetch, (scope,)))
+                   for scope in scopes]
+        # the requests themselves time out after `timeout`, give the
+        # pool a little longer so we see their errors rather than ours.
+        wait = timeout + 5 if timeout else None
+        return {scope: result.get(wait) for scope, result in results}
+    finally:
+        pool.terminate()
+
+
+def _daterange(start, end):
+    days = (end - start).days
+    return [start + datetime.timedelta(days=i) for i in xrange(days + 1)]
+
+
+def _location_report_partials(report, keyword, dates):
+    """Split a location `ColumnarReport` grouped by day into daily partials.
+
+    Each partial is a `ColumnarReport` of that day grouped by location,
+    `None` for the unscoped total.
+
+    """
+
+    partials = {date: ColumnarReport() for date in dates}
+    groups = report.groups
+    fromordinal = datetime.date.fromordinal
+
+    for group_id, date, impressions, clicks in izip(
+            report.group_ids, report.start_dates, report.impressions,
+            report.clicks):
+        group = groups[group_id]
+        if group[0] != keyword:
+            continue
+
+        location = group[1] if len(group) > 1 else None
+        date = fromordinal(date)
+        partial = partials.setdefault(date, ColumnarReport())
+        partial.append(location, date, date, impressions, clicks)
+    return partials
+
+
+def get_location_partials(start, end, keyword, scopes=LOCATION_SCOPES,
+                          today=None):
+    """Return a location report for every scope in the [start, end] window.
+
+    Daily partials are cached, so only days missing from the cache are
+    requested from adzerk (as a single report per scope). Returns a dict of
+    scope to a `ColumnarReport` grouped by location.
+
+    """
+
+    dates = _daterange(start, end)
+    cache_keyword = mangle_frontpage_name(keyword)
+    partials_by_scope = {}
+    missing_by_scope = {}
+
+    for scope in scopes:
+        partials = LocationReportPartialCache.get_multi(
+            cache_keyword, scope, dates)
+        partials_by_scope[scope] = partials
+        missing = [date for date in dates if date not in partials]
+        if missing:
+            missing_by_scope[scope] = missing
+
+    if missing_by_scope:
+        fetch_start = min(min(missing) for missing in missing_by_scope.values())
+        fetch_end = max(max(missing) for missing in missing_by_scope.values())
+        fetch_dates = _daterange(fetch_start, fetch_end)
+        g.log.info("fetching location partials for %s (%s-%s)" % (
+            keyword, fetch_start, fetch_end))
+
+        reports = get_location_reports(fetch_start, fetch_end,
+                                       keywords=[keyword],
+                                       scopes=missing_by_scope.keys())
+
+        for scope, report in reports.iteritems():
+            fetched = _location_report_partials(report, keyword, fetch_dates)
+            LocationReportPartialCache.set_multi(cache_keyword, scope, fetched,
+                                                 today=today)
+            partials_by_scope[scope].update(
+                (date, partial) for date, partial in fetched.iteritems()
+                if start <= date <= end)
+
+    reports_by_scope = {}
+    for scope, partials in partials_by_scope.iteritems():
+        report = reports_by_scope[scope] = ColumnarReport()
+        for date in dates:
+            if date in partials:
+                report.extend(partials[date])
+    return reports_by_scope
+
+
 def get_location_inventory():
-    now = datetime.datetime.now(g.tz)
-    end = (now - datetime.timedelta(days=2)).date()
+    today = datetime.datetime.now(g.tz).date()
+    # adzerk's numbers for these days are final, see
+    # `LocationReportPartialCache`
+    end = today - datetime.timedelta(
+        days=LocationReportPartialCache.CORRECTION_DAYS)
     start = end - datetime.timedelta(days=14)
 
-    keywords = [Frontpage.name]
-    base_report = get_location_report(start, end, keywords=keywords)
-    country_report = get_location_report(start, end, keywords=keywords,
-                                         location_scope='countryCode')
-    metro_report = get_location_report(start, end, keywords=keywords,
-                                       location_scope='metroCode')
+    reports = get_location_partials(start, end, Frontpage.name, today=today)
+    base_report = reports[None].group_min()
+    country_report = reports['countryCode'].group_min()
+    metro_report = reports['metroCode'].group_min()
 
     # construct metro to region mapping
     metro_to_region = {}
@@ -196,22 +452,20 @@ def get_location_inventory():
     ret = []
 
     location = Location(None)
-    impressions = min(t.impressions for t in base_report[Frontpage.name])
+    impressions = base_report[None]
     ret.append((location, Frontpage, impressions))
 
-    for country_code, report in country_report[Frontpage.name].iteritems():
+    for country_code, impressions in country_report.iteritems():
         if country_code == 'None':
             continue
 
         location = Location(country_code)
-        impressions = min(t.impressions for t in report)
         ret.append((location, Frontpage, impressions))
 
-    for metro_code, report in metro_report[Frontpage.name].iteritems():
+    for metro_code, impressions in metro_report.iteritems():
         metro_code = str(metro_code)
         region_code = metro_to_region[metro_code]
         location = Location('US', region=region_code, metro=metro_code)
-        impressions = min(t.impressions for t in report)
         ret.append((location, Frontpage, impressions))
 
     return ret
@@ -0,0 +1,276 @@
+"""
+Shared helpers for the adzerk benchmarks.
+
+Benchmarks need a configured reddit install and are run with paster, e.g.
+
+    paster run $REDDIT_INI -c 'from reddit_adzerk.tests.benchmarks.request_promo import main; main()'
+
+Each benchmark writes a JSON result file which `compare_results` can diff,
+and `compare_revisions` runs a benchmark against two git revisions of the
+plugin and prints the difference.
+
+"""
+
+import gc
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(sorted_samples, pct):
+    if not sorted_samples:
+        return None
+    index = int(round((pct / 100.) * (len(sorted_samples) - 1)))
+    return sorted_samples[index]
+
+
+def summarize(samples, wall_time=None):
+    """Summarize a list of latencies (in seconds)."""
+    samples = sorted(samples)
+    summary = {
+        "count": len(samples),
+        "mean_ms": (sum(samples) / len(samples) * 1000.) if samples else None,
+        "max_ms": samples[-1] * 1000. if samples else None,
+    }
+    for pct in PERCENTILES:
+        value = percentile(samples, pct)
+        summary["p%d_ms" % pct] = value * 1000. if value is not None else None
+
+    if wall_time:
+        summary["wall_time_s"] = wall_time
+        summary["throughput_rps"] = len(samples) / wall_time
+
+    return summary
+
+
+class Timings(object):
+    """Thread-safe named latency samples."""
+
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.samples.setdefault(name, []).append(seconds)
+
+    @contextmanager
+    def time(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def summary(self):
+        return {name: summarize(samples)
+                for name, samples in self.samples.iteritems()}
+
+
+def run_concurrently(fn, count, concurrency):
+    """Call `fn(i)` `count` times on `concurrency` threads.
+
+    Returns (latencies, errors, wall time).
+
+    """
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    counter = iter(xrange(count))
+
+    def worker():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+
+            start = time.time()
+            try:
+                fn(i)
+            except Exception as e:
+                with lock:
+                    errors.append(repr(e))
+            finally:
+                elapsed = time.time() - start
+                with lock:
+                    latencies.append(elapsed)
+
+    start = time.time()
+    threads = [threading.Thread(target=worker) for _ in xrange(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors, time.time() - start
+
+
+def measure_memory(fn, count):
+    """Return memory retained per call of `fn(i)`, run serially `count` times.
+
+    With tracemalloc (python 3, or the pytracemalloc backport) this reports
+    retained blocks and bytes plus the peak traced memory; otherwise it
+    falls back to the net number of gc tracked objects created, which
+    ignores strings and numbers. Python 2 has no allocation counter, so
+    short lived garbage is not counted by either.
+
+    """
+
+    if tracemalloc is not None:
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        for i in xrange(count):
+            fn(i)
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        stats = after.compare_to(before, "filename")
+        blocks = sum(max(stat.count_diff, 0) for stat in stats)
+        size = sum(max(stat.size_diff, 0) for stat in stats)
+        return {
+            "method": "tracemalloc",
+            "retained_blocks_per_call": blocks / float(count),
+            "retained_bytes_per_call": size / float(count),
+            "peak_bytes": peak,
+        }
+
+    gc.collect()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        for i in xrange(count):
+            fn(i)
+        after = len(gc.get_objects())
+    finally:
+        gc.enable()
+
+    return {
+        "method": "gc_objects",
+        "retained_objects_per_call": (after - before) / float(count),
+    }
+
+
+def write_results(path, results):
+    if not path:
+        print json.dumps(results, indent=2, sort_keys=True)
+        return
+
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def _flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.iteritems():
+        name = "%s.%s" % (prefix, key) if prefix else key
+        if isinstance(value, dict):
+            flat.update(_flatten(value, name))
+        elif isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare_results(base, head):
+    """Return (metric, base, head, change) rows for numeric results."""
+    base = _flatten(base)
+    head = _flatten(head)
+    rows = []
+    for name in sorted(set(base) & set(head)):
+        before, after = base[name], head[name]
+        change = (after - before) / float(before) if before else None
+        rows.append((name, before, after, change))
+    return rows
+
+
+def print_comparison(rows, base_name="base", head_name="head"):
+    print "%-60s %14s %14s %9s" % ("metric", base_name[:14], head_name[:14],
+                                   "change")
+    for name, before, after, change in rows:
+        change_str = "%+8.1f%%" % (change * 100) if change is not None else ""
+        print "%-60s %14.3f %14.3f %9s" % (name, before, after, change_str)
+
+
+def compare_revisions(module, base_rev, head_rev, ini, args=()):
+    """Run benchmark `module` against two git revisions and print the diff.
+
+    Each revision is checked out into a temporary git worktree which is put
+    at the front of PYTHONPATH for a `paster run` of the benchmark's `main`.
+
+    """
+
+    repo = subprocess.check_output(
+        ["git", "rev-parse", "--show-toplevel"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    ).strip()
+
+    results = []
+    for rev in (base_rev, head_rev):
+        worktree = tempfile.mkdtemp(prefix="adzerk-bench-")
+        output = os.path.join(worktree, "results.json")
+        subprocess.check_call(
+            ["git", "worktree", "add", "--detach", worktree, rev], cwd=repo)
+        try:
+            argv = list(args) + ["--output", output]
+            code = ("from reddit_adzerk.tests.benchmarks.%s import main; "
+                    "main(%r)" % (module, argv))
+            env = dict(os.environ)
+            env["PYTHONPATH"] = os.pathsep.join(
+                filter(None, [worktree, env.get("PYTHONPATH")]))
+            subprocess.check_call(["paster", "run", ini, "-c", code], env=env)
+            with open(output) as f:
+                results.append(json.load(f))
+        finally:
+            subprocess.call(
+                ["git", "worktree", "remove", "--force", worktree], cwd=repo)
+            shutil.rmtree(worktree, ignore_errors=True)
+
+    rows = compare_results(*results)
+    print_comparison(rows, base_rev, head_rev)
+    return rows
+
+
+def compare_main(argv=None):
+    """Command line entry point for comparing a benchmark across revisions.
+
+    python -m reddit_adzerk.tests.benchmarks.harness request_promo \\
+        master HEAD $REDDIT_INI -- --requests 2000
+
+    """
+
+    import argparse
+
+    argv = sys.argv[1:] if argv is None else argv
+    if "--" in argv:
+        split = argv.index("--")
+        argv, bench_args = argv[:split], argv[split + 1:]
+    else:
+        bench_args = []
+
+    parser = argparse.ArgumentParser(description="compare benchmark results "
+                                                 "between two revisions")
+    parser.add_argument("module")
+    parser.add_argument("base")
+    parser.add_argument("head")
+    parser.add_argument("ini")
+    args = parser.parse_args(argv)
+    compare_revisions(args.module, args.base, args.head, args.ini, bench_args)
+
+
+if __name__ == "__main__":
+    compare_main()
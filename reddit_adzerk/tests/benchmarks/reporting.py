@@ -0,0 +1,288 @@
+"""
+Benchmark the reporting pipeline with large synthetic adzerk reports.
+
+Generates report JSON shaped like adzerk's queued report results, e.g. 500
+links with 2000 flights between them over 90 days, and runs it through
+`_process_daily_link_reports` and `_process_lifetime_campaign_reports`.
+Parse time (decoding the report JSON), aggregation time, DB write time and
+peak memory are reported separately.
+
+Rows are written with the real `AdserverImpressionsByCodename` family of
+models to a local database (an in-memory sqlite database by default) rather
+than the traffic database. Links and campaigns are in-memory stand-ins.
+
+    paster run $REDDIT_INI -c 'from reddit_adzerk.tests.benchmarks.reporting import main; main(["--days", "30"])'
+
+"""
+
+import argparse
+import datetime
+import json
+import random
+import resource
+import time
+
+import pytz
+from mock import patch
+from pylons import app_globals as g
+from sqlalchemy import create_engine
+
+from reddit_adzerk.tests.benchmarks.harness import (
+    Timings,
+    tracemalloc,
+    write_results,
+)
+from reddit_adzerk.tests.benchmarks.sync import (
+    FakeCampaign,
+    FakeLink,
+    FakeTarget,
+)
+
+
+def traffic_models():
+    from r2.models import traffic
+
+    return [
+        traffic.AdserverClickthroughsByCodename,
+        traffic.AdserverImpressionsByCodename,
+        traffic.AdserverSpentPenniesByCodename,
+        traffic.AdserverTargetedClickthroughsByCodename,
+        traffic.AdserverTargetedImpressionsByCodename,
+        traffic.AdserverTargetedSpentPenniesByCodename,
+    ]
+
+
+def make_promos(num_links, num_flights, first_id):
+    from r2.models import PromoCampaign
+
+    links = []
+    campaigns = []
+    for i in xrange(num_links):
+        links.append(FakeLink(first_id + i, external_campaign_id=first_id + i))
+
+    for i in xrange(num_flights):
+        link = links[i % num_links]
+        campaigns.append(FakeCampaign(
+            first_id + i,
+            link_id=link._id,
+            external_flight_id=first_id + i,
+            target=FakeTarget(["pics"]),
+            target_name="pics",
+            # report titles are checked against the real prefix
+            _fullname_prefix=PromoCampaign._fullname_prefix,
+        ))
+    return links, campaigns
+
+
+def _detail(campaign, rng):
+    impressions = rng.randint(0, 200000)
+    return {
+        "Title": campaign._fullname,
+        "Grouping": {
+            "OptionId": campaign.external_flight_id,
+            "CampaignId": campaign.link_id,
+        },
+        "Impressions": impressions,
+        "Clicks": rng.randint(0, impressions // 100),
+        "TrueRevenue": round(impressions * 0.001, 2),
+    }
+
+
+def generate_daily_report(campaigns, start, days, seed=None):
+    """Return report JSON grouped by day and flight."""
+    rng = random.Random(seed)
+    records = []
+    for i in xrange(days):
+        date = start + datetime.timedelta(days=i)
+        records.append({
+            "Date": date.strftime("%Y-%m-%dT00:00:00"),
+            "Details": [_detail(campaign, rng) for campaign in campaigns],
+        })
+    return json.dumps({"Records": records})
+
+
+def generate_lifetime_report(campaigns, seed=None):
+    """Return report JSON grouped by flight."""
+    rng = random.Random(seed)
+    return json.dumps({"Records": [{
+        "Details": [_detail(campaign, rng) for campaign in campaigns],
+    }]})
+
+
+def _max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class PeakMemory(object):
+    """Track peak memory with tracemalloc if available, else max RSS."""
+
+    def __enter__(self):
+        self.rss_before = _max_rss_kb()
+        if tracemalloc is not None:
+            tracemalloc.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if tracemalloc is not None:
+            _, self.peak_bytes = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        else:
+            self.peak_bytes = None
+        self.rss_growth_kb = _max_rss_kb() - self.rss_before
+
+    def result(self):
+        return {
+            "traced_peak_bytes": self.peak_bytes,
+            "max_rss_growth_kb": self.rss_growth_kb,
+        }
+
+
+def _timed(fn, timings, name):
+    def wrapper(*args, **kwargs):
+        with timings.time(name):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def bind_local_db(db_url):
+    """Bind the reporting session to `db_url`.
+
+    Returns a function binding it back to the traffic engine.
+
+    """
+
+    from reddit_adzerk import adzerkreporting
+
+    db_engine = create_engine(db_url)
+    for model in traffic_models():
+        model.__table__.create(bind=db_engine, checkfirst=True)
+
+    Session = adzerkreporting.Session
+    Session.remove()
+    Session.configure(bind=db_engine)
+
+    def restore():
+        Session.remove()
+        Session.configure(bind=adzerkreporting.engine)
+        db_engine.dispose()
+
+    return restore
+
+
+def run_daily(links, campaigns, args):
+    from reddit_adzerk import adzerkreporting, report
+
+    start = datetime.datetime(2016, 1, 1)
+    report_json = generate_daily_report(campaigns, start, args.days,
+                                        seed=args.seed)
+
+    parse_start = time.time()
+    report_result = json.loads(report_json)
+    parse_time = time.time() - parse_start
+
+    timings = Timings()
+    insert_link = _timed(adzerkreporting._insert_daily_link_reporting,
+                         timings, "link_rows")
+    insert_campaign = _timed(adzerkreporting._insert_daily_campaign_reporting,
+                             timings, "campaign_rows")
+    commit = _timed(adzerkreporting.Session.commit, timings, "commit")
+    queued_date = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+
+    with patch.object(report, "fetch_report", return_value=report_result), \
+            patch.object(adzerkreporting.PromoCampaign, "_query",
+                         return_value=campaigns), \
+            patch.object(adzerkreporting, "_insert_daily_link_reporting",
+                         insert_link), \
+            patch.object(adzerkreporting, "_insert_daily_campaign_reporting",
+                         insert_campaign), \
+            patch.object(adzerkreporting.Session, "commit", commit), \
+            PeakMemory() as memory:
+        process_start = time.time()
+        adzerkreporting._process_daily_link_reports(
+            links=links,
+            report_id="benchmark",
+            queued_date=queued_date,
+        )
+        process_time = time.time() - process_start
+
+    db_time = sum(sum(samples) for samples in timings.samples.values())
+    return {
+        "report_bytes": len(report_json),
+        "details": args.days * len(campaigns),
+        "parse_time_s": parse_time,
+        "aggregation_time_s": process_time - db_time,
+        "db_write_time_s": db_time,
+        "db_writes": timings.summary(),
+        "memory": memory.result(),
+    }
+
+
+def run_lifetime(campaigns, args):
+    from reddit_adzerk import adzerkreporting, report
+
+    report_json = generate_lifetime_report(campaigns, seed=args.seed)
+
+    parse_start = time.time()
+    report_result = json.loads(report_json)
+    parse_time = time.time() - parse_start
+
+    queued_date = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+    group_size = g.live_config.get("adzerk_reporting_campaign_group_size", 100)
+
+    with patch.object(report, "fetch_report", return_value=report_result), \
+            PeakMemory() as memory:
+        process_start = time.time()
+        # reports are generated for groups of campaigns
+        for i in xrange(0, len(campaigns), group_size):
+            adzerkreporting._process_lifetime_campaign_reports(
+                campaigns=campaigns[i:i + group_size],
+                report_id="benchmark",
+                queued_date=queued_date,
+            )
+        process_time = time.time() - process_start
+
+    return {
+        "report_bytes": len(report_json),
+        "details": len(campaigns),
+        "parse_time_s": parse_time,
+        "aggregation_time_s": process_time,
+        "commits": sum(c._commits for c in campaigns),
+        "memory": memory.result(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark report processing")
+    parser.add_argument("--links", type=int, default=500)
+    parser.add_argument("--flights", type=int, default=2000)
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--db-url", default="sqlite://")
+    parser.add_argument("--first-id", type=int, default=10 ** 9)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args(argv)
+
+    links, campaigns = make_promos(args.links, args.flights, args.first_id)
+    restore = bind_local_db(args.db_url)
+
+    try:
+        results = {
+            "daily_link_reports": run_daily(links, campaigns, args),
+            "lifetime_campaign_reports": run_lifetime(campaigns, args),
+        }
+    finally:
+        restore()
+
+    for name, result in sorted(results.iteritems()):
+        g.log.info("%s: parse %.2fs, aggregate %.2fs" % (
+            name, result["parse_time_s"], result["aggregation_time_s"]))
+
+    write_results(args.output, {
+        "benchmark": "reporting",
+        "links": args.links,
+        "flights": args.flights,
+        "days": args.days,
+        "db_url": args.db_url,
+        "results": results,
+    })
+    return results
@@ -0,0 +1,380 @@
+"""
+Benchmark the ad request hot path against the local adzerk emulator.
+
+Modes:
+
+    adzerk_request: call `adzerkpromote.adzerk_request` in process (default).
+    request_promo: POST to `/api/request_promo` on a running app whose
+        `adzerk_engine_domain` points at the emulator started by this
+        benchmark (`--emulator-port`).
+
+Scenarios vary the number of placements, platform and the share of blank
+and orphaned flights in the engine's decisions. Throughput, p50/p95/p99
+latency and memory retained per request are reported for each.
+
+In adzerk_request mode deactivations, alerts and ad events are patched
+out. The app in request_promo mode would act on the orphaned flights, so
+the orphaned scenario only runs in process.
+
+    paster run $REDDIT_INI -c 'from reddit_adzerk.tests.benchmarks.request_promo import main; main(["--requests", "2000"])'
+
+"""
+
+import argparse
+import base64
+import json
+import random
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+from mock import patch
+from pylons import app_globals as g
+
+from reddit_adzerk.lib.cache import PromoCampaignByFlightIdCache
+from reddit_adzerk.tests.emulator import (
+    AdzerkEmulator,
+    EVENT_TYPE_DOWNVOTE,
+    EVENT_TYPE_UPVOTE,
+    point_plugin_at,
+)
+from reddit_adzerk.tests.benchmarks.harness import (
+    measure_memory,
+    run_concurrently,
+    summarize,
+    write_results,
+)
+
+SCENARIOS = {
+    "baseline": dict(),
+    "multi_placement": dict(placements=3),
+    "mobile_web": dict(platform="mobile_web"),
+    "blank": dict(blank_rate=0.5),
+    "orphaned": dict(orphan_rate=0.1),
+}
+
+SCENARIO_DEFAULTS = dict(
+    placements=1,
+    platform="desktop",
+    blank_rate=0.,
+    orphan_rate=0.,
+)
+
+SYNTHETIC_FLIGHT_ID_BASE = 900000000
+ORPHANED_LINK_FULLNAME = "t3_zzzzzzzzzz"
+
+
+def _to36(n):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    s = ""
+    while True:
+        n, r = divmod(n, 36)
+        s = digits[r] + s
+        if not n:
+            return s
+
+
+def load_promos(count):
+    """Return (flight id, campaign fullname, link fullname) to serve.
+
+    Uses promos that are currently serving if there are any, otherwise
+    synthetic ones which are added to the flight id cache.
+
+    """
+
+    from r2.lib import promote
+
+    promos = [
+        (campaign.external_flight_id, campaign._fullname, link._fullname)
+        for campaign, link in promote.get_served_promos(offset=0)
+        if getattr(campaign, "external_flight_id", None)
+    ][:count]
+
+    if promos:
+        return promos
+
+    for i in xrange(count):
+        flight_id = SYNTHETIC_FLIGHT_ID_BASE + i
+        campaign_fullname = "t8_%s" % _to36(SYNTHETIC_FLIGHT_ID_BASE + i)
+        link_fullname = "t3_%s" % _to36(SYNTHETIC_FLIGHT_ID_BASE + i)
+        g.gencache.set(PromoCampaignByFlightIdCache._cache_key(flight_id),
+                       campaign_fullname, time=60*60)
+        promos.append((flight_id, campaign_fullname, link_fullname))
+    return promos
+
+
+class DecisionFactory(object):
+    """Builds engine decisions shaped like the real `/api/v2` responses."""
+
+    def __init__(self, promos, blank_rate=0., orphan_rate=0., seed=None):
+        self.promos = promos
+        self.blank_rate = blank_rate
+        self.orphan_rate = orphan_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.next_orphan = SYNTHETIC_FLIGHT_ID_BASE * 2
+
+    def __call__(self, state, placement, data):
+        with self.lock:
+            roll = self.random.random()
+            impression_id = "%032x" % self.random.getrandbits(128)
+
+            if roll < self.blank_rate and g.blank_campaign_ids:
+                kind = "blank"
+                campaign_id = self.random.choice(g.blank_campaign_ids)
+                flight_id = self.random.randint(1, 10000)
+                link_fullname = None
+            elif roll < self.blank_rate + self.orphan_rate:
+                kind = "orphaned"
+                campaign_id = self.random.randint(1, 10000)
+                self.next_orphan += 1
+                flight_id = self.next_orphan
+                link_fullname = ORPHANED_LINK_FULLNAME
+            else:
+                kind = "promo"
+                campaign_id = self.random.randint(1, 10000)
+                flight_id, _, link_fullname = self.random.choice(self.promos)
+
+        impression_data = base64.urlsafe_b64encode(json.dumps({
+            "di": impression_id,
+            "mk": ",".join(data.get("keywords") or []),
+        })).rstrip("=")
+        event_url = "https://engine.emulated/e.gif?f=%s&e=%%d" % flight_id
+        body = json.dumps({
+            "link": link_fullname,
+            "title": "",
+            "author": "",
+            "target": "",
+            "ecpm": "1.2345",
+            "priorityId": str(g.az_selfserve_priorities.values()[0]),
+            "adType": "4",
+        })
+
+        return {
+            "adId": self.random.randint(1, 10 ** 9),
+            "campaignId": campaign_id,
+            "creativeId": self.random.randint(1, 10 ** 6),
+            "flightId": flight_id,
+            "pricing": {"revenue": 0.0012, "rateType": 2},
+            "impressionUrl": "https://engine.emulated/i.gif?e=%s" % impression_data,
+            "clickUrl": "https://engine.emulated/r?f=%s&k=%s" % (flight_id, kind),
+            "events": [
+                {"id": EVENT_TYPE_UPVOTE, "url": event_url % EVENT_TYPE_UPVOTE},
+                {"id": EVENT_TYPE_DOWNVOTE,
+                 "url": event_url % EVENT_TYPE_DOWNVOTE},
+            ],
+            "contents": [{"type": "html", "body": body}],
+        }
+
+
+class _FakeRequest(object):
+    def __init__(self, ip, user_agent):
+        self.ip = ip
+        self.headers = {
+            "User-Agent": user_agent,
+            "referer": "https://www.reddit.com/",
+        }
+
+
+class _FakeContext(object):
+    def __init__(self):
+        from r2.models import Frontpage
+
+        self.site = Frontpage
+        self.default_sr = True
+        self.user = None
+        self.user_is_loggedin = False
+
+    def __getattr__(self, name):
+        return None
+
+
+_thread_context = threading.local()
+
+
+def _ensure_request_context():
+    # pylons' request/context are thread local, register fakes per thread
+    if getattr(_thread_context, "registered", False):
+        return
+
+    from pylons import request, tmpl_context
+
+    request._push_object(_FakeRequest("127.0.0.1", "adzerk-benchmark/1.0"))
+    tmpl_context._push_object(_FakeContext())
+    _thread_context.registered = True
+
+
+def _placement_names(scenario):
+    return ["div%d" % i for i in xrange(scenario["placements"])]
+
+
+def make_adzerk_request_fn(scenario, outcomes, outcomes_lock):
+    from reddit_adzerk.adzerkpromote import (
+        BlankCreativeResponse,
+        adzerk_request,
+    )
+
+    placement_names = _placement_names(scenario)
+
+    def request_ad(i):
+        _ensure_request_context()
+        response = adzerk_request(
+            keywords=["pics", "funny"],
+            properties={"age_hours": 10, "percentage": 50},
+            user_id="bench%d" % i,
+            placement_names=placement_names,
+            platform=scenario["platform"],
+            timeout=1,
+        )
+
+        if response is None:
+            outcome = "none"
+        elif isinstance(response, BlankCreativeResponse):
+            outcome = "blank"
+        else:
+            outcome = "promos_%d" % len(response)
+
+        with outcomes_lock:
+            outcomes[outcome] += 1
+
+    return request_ad
+
+
+def make_request_promo_fn(scenario, url, outcomes, outcomes_lock):
+    import requests
+
+    sessions = threading.local()
+    data = {
+        "srnames": "pics+funny",
+        "platform": scenario["platform"],
+        "placements": ",".join(_placement_names(scenario)),
+        "is_refresh": "false",
+    }
+
+    def request_promo(i):
+        session = getattr(sessions, "session", None)
+        if session is None:
+            session = sessions.session = requests.Session()
+
+        response = session.post(url, data=data)
+        with outcomes_lock:
+            outcomes["status_%d" % response.status_code] += 1
+            outcomes["empty" if not response.content else "body"] += 1
+
+    return request_promo
+
+
+def _noop(*args, **kwargs):
+    pass
+
+
+class _NullEventQueue(object):
+    def __getattr__(self, name):
+        return _noop
+
+
+@contextmanager
+def _patched_side_effects():
+    # no-ops rather than mocks, which would keep every call and show up
+    # as memory retained per request
+    from reddit_adzerk import adzerkpromote
+
+    with patch.object(adzerkpromote, "deactivate_orphaned_flight", _noop), \
+            patch.object(adzerkpromote, "queue_alert_report", _noop), \
+            patch.object(g, "ad_events", _NullEventQueue(), create=True):
+        yield
+
+
+def run_scenario(name, scenario, emulator, promos, args):
+    emulator.decision_factory = DecisionFactory(
+        promos,
+        blank_rate=scenario["blank_rate"],
+        orphan_rate=scenario["orphan_rate"],
+        seed=args.seed,
+    )
+
+    outcomes = Counter()
+    outcomes_lock = threading.Lock()
+    if args.mode == "adzerk_request":
+        fn = make_adzerk_request_fn(scenario, outcomes, outcomes_lock)
+    else:
+        fn = make_request_promo_fn(scenario, args.url, outcomes, outcomes_lock)
+
+    with _patched_side_effects():
+        # warm up connections and caches before measuring
+        run_concurrently(fn, min(args.requests, 50), args.concurrency)
+        outcomes.clear()
+        emulator.reset_stats()
+
+        latencies, errors, wall_time = run_concurrently(
+            fn, args.requests, args.concurrency)
+
+        result = summarize(latencies, wall_time=wall_time)
+        result["errors"] = len(errors)
+        result["error_samples"] = errors[:5]
+        result["outcomes"] = dict(outcomes)
+        result["engine_calls"] = emulator.calls_by_class["decision"]
+
+        if args.mode == "adzerk_request":
+            result["memory"] = measure_memory(fn, args.memory_requests)
+
+    g.log.info("%s: %.1f req/s, p50 %.1fms, p99 %.1fms" % (
+        name, result["throughput_rps"], result["p50_ms"], result["p99_ms"]))
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark ad requests")
+    parser.add_argument("--mode", choices=["adzerk_request", "request_promo"],
+                        default="adzerk_request")
+    parser.add_argument("--url",
+                        default="http://127.0.0.1:8001/api/request_promo",
+                        help="request_promo endpoint (request_promo mode)")
+    parser.add_argument("--scenario", action="append",
+                        choices=sorted(SCENARIOS),
+                        help="scenarios to run (default: all)")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--memory-requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--promos", type=int, default=50)
+    parser.add_argument("--engine-latency", type=float, default=0.02)
+    parser.add_argument("--emulator-port", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args(argv)
+
+    scenarios = args.scenario or sorted(SCENARIOS)
+    if args.mode == "request_promo":
+        in_process_only = [name for name in scenarios
+                           if SCENARIOS[name].get("orphan_rate")]
+        if args.scenario and in_process_only:
+            parser.error("%s only run in adzerk_request mode" %
+                         ", ".join(in_process_only))
+        scenarios = [name for name in scenarios
+                     if name not in in_process_only]
+
+    emulator = AdzerkEmulator(port=args.emulator_port,
+                              latency_by_class={"decision": args.engine_latency},
+                              seed=args.seed)
+    emulator.start()
+    restore = point_plugin_at(emulator)
+
+    try:
+        promos = load_promos(args.promos)
+        results = {}
+        for name in scenarios:
+            scenario = dict(SCENARIO_DEFAULTS, **SCENARIOS[name])
+            results[name] = run_scenario(name, scenario, emulator, promos, args)
+    finally:
+        restore()
+        emulator.stop()
+
+    write_results(args.output, {
+        "benchmark": "request_promo",
+        "mode": args.mode,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "engine_latency": args.engine_latency,
+        "scenarios": results,
+    })
+    return results
@@ -0,0 +1,289 @@
+"""
+Benchmark the adzerk_q sync pipeline against the local adzerk emulator.
+
+Drives `adzerkpromote._update_adzerk` (update_advertiser -> update_creative
+-> update_campaign -> update_flight -> update_cfmap) for promoted links of
+a few typical shapes, the same way `process_adzerk` would for an edit of
+the link followed by an edit of each of its campaigns. Each shape is synced
+twice: once creating the adzerk objects and once more with nothing changed.
+
+For every link this records wall time, management API calls by endpoint,
+bytes sent and how long the `adzerk_update` lock was held. The links and
+campaigns are in-memory stand-ins, and the promote predicates that would
+query the database (payment, review, billable impressions) are stubbed, so
+only the sync logic and API traffic are measured.
+
+    paster run $REDDIT_INI -c 'from reddit_adzerk.tests.benchmarks.sync import main; main(["--links", "20"])'
+
+"""
+
+import argparse
+import datetime
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from mock import patch
+from pylons import app_globals as g
+
+from reddit_adzerk.tests.emulator import AdzerkEmulator, point_plugin_at
+from reddit_adzerk.tests.benchmarks.harness import (
+    Timings,
+    summarize,
+    write_results,
+)
+
+SHAPES = {
+    "single_campaign": dict(),
+    "twenty_campaigns": dict(campaigns=20),
+    "geotargeted": dict(location=("US", "CA", "807")),
+    "mobile_targeted": dict(
+        platform="all",
+        mobile_os=["iOS", "Android"],
+        ios_devices=["iPhone", "iPad"],
+        ios_version_range=["8.0", ""],
+        android_devices=["phone", "tablet"],
+        android_version_range=["4.4", "6.0"],
+    ),
+}
+
+SHAPE_DEFAULTS = dict(
+    campaigns=1,
+    platform="desktop",
+    location=None,
+    mobile_os=None,
+    ios_devices=None,
+    ios_version_range=None,
+    android_devices=None,
+    android_version_range=None,
+)
+
+
+class FakeThing(object):
+    """Just enough of a `Thing` for the sync functions."""
+
+    _fullname_prefix = "t0_"
+
+    def __init__(self, _id, **attrs):
+        self._id = _id
+        self._deleted = False
+        self._commits = 0
+        for attr, value in attrs.iteritems():
+            setattr(self, attr, value)
+
+    @property
+    def _fullname(self):
+        return "%s%d" % (self._fullname_prefix, self._id)
+
+    def _commit(self):
+        self._commits += 1
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self._fullname)
+
+
+class FakeAccount(FakeThing):
+    _fullname_prefix = "t2_"
+
+
+class FakeLink(FakeThing):
+    _fullname_prefix = "t3_"
+
+
+class FakeCampaign(FakeThing):
+    _fullname_prefix = "t8_"
+
+
+class FakeTarget(object):
+    def __init__(self, subreddit_names):
+        self.subreddit_names = subreddit_names
+        self.is_collection = False
+
+
+def make_link(shape, link_id):
+    from r2.models import promo
+
+    now = datetime.datetime.now(g.tz).replace(minute=0, second=0,
+                                              microsecond=0)
+    author = FakeAccount(link_id, name="advertiser%d" % link_id)
+    link = FakeLink(
+        link_id,
+        author_id=author._id,
+        url="https://www.example.com/promo/%d" % link_id,
+        is_self=False,
+        third_party_tracking=None,
+        third_party_tracking_2=None,
+        moat_tracking=False,
+        over_18=False,
+    )
+
+    if shape["location"]:
+        country, region, metro = shape["location"]
+        location = promo.Location(country, region=region, metro=metro)
+    else:
+        location = None
+
+    campaigns = []
+    for i in xrange(shape["campaigns"]):
+        campaigns.append(FakeCampaign(
+            link_id * 1000 + i,
+            link_id=link._id,
+            platform=shape["platform"],
+            start_date=now + datetime.timedelta(days=i),
+            end_date=now + datetime.timedelta(days=i + 7),
+            target=FakeTarget(["pics", "funny", "aww"]),
+            is_approved=True,
+            paused=False,
+            is_terminated=False,
+            priority_name=sorted(g.az_selfserve_priorities)[0],
+            frequency_cap=None,
+            is_house=False,
+            bid_pennies=500,
+            cost_basis=promo.PROMOTE_COST_BASIS.cpm,
+            impressions=100000,
+            total_budget_pennies=50000,
+            ndays=7,
+            use_daily_budget_cap=True,
+            mobile_os=shape["mobile_os"],
+            ios_devices=shape["ios_devices"],
+            ios_version_range=shape["ios_version_range"],
+            android_devices=shape["android_devices"],
+            android_version_range=shape["android_version_range"],
+            location=location,
+        ))
+
+    return author, link, campaigns
+
+
+class LockTimer(object):
+    """Wraps `g.make_lock` to record how long each lock is held."""
+
+    def __init__(self, make_lock):
+        self.make_lock = make_lock
+        self.held = []
+
+    @contextmanager
+    def __call__(self, *args, **kwargs):
+        with self.make_lock(*args, **kwargs):
+            acquired = time.time()
+            try:
+                yield
+            finally:
+                self.held.append(time.time() - acquired)
+
+
+def sync_link(author, link, campaigns, emulator, lock_timer, timings):
+    from reddit_adzerk import adzerkpromote
+
+    emulator.reset_stats()
+    del lock_timer.held[:]
+    start = time.time()
+
+    with patch.object(adzerkpromote.Account, "_byID",
+                      return_value=author):
+        with timings.time("link"):
+            adzerkpromote._update_adzerk(link, None, None)
+
+        for campaign in campaigns:
+            with timings.time("campaign"):
+                adzerkpromote._update_adzerk(link, campaign, None)
+
+    return {
+        "wall_time": time.time() - start,
+        "calls": sum(emulator.calls.values()),
+        "calls_by_endpoint": {"%s %s" % key: count
+                              for key, count in emulator.calls.iteritems()},
+        "bytes_sent": sum(emulator.bytes_received.values()),
+        "lock_hold_time": sum(lock_timer.held),
+    }
+
+
+def _summarize_links(per_link):
+    calls_by_endpoint = Counter()
+    for result in per_link:
+        calls_by_endpoint.update(result["calls_by_endpoint"])
+
+    count = float(len(per_link))
+    return {
+        "wall_time": summarize([r["wall_time"] for r in per_link]),
+        "lock_hold_time": summarize([r["lock_hold_time"] for r in per_link]),
+        "calls_per_link": sum(r["calls"] for r in per_link) / count,
+        "bytes_sent_per_link": sum(r["bytes_sent"] for r in per_link) / count,
+        "calls_by_endpoint_per_link": {
+            endpoint: calls / count
+            for endpoint, calls in calls_by_endpoint.iteritems()
+        },
+    }
+
+
+def run_shape(name, shape, emulator, args):
+    from r2.lib import promote
+    from reddit_adzerk import adzerkpromote
+
+    lock_timer = LockTimer(g.make_lock)
+    links = [make_link(shape, args.first_id + i) for i in xrange(args.links)]
+    results = {}
+
+    with patch.object(g, "make_lock", lock_timer), \
+            patch.object(adzerkpromote.PromotionLog, "add"), \
+            patch.object(promote, "is_accepted", return_value=True), \
+            patch.object(promote, "is_external", return_value=False), \
+            patch.object(promote, "campaign_needs_review", return_value=False), \
+            patch.object(promote, "charged_or_not_needed", return_value=True), \
+            patch.object(adzerkpromote, "get_billable_impressions_multi",
+                         side_effect=lambda campaigns: dict.fromkeys(
+                             (c._fullname for c in campaigns), 0)):
+
+        for phase in ("create", "resync"):
+            timings = Timings()
+            per_link = [
+                sync_link(author, link, campaigns, emulator, lock_timer,
+                          timings)
+                for author, link, campaigns in links
+            ]
+            results[phase] = _summarize_links(per_link)
+            results[phase]["steps"] = timings.summary()
+
+            g.log.info("%s/%s: %.1f calls/link, p50 %.1fms/link" % (
+                name, phase, results[phase]["calls_per_link"],
+                results[phase]["wall_time"]["p50_ms"]))
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark adzerk syncs")
+    parser.add_argument("--shape", action="append", choices=sorted(SHAPES),
+                        help="link shapes to run (default: all)")
+    parser.add_argument("--links", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="management API latency in seconds")
+    parser.add_argument("--first-id", type=int, default=10 ** 9)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args(argv)
+
+    if not hasattr(g, "ad_events"):
+        from reddit_adzerk.lib.events import AdEventQueue
+        g.ad_events = AdEventQueue()
+
+    results = {}
+    for name in args.shape or sorted(SHAPES):
+        # a fresh emulator per shape keeps object counts comparable
+        emulator = AdzerkEmulator(latency=args.latency, seed=args.seed)
+        emulator.start()
+        restore = point_plugin_at(emulator)
+        try:
+            shape = dict(SHAPE_DEFAULTS, **SHAPES[name])
+            results[name] = run_shape(name, shape, emulator, args)
+        finally:
+            restore()
+            emulator.stop()
+
+    write_results(args.output, {
+        "benchmark": "sync",
+        "links": args.links,
+        "latency": args.latency,
+        "shapes": results,
+    })
+    return results
@@ -0,0 +1,728 @@
+"""
+A local stand-in for the Adzerk management, reporting and decision APIs.
+
+Speaks the subset of endpoints used by `adzerk_api`, `report`, `location`
+and `adzerkpromote.adzerk_request`, keeping all objects in memory. Latency,
+errors and how long queued reports stay pending are configurable, which
+makes it the base for load tests and reproducible benchmarks.
+
+    emulator = AdzerkEmulator(latency=0.05, report_pending_polls=2)
+    emulator.start()
+    point_plugin_at(emulator)
+    ...
+    emulator.stop()
+
+It can also be run standalone:
+
+    python -m reddit_adzerk.tests.emulator --port 8765 --latency 0.05
+
+"""
+
+import base64
+import datetime
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import urllib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from collections import Counter, defaultdict
+from urlparse import parse_qs, urlparse
+
+from reddit_adzerk import adzerk_api
+
+
+FIRST_ID = 10000
+EVENT_TYPE_UPVOTE = 10
+EVENT_TYPE_DOWNVOTE = 11
+REPORT_STATUS_PENDING = 1
+REPORT_STATUS_COMPLETE = 2
+
+# adzerk returns every field of an object, with nulls for unset ones
+FIELDS_BY_NAME = {cls._name: cls._fields for cls in (
+    adzerk_api.Advertiser,
+    adzerk_api.Campaign,
+    adzerk_api.Creative,
+    adzerk_api.Flight,
+)}
+FIELDS_BY_NAME["cfmap"] = adzerk_api.CreativeFlightMap._fields
+
+# endpoint classes, used for per class latency and call counts
+MANAGEMENT = "management"
+REPORTING = "reporting"
+DECISION = "decision"
+
+DEFAULT_COUNTRIES = [{
+    "Name": "United States",
+    "Code": "US",
+    "Regions": {
+        "CA": {
+            "Name": "California",
+            "Code": "CA",
+            "Metros": {
+                "807": {"Name": "San Francisco-Oakland-San Jose", "Code": "807"},
+                "803": {"Name": "Los Angeles", "Code": "803"},
+            },
+        },
+        "NY": {
+            "Name": "New York",
+            "Code": "NY",
+            "Metros": {
+                "501": {"Name": "New York", "Code": "501"},
+            },
+        },
+    },
+}, {
+    "Name": "Canada",
+    "Code": "CA",
+    "Regions": {},
+}]
+
+
+def _parse_date(date_str):
+    return datetime.datetime.strptime(date_str, "%m/%d/%Y").date()
+
+
+def _format_date(date):
+    return date.strftime("%Y-%m-%dT00:00:00Z")
+
+
+class EmulatorState(object):
+    """In-memory store of adzerk objects and queued reports."""
+
+    def __init__(self, seed=None):
+        self.lock = threading.RLock()
+        self.random = random.Random(seed)
+        self.ids = itertools.count(FIRST_ID)
+        self.objects = defaultdict(dict)
+        self.reports = {}
+        self.countries = DEFAULT_COUNTRIES
+
+    def next_id(self):
+        return next(self.ids)
+
+    def create(self, name, item):
+        with self.lock:
+            item = dict(item, Id=self.next_id())
+            for field in FIELDS_BY_NAME.get(name, ()):
+                item.setdefault(field, None)
+
+            if name == "flight":
+                item.setdefault("CreativeMaps", [])
+                item["GeoTargeting"] = [
+                    dict(geotarget, LocationId=self.next_id())
+                    for geotarget in item.get("GeoTargeting") or []
+                ]
+            elif name == "campaign":
+                item["Flights"] = [self.create("flight", flight)
+                                   for flight in item.get("Flights") or []]
+
+            self.objects[name][item["Id"]] = item
+            return item
+
+    def get(self, name, Id):
+        return self.objects[name].get(Id)
+
+    def update(self, name, Id, item):
+        with self.lock:
+            existing = self.objects[name].get(Id)
+            if existing is None:
+                return None
+
+            if name == "flight" and item.get("GeoTargeting"):
+                # geotargeting can only be added to flights without any
+                if not existing.get("GeoTargeting"):
+                    item["GeoTargeting"] = [
+                        dict(geotarget, LocationId=self.next_id())
+                        for geotarget in item["GeoTargeting"]
+                    ]
+                else:
+                    item.pop("GeoTargeting")
+            elif name == "flight":
+                item.pop("GeoTargeting", None)
+
+            existing.update(item)
+            existing["Id"] = Id
+            return existing
+
+    def list(self, name, **filters):
+        items = self.objects[name].values()
+        for attr, value in filters.items():
+            items = [item for item in items if item.get(attr) == value]
+        return sorted(items, key=lambda item: item["Id"])
+
+    def queue_report(self, criteria, pending_polls):
+        with self.lock:
+            report_id = "emulated-%d" % self.next_id()
+            self.reports[report_id] = {
+                "criteria": criteria,
+                "polls_remaining": pending_polls,
+            }
+            return report_id
+
+
+def default_report_records(state, criteria):
+    """Build report records for `criteria` from the emulated flights.
+
+    Records are split by day when grouped by day and each detail is a
+    flight with deterministic (seeded) traffic.
+
+    """
+
+    groups = [group.lower() for group in criteria.get("GroupBy") or []]
+    parameters = criteria.get("Parameters") or []
+    start = _parse_date(criteria["StartDate"])
+    end = _parse_date(criteria["EndDate"])
+
+    flight_ids = {p["flightId"] for p in parameters if "flightId" in p}
+    campaign_ids = {p["campaignId"] for p in parameters if "campaignId" in p}
+    flights = [flight for flight in state.list("flight")
+               if (not flight_ids or flight["Id"] in flight_ids) and
+                  (not campaign_ids or flight.get("CampaignId") in campaign_ids)]
+
+    if "day" in groups:
+        days = [start + datetime.timedelta(days=i)
+                for i in range((end - start).days + 1)]
+    else:
+        days = [None]
+
+    records = []
+    for day in days:
+        details = []
+        for flight in flights:
+            seed = "%s:%s" % (flight["Id"], day)
+            rng = random.Random(seed)
+            impressions = rng.randint(0, 100000)
+            clicks = rng.randint(0, impressions // 100)
+            price = flight.get("Price") or 0
+            revenue = round(impressions * price / 1000., 2)
+            details.append({
+                "Title": flight.get("Name") or "",
+                "Grouping": {
+                    "OptionId": flight["Id"],
+                    "CampaignId": flight.get("CampaignId"),
+                },
+                "Impressions": impressions,
+                "Clicks": clicks,
+                "TrueRevenue": revenue,
+            })
+
+        record = {
+            "Details": details,
+            "FirstDate": _format_date(day or start),
+            "LastDate": _format_date(day or end),
+            "TotalImpressions": sum(d["Impressions"] for d in details),
+            "TotalClicks": sum(d["Clicks"] for d in details),
+            "TotalTrueRevenue": sum(d["TrueRevenue"] for d in details),
+        }
+        if day:
+            record["Date"] = _format_date(day)
+        records.append(record)
+
+    return {"Records": records}
+
+
+def default_inventory_records(state, criteria):
+    """Build a synchronous (keyword/location) inventory report."""
+
+    groups = criteria.get("GroupBy") or []
+    keywords = [p["keyword"] for p in criteria.get("Parameters") or []
+                if "keyword" in p] or ["-reddit.com"]
+    start = _parse_date(criteria["StartDate"])
+    end = _parse_date(criteria["EndDate"])
+
+    locations = {
+        "countrycode": [country["Code"] for country in state.countries],
+        "metrocode": [int(metro)
+                      for country in state.countries
+                      for region in country["Regions"].values()
+                      for metro in region["Metros"]],
+    }
+    location_groups = [group for group in groups[1:]
+                       if group.lower() in locations]
+
+    records = []
+    for i in range((end - start).days + 1):
+        day = start + datetime.timedelta(days=i)
+        details = []
+        for keyword in keywords:
+            if location_groups:
+                group = location_groups[0]
+                values = locations[group.lower()]
+            else:
+                group, values = None, [None]
+
+            for value in values:
+                rng = random.Random("%s:%s:%s" % (keyword, value, day))
+                grouping = {"keyword": keyword}
+                if group:
+                    grouping[group] = value
+                impressions = rng.randint(1000, 1000000)
+                details.append({
+                    "Grouping": grouping,
+                    "Impressions": impressions,
+                    "Clicks": impressions // 1000,
+                })
+
+        records.append({
+            "FirstDate": _format_date(day),
+            "LastDate": _format_date(day),
+            "Details": details,
+        })
+
+    return {"Records": records}
+
+
+def default_decision(state, placement, data):
+    """Pick an active, mapped flight for a placement (or `None`)."""
+
+    flights = [flight for flight in state.list("flight", IsActive=True)
+               if flight.get("CreativeMaps")]
+    if not flights:
+        return None
+
+    flight = state.random.choice(flights)
+    cfmap = flight["CreativeMaps"][0]
+    creative = state.get("creative", cfmap["Creative"]["Id"]) or {}
+    impression_data = json.dumps({
+        "di": "%032x" % state.random.getrandbits(128),
+        "mk": ",".join(data.get("keywords") or []),
+    })
+    encoded = base64.urlsafe_b64encode(impression_data).rstrip("=")
+    event_url = "https://engine.emulated/e.gif?flight=%s&event=%%d" % flight["Id"]
+
+    return {
+        "adId": state.next_id(),
+        "campaignId": flight.get("CampaignId"),
+        "creativeId": creative.get("Id"),
+        "flightId": flight["Id"],
+        "pricing": {
+            "revenue": flight.get("Price"),
+            "rateType": flight.get("RateType") or 2,
+        },
+        "impressionUrl": "https://engine.emulated/i.gif?e=%s" % encoded,
+        "clickUrl": "https://engine.emulated/r?flight=%s" % flight["Id"],
+        "events": [
+            {"id": EVENT_TYPE_UPVOTE, "url": event_url % EVENT_TYPE_UPVOTE},
+            {"id": EVENT_TYPE_DOWNVOTE, "url": event_url % EVENT_TYPE_DOWNVOTE},
+        ],
+        "contents": [{
+            "type": "html",
+            "body": creative.get("ScriptBody", "{}"),
+        }],
+    }
+
+
+class EmulatorError(Exception):
+    def __init__(self, status_code, body=""):
+        super(EmulatorError, self).__init__(status_code, body)
+        self.status_code = status_code
+        self.body = body
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # (method, pattern, handler name, endpoint class)
+    routes = [
+        ("POST", r"^/api/v2$", "decide", DECISION),
+        ("GET", r"^/v1/countries$", "countries", MANAGEMENT),
+        ("POST", r"^/v1/report$", "report", REPORTING),
+        ("POST", r"^/v1/report/queue$", "queue_report", REPORTING),
+        ("GET", r"^/v1/report/queue/(?P<report_id>[^/]+)$", "fetch_report",
+            REPORTING),
+        ("GET", r"^/v1/advertiser/(?P<Id>\d+)/creatives$",
+            "list_creatives", MANAGEMENT),
+        ("GET", r"^/v1/flight/(?P<flight_id>\d+)/creatives$",
+            "list_cfmaps", MANAGEMENT),
+        ("POST", r"^/v1/flight/(?P<flight_id>\d+)/creative$",
+            "create_cfmap", MANAGEMENT),
+        ("GET", r"^/v1/flight/(?P<flight_id>\d+)/creative/(?P<Id>\d+)$",
+            "get_cfmap", MANAGEMENT),
+        ("PUT", r"^/v1/flight/(?P<flight_id>\d+)/creative/(?P<Id>\d+)$",
+            "update_cfmap", MANAGEMENT),
+        ("PUT", r"^/v1/flight/(?P<flight_id>\d+)/geotargeting/(?P<Id>\d+)$",
+            "update_geotargeting", MANAGEMENT),
+        ("GET",
+            r"^/v1/flight/(?P<flight_id>\d+)/geotargeting/(?P<Id>\d+)/delete$",
+            "delete_geotargeting", MANAGEMENT),
+        ("GET", r"^/v1/(?P<name>[a-z]+)$", "list", MANAGEMENT),
+        ("POST", r"^/v1/(?P<name>[a-z]+)$", "create", MANAGEMENT),
+        ("GET", r"^/v1/(?P<name>[a-z]+)/(?P<Id>\d+)$", "get", MANAGEMENT),
+        ("PUT", r"^/v1/(?P<name>[a-z]+)/(?P<Id>\d+)$", "update", MANAGEMENT),
+    ]
+    routes = [(method, re.compile(pattern), handler, endpoint_class)
+              for method, pattern, handler, endpoint_class in routes]
+
+    def log_message(self, format, *args):
+        if self.server.emulator.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PUT(self):
+        self._dispatch("PUT")
+
+    def _dispatch(self, method):
+        emulator = self.server.emulator
+        url = urlparse(self.path)
+        self.query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        self.body = self.rfile.read(length) if length else ""
+
+        for route_method, pattern, handler, endpoint_class in self.routes:
+            match = pattern.match(url.path)
+            if route_method == method and match:
+                break
+        else:
+            return self._respond(404, "not found: %s %s" % (method, url.path))
+
+        emulator.record_call(method, handler, endpoint_class, len(self.body))
+
+        try:
+            emulator.before_request(endpoint_class)
+            status, content = 200, getattr(self, handler)(**match.groupdict())
+        except EmulatorError as e:
+            status, content = e.status_code, e.body
+
+        self._respond(status, content)
+
+    def _respond(self, status, content):
+        if isinstance(content, basestring):
+            body = content
+        else:
+            body = json.dumps(content)
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _form_item(self, name):
+        # management api objects are posted as form data: `<name>=<json>`
+        form = parse_qs(self.body)
+        if name not in form:
+            raise EmulatorError(400, "missing %s" % name)
+        return json.loads(form[name][-1])
+
+    def _criteria(self):
+        # reporting criteria are posted as an unencoded `criteria=<json>`
+        _, _, criteria = self.body.partition("criteria=")
+        try:
+            return json.loads(urllib.unquote_plus(criteria))
+        except ValueError:
+            return json.loads(criteria)
+
+    @property
+    def state(self):
+        return self.server.emulator.state
+
+    def _existing(self, name, Id):
+        item = self.state.get(name, int(Id))
+        if item is None:
+            raise EmulatorError(404, "%s %s not found" % (name, Id))
+        return item
+
+    def list(self, name):
+        filters = {}
+        if name == "flight" and self.query.get("isActive") == "True":
+            filters["IsActive"] = True
+        items = self.state.list(name, **filters)
+
+        if "page" not in self.query:
+            return {"items": items}
+
+        # pages are numbered from 1, like adzerk's
+        page = int(self.query["page"])
+        page_size = int(self.query.get("pageSize") or 500)
+        offset = (page - 1) * page_size
+        return {
+            "items": items[offset:offset + page_size],
+            "page": page,
+            "pageSize": page_size,
+            "totalItems": len(items),
+            "totalPages": max(1, -(-len(items) // page_size)),
+        }
+
+    def create(self, name):
+        return self.state.create(name, self._form_item(name))
+
+    def get(self, name, Id):
+        item = dict(self._existing(name, Id))
+        if name == "campaign":
+            if self.query.get("excludeFlights") == "true":
+                item["Flights"] = []
+            else:
+                item["Flights"] = self.state.list("flight", CampaignId=item["Id"])
+        return item
+
+    def update(self, name, Id):
+        self._existing(name, Id)
+        return self.state.update(name, int(Id), self._form_item(name))
+
+    def list_creatives(self, Id):
+        return {"items": self.state.list("creative", AdvertiserId=int(Id))}
+
+    def list_cfmaps(self, flight_id):
+        return {"items": self._existing("flight", flight_id)["CreativeMaps"]}
+
+    def create_cfmap(self, flight_id):
+        flight = self._existing("flight", flight_id)
+        item = self._form_item("creative")
+        cfmap = self.state.create("cfmap", dict(item, FlightId=int(flight_id)))
+        with self.state.lock:
+            flight["CreativeMaps"].append(cfmap)
+        return cfmap
+
+    def get_cfmap(self, flight_id, Id):
+        return self._existing("cfmap", Id)
+
+    def update_cfmap(self, flight_id, Id):
+        self._existing("cfmap", Id)
+        return self.state.update("cfmap", int(Id), self._form_item("creative"))
+
+    def update_geotargeting(self, flight_id, Id):
+        flight = self._existing("flight", flight_id)
+        item = self._form_item("geotargeting")
+        with self.state.lock:
+            for geotarget in flight.get("GeoTargeting") or []:
+                if geotarget["LocationId"] == int(Id):
+                    geotarget.update(item)
+                    return geotarget
+        raise EmulatorError(404, "geotargeting %s not found" % Id)
+
+    def delete_geotargeting(self, flight_id, Id):
+        flight = self._existing("flight", flight_id)
+        with self.state.lock:
+            flight["GeoTargeting"] = [
+                geotarget for geotarget in flight.get("GeoTargeting") or []
+                if geotarget["LocationId"] != int(Id)
+            ]
+        return {"Message": "Successfully deleted"}
+
+    def countries(self):
+        return self.state.countries
+
+    def report(self):
+        emulator = self.server.emulator
+        return emulator.inventory_report_factory(self.state, self._criteria())
+
+    def queue_report(self):
+        emulator = self.server.emulator
+        report_id = self.state.queue_report(self._criteria(),
+                                            emulator.report_pending_polls)
+        return {"Id": report_id}
+
+    def fetch_report(self, report_id):
+        emulator = self.server.emulator
+        queued = self.state.reports.get(report_id)
+        if queued is None:
+            raise EmulatorError(404, "report %s not found" % report_id)
+
+        with self.state.lock:
+            if queued["polls_remaining"] > 0:
+                queued["polls_remaining"] -= 1
+                return {"Id": report_id, "Status": REPORT_STATUS_PENDING}
+
+        if "result" not in queued:
+            queued["result"] = emulator.report_factory(
+                self.state, queued["criteria"])
+
+        return {
+            "Id": report_id,
+            "Status": REPORT_STATUS_COMPLETE,
+            "Result": queued["result"],
+        }
+
+    def decide(self):
+        emulator = self.server.emulator
+        data = json.loads(self.body)
+        decisions = {}
+        for placement in data.get("placements") or []:
+            decisions[placement["divName"]] = emulator.decision_factory(
+                self.state, placement, data)
+        return {"user": data.get("user"), "decisions": decisions}
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class AdzerkEmulator(object):
+    """A local, in-memory Adzerk served over http.
+
+    latency: seconds added to every request.
+    latency_by_class: per endpoint class (`MANAGEMENT`, `REPORTING`,
+        `DECISION`) latency overriding `latency`.
+    error_rate: probability of failing a request with `error_status`.
+    report_pending_polls: number of times a queued report is reported as
+        pending before it completes.
+    report_factory, inventory_report_factory, decision_factory: callables
+        building queued report results, synchronous report results and
+        placement decisions.
+
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0,
+                 latency_by_class=None, error_rate=0, error_status=500,
+                 report_pending_polls=0, report_factory=None,
+                 inventory_report_factory=None, decision_factory=None,
+                 seed=None, verbose=False):
+        self.state = EmulatorState(seed=seed)
+        self.latency = latency
+        self.latency_by_class = latency_by_class or {}
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.report_pending_polls = report_pending_polls
+        self.report_factory = report_factory or default_report_records
+        self.inventory_report_factory = (inventory_report_factory or
+                                         default_inventory_records)
+        self.decision_factory = decision_factory or default_decision
+        self.verbose = verbose
+
+        self.calls = Counter()
+        self.calls_by_class = Counter()
+        self.bytes_received = Counter()
+        self._forced_errors = []
+        self._stats_lock = threading.Lock()
+
+        self.server = _ThreadingHTTPServer((host, port), _Handler)
+        self.server.emulator = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+    @property
+    def management_url(self):
+        return "%s/v1" % self.url
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def fail_next(self, count=1, status=500, body="emulated failure",
+                  endpoint_class=None):
+        """Fail the next `count` requests (of `endpoint_class`, if given)."""
+        with self._stats_lock:
+            self._forced_errors.extend(
+                [(endpoint_class, status, body)] * count)
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self.calls.clear()
+            self.calls_by_class.clear()
+            self.bytes_received.clear()
+
+    def record_call(self, method, handler, endpoint_class, size):
+        with self._stats_lock:
+            self.calls[(method, handler)] += 1
+            self.calls_by_class[endpoint_class] += 1
+            self.bytes_received[endpoint_class] += size
+
+    def before_request(self, endpoint_class):
+        latency = self.latency_by_class.get(endpoint_class, self.latency)
+        if latency:
+            time.sleep(latency)
+
+        with self._stats_lock:
+            for i, (error_class, status, body) in enumerate(self._forced_errors):
+                if error_class is None or error_class == endpoint_class:
+                    del self._forced_errors[i]
+                    raise EmulatorError(status, body)
+
+        if self.error_rate and self.state.random.random() < self.error_rate:
+            raise EmulatorError(self.error_status, "emulated failure")
+
+
+def point_plugin_at(emulator):
+    """Point the plugin's adzerk clients at `emulator`.
+
+    Sets `adzerk_api.Base._base_url`, `report.URL_BASE`,
+    `location.COUNTRIES_URL` and `g.adzerk_engine_domain`, and keeps rate
+    limit buckets in process so the emulator doesn't use up the real API
+    key's budget. Returns a function restoring the previous values.
+
+    """
+
+    from pylons import app_globals as g
+
+    from reddit_adzerk import adzerk_api, location, report
+    from reddit_adzerk.lib import ratelimit
+
+    previous = (adzerk_api.Base._base_url, report.URL_BASE,
+                location.COUNTRIES_URL, g.adzerk_engine_domain,
+                ratelimit._local_counters)
+
+    adzerk_api.Base._base_url = emulator.management_url
+    report.URL_BASE = emulator.management_url
+    location.COUNTRIES_URL = "%s/countries" % emulator.management_url
+    g.adzerk_engine_domain = emulator.url
+    ratelimit.use_local_counters()
+
+    def restore():
+        (adzerk_api.Base._base_url, report.URL_BASE,
+         location.COUNTRIES_URL, g.adzerk_engine_domain,
+         ratelimit._local_counters) = previous
+
+    return restore
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--report-pending-polls", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    emulator = AdzerkEmulator(
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        report_pending_polls=args.report_pending_polls,
+        seed=args.seed,
+        verbose=True,
+    )
+    print "serving emulated adzerk on %s" % emulator.url
+    try:
+        emulator.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+import json
+import threading
+import time
+from unittest import TestCase
+
+from mock import MagicMock, patch
+
+from reddit_adzerk import adzerk_api
+from reddit_adzerk.adzerk_api import SingleFlight
+
+
+class TestSingleFlight(TestCase):
+
+    def _run_concurrently(self, single_flight, key, fn, count):
+        results = []
+        errors = []
+
+        def call():
+            try:
+                results.append(single_flight.do(key, fn))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call) for _ in xrange(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, errors
+
+    def test_concurrent_calls_are_coalesced(self):
+        single_flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def fetch():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return {"Id": 1}
+
+        def call():
+            results.append(single_flight.do("flight/1", fetch))
+
+        threads = [threading.Thread(target=call) for _ in xrange(4)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+
+        # let the leader finish once everyone is waiting on its call
+        while single_flight.calls["flight/1"].waiters < 3:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results),
+                         [({"Id": 1}, False)] + [({"Id": 1}, True)] * 3)
+        self.assertEqual(single_flight.calls, {})
+
+    def test_errors_are_shared(self):
+        single_flight = SingleFlight()
+
+        def fetch():
+            raise ValueError("bad response")
+
+        results, errors = self._run_concurrently(
+            single_flight, "flight/1", fetch, 3)
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(single_flight.calls, {})
+
+    def test_sequential_calls_are_not_coalesced(self):
+        single_flight = SingleFlight()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(single_flight.do("flight/1", fetch), (1, False))
+        self.assertEqual(single_flight.do("flight/1", fetch), (2, False))
+
+
+class TestIterList(TestCase):
+
+    def _response(self, page, total_pages, ids):
+        return MagicMock(status_code=200, text=json.dumps({
+            "page": page,
+            "totalPages": total_pages,
+            "items": [{"Id": i, "Url": "", "Title": "site %d" % i,
+                       "IsDeleted": False} for i in ids],
+        }))
+
+    def test_pages_are_fetched_in_turn(self):
+        responses = [
+            self._response(1, 2, [1, 2]),
+            self._response(2, 2, [3]),
+        ]
+
+        with patch.object(adzerk_api, "_request",
+                          side_effect=responses) as request, \
+                patch.object(adzerk_api.Site, "_headers", return_value={}):
+            pages = adzerk_api.Site.iter_list(page_size=2)
+            first = next(pages)
+            self.assertEqual(request.call_count, 1)
+            rest = list(pages)
+
+        self.assertEqual([site.Id for site in first], [1, 2])
+        self.assertEqual([[site.Id for site in page] for page in rest], [[3]])
+        self.assertEqual([call[1]["params"]["page"]
+                          for call in request.call_args_list], [1, 2])
+
+    def test_empty_listing(self):
+        with patch.object(adzerk_api, "_request",
+                          return_value=self._response(1, 0, [])), \
+                patch.object(adzerk_api.Site, "_headers", return_value={}):
+            self.assertEqual(list(adzerk_api.Site.iter_list()), [])
+
+
+class FakeCache(dict):
+    def add(self, key, value, time=0):
+        if key in self:
+            return False
+        self[key] = value
+        return True
+
+    def set(self, key, value, time=0):
+        self[key] = value
+
+    def delete(self, key):
+        self.pop(key, None)
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.pop(key, None)
+
+
+class TestSharedGets(TestCase):
+
+    url = "https://api.adzerk.net/v1/flight/1"
+
+    def setUp(self):
+        self.cache = FakeCache()
+        patches = [
+            patch.object(adzerk_api.g, "gencache", self.cache),
+            patch.object(adzerk_api.g, "live_config",
+                         {"adzerk_api_shared_get_seconds": 30}),
+            patch.object(adzerk_api.g, "stats"),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def _response(self, status_code=200, item=None):
+        return MagicMock(status_code=status_code, text=json.dumps(item or {}))
+
+    def test_lock_is_released_after_fetch(self):
+        with patch.object(adzerk_api, "_request",
+                          return_value=self._response(item={"Id": 1})):
+            item = adzerk_api._fetch_item(self.url, {})
+
+        self.assertEqual(item, {"Id": 1})
+        self.assertEqual(self.cache, {
+            adzerk_api._shared_get_key(self.url): {"Id": 1},
+        })
+
+    def test_lock_is_released_after_failure(self):
+        with patch.object(adzerk_api, "_request",
+                          return_value=self._response(status_code=503)):
+            with self.assertRaises(adzerk_api.AdzerkError):
+                adzerk_api._fetch_item(self.url, {})
+
+        self.assertEqual(self.cache, {})
+
+    def test_invalidate_removes_locks(self):
+        for suffix in adzerk_api.GET_URL_SUFFIXES:
+            self.cache[adzerk_api._shared_get_key(self.url + suffix)] = {}
+            self.cache[adzerk_api._shared_get_lock_key(self.url + suffix)] = 1
+
+        adzerk_api._invalidate_shared_gets(self.url)
+        self.assertEqual(self.cache, {})
+
+    def _campaign_key(self):
+        campaign_url = "/".join([adzerk_api.Base._base_url, "campaign", "5"])
+        return adzerk_api._shared_get_key(
+            campaign_url + adzerk_api.GET_URL_SUFFIXES[-1])
+
+    def _flight_attrs(self):
+        attrs = {field: None for field in adzerk_api.Flight._fields.to_set()}
+        attrs["CampaignId"] = 5
+        return attrs
+
+    def test_flight_update_invalidates_campaign(self):
+        campaign_key = self._campaign_key()
+        self.cache[campaign_key] = {}
+        flight = adzerk_api.Flight(1, **self._flight_attrs())
+
+        with patch.object(adzerk_api, "_request",
+                          return_value=self._response(item={"Id": 1})), \
+                patch.object(adzerk_api.Flight, "_headers", return_value={}):
+            flight._send()
+
+        self.assertNotIn(campaign_key, self.cache)
+
+    def test_flight_create_invalidates_campaign(self):
+        campaign_key = self._campaign_key()
+        self.cache[campaign_key] = {}
+
+        with patch.object(adzerk_api, "_request",
+                          return_value=self._response(item={"Id": 1})), \
+                patch.object(adzerk_api.Flight, "_headers", return_value={}):
+            adzerk_api.Flight.create(**self._flight_attrs())
+
+        self.assertNotIn(campaign_key, self.cache)
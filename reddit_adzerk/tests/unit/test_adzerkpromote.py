@@ -1,8 +1,12 @@
-from mock import MagicMock, Mock, patch
+import datetime
 from random import randint
 
+import pytz
+from mock import MagicMock, Mock, patch
+
 from r2.tests import RedditTestCase
 
+from reddit_adzerk import adzerkpromote
 from reddit_adzerk.adzerkpromote import flight_is_active
 
 
@@ -39,3 +43,216 @@ class TestIsActive(RedditTestCase):
             kwargs[key] = True
 
         self.assertFalse(flight_is_active(**kwargs))
+
+
+class TestSyncFingerprint(RedditTestCase):
+
+    def setUp(self):
+        self.autopatch(adzerkpromote.g, "stats")
+
+    def test_fingerprint_is_stable(self):
+        first = adzerkpromote._sync_fingerprint(
+            {'Keywords': ['a', 'b'], 'IsActive': True}, None)
+        second = adzerkpromote._sync_fingerprint(
+            {'IsActive': True, 'Keywords': ['a', 'b']}, None)
+        self.assertEqual(first, second)
+
+    def test_fingerprint_changes_with_payload(self):
+        active = adzerkpromote._sync_fingerprint({'IsActive': True}, None)
+        inactive = adzerkpromote._sync_fingerprint({'IsActive': False}, None)
+        geotargeted = adzerkpromote._sync_fingerprint(
+            {'IsActive': True}, ('US', None, None))
+        self.assertEqual(len(set([active, inactive, geotargeted])), 3)
+
+    def test_is_synced(self):
+        campaign = MagicMock(adzerk_flight_fingerprint='abc')
+        self.assertTrue(adzerkpromote._is_synced(
+            campaign, 'adzerk_flight_fingerprint', 'abc', 'flight'))
+        self.assertFalse(adzerkpromote._is_synced(
+            campaign, 'adzerk_flight_fingerprint', 'def', 'flight'))
+        adzerkpromote.g.stats.simple_event.assert_any_call(
+            'adzerk.sync.flight.skipped')
+        adzerkpromote.g.stats.simple_event.assert_any_call(
+            'adzerk.sync.flight.synced')
+
+
+class TestOutOfBandFlightWrites(RedditTestCase):
+
+    def setUp(self):
+        self.autopatch(adzerkpromote.g, "make_lock")
+        self.campaign = MagicMock(adzerk_flight_fingerprint="abc")
+
+    def test_orphan_deactivation_clears_fingerprint(self):
+        az_flight = MagicMock(IsActive=True)
+        self.autopatch(adzerkpromote.adzerk_api.Flight, "get",
+                       return_value=az_flight)
+        self.autopatch(adzerkpromote.PromoCampaignByFlightIdCache, "get",
+                       return_value="t8_1")
+        self.autopatch(adzerkpromote.PromoCampaign, "_by_fullname",
+                       return_value=self.campaign)
+
+        adzerkpromote._deactivate_orphaned_flight(10)
+
+        self.assertFalse(az_flight.IsActive)
+        self.assertTrue(az_flight._send.called)
+        self.assertIsNone(self.campaign.adzerk_flight_fingerprint)
+        self.assertTrue(self.campaign._commit.called)
+
+    def test_true_orphan_has_nothing_to_clear(self):
+        self.autopatch(adzerkpromote.adzerk_api.Flight, "get")
+        self.autopatch(adzerkpromote.PromoCampaignByFlightIdCache, "get",
+                       return_value=None)
+        by_fullname = self.autopatch(adzerkpromote.PromoCampaign,
+                                     "_by_fullname")
+
+        adzerkpromote._deactivate_orphaned_flight(10)
+        self.assertFalse(by_fullname.called)
+
+    def test_forced_sync_clears_fingerprint_first(self):
+        self.autopatch(adzerkpromote, "_update_flight",
+                       side_effect=adzerkpromote.adzerk_api.AdzerkError(
+                           503, ""))
+        self.autopatch(adzerkpromote, "billable_impressions_batch")
+
+        with self.assertRaises(adzerkpromote.adzerk_api.AdzerkError):
+            adzerkpromote.update_flight(MagicMock(), self.campaign,
+                                        force=True)
+        self.assertIsNone(self.campaign.adzerk_flight_fingerprint)
+
+
+class TestGetAdvertiser(RedditTestCase):
+
+    def test_known_advertiser_is_not_fetched(self):
+        get = self.autopatch(adzerkpromote.adzerk_api.Advertiser, "get")
+        author = MagicMock(external_advertiser_id=123)
+
+        az_advertiser = adzerkpromote.update_advertiser(author)
+
+        self.assertEqual(az_advertiser.Id, 123)
+        self.assertFalse(get.called)
+
+    def test_unknown_advertiser(self):
+        author = MagicMock(spec=[])
+        self.assertIsNone(adzerkpromote.get_advertiser(author))
+
+    def test_full_advertiser_is_cached(self):
+        cache_get = self.autopatch(adzerkpromote.AdvertiserCache, "get")
+        author = MagicMock(external_advertiser_id=123)
+
+        az_advertiser = adzerkpromote.get_advertiser(author, full=True)
+
+        cache_get.assert_called_once_with(123)
+        self.assertEqual(az_advertiser, cache_get.return_value)
+
+
+class TestQueueLanes(RedditTestCase):
+
+    def setUp(self):
+        self.add_item = self.autopatch(adzerkpromote.amqp, "add_item")
+
+    def test_deactivations_use_urgent_lane(self):
+        link = MagicMock(_fullname="t3_1")
+        campaign = MagicMock(_fullname="t8_1")
+
+        adzerkpromote.deactivate_overdelivered(link, campaign)
+        adzerkpromote.deactivate_orphaned_flight(1)
+
+        queues = [call[0][0] for call in self.add_item.call_args_list]
+        self.assertEqual(queues, [adzerkpromote.ADZERK_URGENT_Q] * 2)
+
+    def test_updates_use_default_lane(self):
+        link = MagicMock(_fullname="t3_1")
+        self.autopatch(adzerkpromote, "c", user=None)
+
+        adzerkpromote.update_adzerk(link)
+
+        self.assertEqual(self.add_item.call_args[0][0],
+                         adzerkpromote.ADZERK_Q)
+
+
+class TestBillableImpressions(RedditTestCase):
+
+    def setUp(self):
+        self.fetch = self.autopatch(
+            adzerkpromote, "get_billable_impressions_multi",
+            side_effect=lambda campaigns: {
+                c._fullname: 1000 for c in campaigns})
+
+    def _campaign(self, fullname, is_house=False,
+                  cost_basis=adzerkpromote.promo.PROMOTE_COST_BASIS.fixed_cpm):
+        return MagicMock(_fullname=fullname, is_house=is_house,
+                         cost_basis=cost_basis, impressions=400)
+
+    def test_batch_is_fetched_once(self):
+        campaigns = [self._campaign("t8_1"), self._campaign("t8_2"),
+                     self._campaign("t8_3", is_house=True)]
+
+        with adzerkpromote.billable_impressions_batch(campaigns):
+            overdelivered = [adzerkpromote.is_overdelivered(c)
+                             for c in campaigns]
+            adzerkpromote.get_billable_impressions(campaigns[0])
+
+            # nested batches reuse the outer lookups
+            with adzerkpromote.billable_impressions_batch(campaigns[:1]):
+                adzerkpromote.get_billable_impressions(campaigns[0])
+
+        self.assertEqual(overdelivered, [True, True, False])
+        self.assertEqual(self.fetch.call_count, 1)
+        self.assertEqual(len(self.fetch.call_args[0][0]), 2)
+
+    def test_lookups_outside_batch_are_not_memoized(self):
+        campaign = self._campaign("t8_1")
+        adzerkpromote.get_billable_impressions(campaign)
+        adzerkpromote.get_billable_impressions(campaign)
+        self.assertEqual(self.fetch.call_count, 2)
+
+    def test_overdelivered_campaigns_deactivated_with_one_lookup(self):
+        campaigns = [self._campaign("t8_%d" % i) for i in xrange(5)]
+        promos = [(campaign, MagicMock()) for campaign in campaigns]
+        for campaign in campaigns:
+            campaign.external_flight_overdelivered = False
+        self.autopatch(adzerkpromote.promote, "get_scheduled_promos",
+                       return_value=promos)
+        self.autopatch(adzerkpromote.promote, "is_live_promo",
+                       return_value=True)
+        deactivate = self.autopatch(adzerkpromote, "deactivate_overdelivered")
+
+        adzerkpromote.deactivate_overdelivered_campaigns()
+
+        self.assertEqual(self.fetch.call_count, 1)
+        self.assertEqual(deactivate.call_count, 5)
+
+
+class TestGetBillableImpressionsMulti(RedditTestCase):
+
+    def setUp(self):
+        now = datetime.datetime.now(pytz.utc)
+        self.traffic_dates = {
+            "t8_1": (now - datetime.timedelta(days=2), now),
+            "t8_2": (now - datetime.timedelta(days=1), now),
+            "t8_3": (now + datetime.timedelta(days=1),
+                     now + datetime.timedelta(days=2)),
+        }
+        self.autopatch(
+            adzerkpromote.promote, "get_traffic_dates",
+            side_effect=lambda c: self.traffic_dates[c._fullname])
+        self.query = self.autopatch(adzerkpromote.traffic.Session, "query")
+        self.query.return_value.filter.return_value.filter.return_value\
+            .group_by.return_value = [("t8_1", 1200L)]
+
+    def test_one_query_for_started_campaigns(self):
+        campaigns = [MagicMock(_fullname=fullname)
+                     for fullname in sorted(self.traffic_dates)]
+
+        impressions = adzerkpromote.get_billable_impressions_multi(campaigns)
+
+        self.assertEqual(impressions, {"t8_1": 1200, "t8_2": 0, "t8_3": 0})
+        self.assertEqual(self.query.call_count, 1)
+
+    def test_unstarted_campaigns_are_not_queried(self):
+        campaign = MagicMock(_fullname="t8_3")
+
+        impressions = adzerkpromote.get_billable_impressions_multi([campaign])
+
+        self.assertEqual(impressions, {"t8_3": 0})
+        self.assertFalse(self.query.called)
@@ -0,0 +1,467 @@
+import json
+from datetime import datetime, timedelta
+
+import pytz
+from mock import MagicMock
+
+from r2.tests import RedditTestCase
+
+from reddit_adzerk import adzerkreporting
+from reddit_adzerk.lib import retry
+
+
+class FakeCache(dict):
+    def add(self, key, value, time=0):
+        if key in self:
+            return False
+        self[key] = value
+        return True
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.pop(key, None)
+
+
+class TestReportDedup(RedditTestCase):
+
+    def setUp(self):
+        self.cache = FakeCache()
+        self.autopatch(adzerkreporting.g, "gencache", self.cache)
+        self.autopatch(adzerkreporting, "_get_dedup_window",
+                       return_value=3600)
+        self.add_item = self.autopatch(adzerkreporting.amqp, "add_item")
+
+    def _campaigns(self, *ids, **dates):
+        start_date = dates.get("start_date", datetime(2016, 1, 1))
+        return [MagicMock(_id=i, _fullname="t8_%d" % i,
+                          start_date=start_date,
+                          end_date=datetime(2016, 1, 5))
+                for i in ids]
+
+    def test_duplicate_queue_is_skipped(self):
+        adzerkreporting._generate_promo_reports(self._campaigns(1, 2))
+        adzerkreporting._generate_promo_reports(self._campaigns(2, 1))
+        self.assertEqual(self.add_item.call_count, 1)
+
+        adzerkreporting._generate_promo_reports(self._campaigns(1, 3))
+        self.assertEqual(self.add_item.call_count, 2)
+
+    def test_other_windows_are_not_duplicates(self):
+        adzerkreporting._generate_promo_reports(self._campaigns(1, 2))
+        adzerkreporting._generate_promo_reports(
+            self._campaigns(1, 2, start_date=datetime(2016, 1, 3)))
+        self.assertEqual(self.add_item.call_count, 2)
+
+        message = self._queued_message()
+        self.assertEqual((message["start"], message["end"]),
+                         ("2016-01-03", "2016-01-05"))
+
+    def _queued_message(self):
+        return json.loads(self.add_item.call_args[0][1])
+
+    def test_release_allows_requeue(self):
+        campaigns = self._campaigns(1, 2)
+        adzerkreporting._generate_promo_reports(campaigns)
+        adzerkreporting._release_report([self._queued_message()["dedup_key"]])
+        adzerkreporting._generate_promo_reports(campaigns)
+        self.assertEqual(self.add_item.call_count, 2)
+
+    def test_failed_processing_releases_claimed_keys(self):
+        self.autopatch(
+            adzerkreporting, "_handle_generate_lifetime_campaign_reports",
+            side_effect=IOError)
+        consume_items = self.autopatch(adzerkreporting.amqp, "consume_items")
+        self.autopatch(adzerkreporting.g.stats, "amqp_processor",
+                       return_value=lambda fn: fn)
+
+        adzerkreporting._generate_promo_reports(self._campaigns(1, 2))
+        message = MagicMock(body=self.add_item.call_args[0][1])
+        self.assertEqual(len(self.cache), 1)
+
+        adzerkreporting.process_report_q()
+        processor = consume_items.call_args[0][1]
+        processor(message)
+        self.assertEqual(self.cache, {})
+
+    def _processor(self):
+        consume_items = self.autopatch(adzerkreporting.amqp, "consume_items")
+        self.autopatch(adzerkreporting.g.stats, "amqp_processor",
+                       return_value=lambda fn: fn)
+        adzerkreporting.process_report_q()
+        return consume_items.call_args[0][1]
+
+    def _fail_lifetime_report(self, campaigns):
+        self.autopatch(adzerkreporting.PromoCampaign, "_byID",
+                       return_value=campaigns)
+        self.autopatch(adzerkreporting, "_get_campaign_report_range",
+                       return_value=(datetime(2016, 1, 1, tzinfo=pytz.utc),
+                                     datetime(2016, 1, 2, tzinfo=pytz.utc)))
+        self.autopatch(adzerkreporting.report, "queue_report")
+        self.autopatch(adzerkreporting, "_process_lifetime_campaign_reports",
+                       side_effect=adzerkreporting.report.ReportFailedException)
+
+    def test_failed_lifetime_report_is_retried_with_backoff(self):
+        campaigns = self._campaigns(1, 2)
+        self._fail_lifetime_report(campaigns)
+        processor = self._processor()
+
+        adzerkreporting._generate_promo_reports(campaigns)
+        processor(MagicMock(body=self.add_item.call_args[0][1]))
+
+        # scheduled as a retry, not queued again straight away
+        queue, body = self.add_item.call_args[0]
+        self.assertEqual(queue, retry.RETRY_Q)
+        retried = json.loads(json.loads(body)["body"])
+        self.assertEqual(retried["attempt"], 2)
+        self.assertEqual(retried["campaign_ids"], [1, 2])
+        self.assertEqual(self.cache, {})
+
+    def test_failing_lifetime_report_is_dead_lettered(self):
+        self._fail_lifetime_report(self._campaigns(1, 2))
+        self.autopatch(retry, "get_max_attempts", return_value=3)
+        processor = self._processor()
+
+        processor(MagicMock(body=json.dumps({
+            "action": "generate_lifetime_campaign_reports",
+            "campaign_ids": [1, 2],
+            "attempt": 3,
+        })))
+
+        self.assertEqual(self.add_item.call_args[0][0], retry.DEAD_LETTER_Q)
+
+    def test_link_reports_are_timed_separately(self):
+        links = [MagicMock(_id=1, _fullname="t3_1"),
+                 MagicMock(_id=2, _fullname="t3_2")]
+        campaigns = [MagicMock(_id=3, _fullname="t8_3", link_id=1),
+                     MagicMock(_id=4, _fullname="t8_4", link_id=2)]
+        self.autopatch(adzerkreporting.Link, "_byID", return_value=links)
+        self.autopatch(adzerkreporting.PromoCampaign, "_byID",
+                       return_value=campaigns)
+        now = datetime(2016, 1, 10, tzinfo=pytz.utc)
+        self.autopatch(adzerkreporting, "_split_link_reports", return_value=[
+            ([links[0]], [campaigns[0]], now, now),
+            ([links[1]], [campaigns[1]], now, now),
+        ])
+        self.autopatch(adzerkreporting.report, "queue_report")
+        self.autopatch(adzerkreporting, "_process_daily_link_reports")
+        record_cost = self.autopatch(adzerkreporting, "_record_report_cost")
+        # each report takes 10 seconds
+        self.autopatch(adzerkreporting.time, "time",
+                       side_effect=[100., 110., 110., 120.])
+
+        adzerkreporting._handle_generate_daily_link_reports([1, 2], [3, 4])
+
+        seconds = [call[1]["seconds"] for call in record_cost.call_args_list]
+        self.assertEqual(seconds, [10., 10.])
+
+    def test_failed_link_report_fails_message(self):
+        links = [MagicMock(_id=1, _fullname="t3_1"),
+                 MagicMock(_id=2, _fullname="t3_2")]
+        campaigns = [MagicMock(_id=3, _fullname="t8_3", link_id=1),
+                     MagicMock(_id=4, _fullname="t8_4", link_id=2)]
+        self.autopatch(adzerkreporting.Link, "_byID", return_value=links)
+        self.autopatch(adzerkreporting.PromoCampaign, "_byID",
+                       return_value=campaigns)
+        now = datetime(2016, 1, 10, tzinfo=pytz.utc)
+        self.autopatch(adzerkreporting, "_split_link_reports", return_value=[
+            ([links[0]], [campaigns[0]], now, now),
+            ([links[1]], [campaigns[1]], now, now),
+        ])
+        self.autopatch(adzerkreporting.report, "queue_report")
+        failed = adzerkreporting.report.ReportFailedException()
+        process = self.autopatch(
+            adzerkreporting, "_process_daily_link_reports",
+            side_effect=[failed, None])
+        self.autopatch(adzerkreporting, "_record_report_cost")
+
+        with self.assertRaises(adzerkreporting.report.ReportFailedException):
+            adzerkreporting._handle_generate_daily_link_reports(
+                [1, 2], [3, 4])
+
+        # the other report still ran and nothing was queued directly
+        self.assertEqual(process.call_count, 2)
+        self.assertFalse(self.add_item.called)
+
+    def test_duplicate_processing_is_skipped(self):
+        message = MagicMock(body=json.dumps({
+            "action": "generate_lifetime_campaign_reports",
+            "campaign_ids": [1, 2],
+        }))
+        handler = self.autopatch(
+            adzerkreporting, "_handle_generate_lifetime_campaign_reports",
+            side_effect=lambda campaign_ids: processor(message))
+        processor = self._processor()
+
+        # the duplicate arrives while the first message is in flight
+        processor(message)
+        self.assertEqual(handler.call_count, 1)
+
+    def test_processed_reports_are_released(self):
+        handler = self.autopatch(
+            adzerkreporting, "_handle_generate_lifetime_campaign_reports")
+        processor = self._processor()
+
+        campaigns = self._campaigns(1, 2)
+        adzerkreporting._generate_promo_reports(campaigns)
+        processor(MagicMock(body=self.add_item.call_args[0][1]))
+        self.assertEqual(handler.call_count, 1)
+        self.assertEqual(self.cache, {})
+
+        adzerkreporting._generate_promo_reports(campaigns)
+        self.assertEqual(self.add_item.call_count, 2)
+
+    def test_failed_processing_is_released(self):
+        error = adzerkreporting.adzerk_api.AdzerkError(503, "unavailable")
+        handler = self.autopatch(
+            adzerkreporting, "_handle_generate_lifetime_campaign_reports",
+            side_effect=[error, None])
+        consume_items = self.autopatch(adzerkreporting.amqp, "consume_items")
+        self.autopatch(adzerkreporting.g.stats, "amqp_processor",
+                       return_value=lambda fn: fn)
+
+        adzerkreporting.process_report_q()
+        processor = consume_items.call_args[0][1]
+        message = MagicMock(body=json.dumps({
+            "action": "generate_lifetime_campaign_reports",
+            "campaign_ids": [1, 2],
+        }))
+
+        processor(message)
+        processor(message)
+        self.assertEqual(handler.call_count, 2)
+
+        # the failure was scheduled for a retry rather than raised
+        queues = [call[0][0] for call in self.add_item.call_args_list]
+        self.assertEqual(queues, [retry.RETRY_Q])
+
+
+class TestPackByCost(RedditTestCase):
+
+    def _sized(self, name, start_day, days, flights):
+        start = datetime(2016, 1, 1) + timedelta(days=start_day)
+        return (name, start, start + timedelta(days=days), flights)
+
+    def test_groups_by_cost(self):
+        sized_items = [
+            self._sized("a", 0, 10, 1),
+            self._sized("b", 0, 10, 1),
+            self._sized("c", 0, 10, 1),
+        ]
+        groups = adzerkreporting._pack_by_cost(
+            sized_items, target_cost=20, max_size=50)
+        self.assertEqual(groups, [["a", "b"], ["c"]])
+
+    def test_cost_covers_combined_range(self):
+        # together these cover 20 days for 2 flights
+        sized_items = [
+            self._sized("late", 10, 10, 1),
+            self._sized("early", 0, 10, 1),
+        ]
+        groups = adzerkreporting._pack_by_cost(
+            sized_items, target_cost=39, max_size=50)
+        self.assertEqual(groups, [["early"], ["late"]])
+
+        groups = adzerkreporting._pack_by_cost(
+            sized_items, target_cost=40, max_size=50)
+        self.assertEqual(groups, [["early", "late"]])
+
+    def test_expensive_item_alone(self):
+        sized_items = [
+            self._sized("small", 0, 1, 1),
+            self._sized("huge", 1, 90, 20),
+            self._sized("small2", 2, 1, 1),
+        ]
+        groups = adzerkreporting._pack_by_cost(
+            sized_items, target_cost=100, max_size=50)
+        self.assertEqual(groups, [["small"], ["huge"], ["small2"]])
+
+    def test_max_size(self):
+        sized_items = [self._sized(i, 0, 1, 1) for i in xrange(5)]
+        groups = adzerkreporting._pack_by_cost(
+            sized_items, target_cost=1000, max_size=2)
+        self.assertEqual([len(group) for group in groups], [2, 2, 1])
+
+
+class TestSplitLinkReports(RedditTestCase):
+
+    def test_links_report_from_own_watermark(self):
+        now = datetime(2016, 3, 1, 12, tzinfo=pytz.utc)
+        start = datetime(2016, 1, 1, tzinfo=pytz.utc)
+        end = datetime(2016, 4, 1, tzinfo=pytz.utc)
+
+        current = MagicMock(_id=1, last_daily_report_run=now)
+        also_current = MagicMock(_id=2, last_daily_report_run=now)
+        stale = MagicMock(_id=3, last_daily_report_run=start)
+        campaigns = [
+            MagicMock(link_id=link._id, start_date=start, end_date=end)
+            for link in (current, also_current, stale)
+        ]
+
+        reports = adzerkreporting._split_link_reports(
+            [current, also_current, stale], campaigns, now)
+
+        self.assertEqual(len(reports), 2)
+        stale_report, current_report = reports
+        self.assertEqual(stale_report[0], [stale])
+        self.assertEqual(stale_report[2], start)
+        self.assertEqual(current_report[0], [current, also_current])
+        self.assertEqual(current_report[2], now - timedelta(hours=24))
+        self.assertEqual(current_report[3], now)
+
+
+class FakeCampaign(object):
+    """Records which attributes were set, like a Thing's dirties."""
+
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs, _commit=MagicMock(), dirties=set())
+
+    def __setattr__(self, attr, value):
+        self.dirties.add(attr)
+        object.__setattr__(self, attr, value)
+
+
+class TestCommitLifetimeCampaignMetrics(RedditTestCase):
+
+    def setUp(self):
+        self.autopatch(adzerkreporting.g, "stats")
+
+    def test_unchanged_metrics_skipped(self):
+        metrics = dict(
+            adserver_spent_pennies=100.,
+            adserver_impressions=1000,
+            adserver_clicks=10,
+        )
+        unchanged = FakeCampaign(**metrics)
+        changed = FakeCampaign(**metrics)
+        campaign_results = {
+            unchanged: dict(spent_pennies=100., impressions=1000, clicks=10),
+            changed: dict(spent_pennies=200., impressions=2000, clicks=20),
+        }
+        queued_date = datetime(2016, 1, 1, tzinfo=pytz.utc)
+
+        skipped = adzerkreporting._commit_lifetime_campaign_metrics(
+            campaign_results, "report", queued_date)
+
+        self.assertEqual(skipped, 1)
+        self.assertFalse(unchanged._commit.called)
+        self.assertEqual(unchanged.dirties, set())
+
+        self.assertEqual(changed._commit.call_count, 1)
+        self.assertEqual(changed.adserver_impressions, 2000)
+        self.assertEqual(changed.last_lifetime_report, "report")
+        self.assertEqual(changed.last_lifetime_report_run, queued_date)
+
+        events = dict((call[0][0], call[1]["delta"]) for call in
+                      adzerkreporting.g.stats.simple_event.call_args_list)
+        self.assertEqual(events, {
+            "adzerk.reporting.lifetime_commit.committed": 1,
+            "adzerk.reporting.lifetime_commit.skipped": 1,
+        })
+
+
+class TestFetchReport(RedditTestCase):
+
+    def setUp(self):
+        self.fetch_report = self.autopatch(
+            adzerkreporting.report, "fetch_report")
+        self.sleep = self.autopatch(adzerkreporting.time, "sleep")
+        self.autopatch(adzerkreporting.g, "live_config",
+                       {"adzerk_reporting_timeout": 500})
+
+    def test_backs_off_while_pending(self):
+        pending = adzerkreporting.report.ReportPendingException()
+        self.fetch_report.side_effect = [pending, pending, {"Records": []}]
+        queued_date = datetime.utcnow().replace(tzinfo=pytz.utc)
+
+        result = adzerkreporting._fetch_report(
+            "report", queued_date, "link", "t3_1")
+
+        self.assertEqual(result, {"Records": []})
+        self.assertEqual([call[0][0] for call in self.sleep.call_args_list],
+                         [3, 9])
+
+    def test_times_out(self):
+        self.fetch_report.side_effect = (
+            adzerkreporting.report.ReportPendingException())
+        queued_date = (datetime.utcnow().replace(tzinfo=pytz.utc) -
+                       timedelta(seconds=600))
+
+        with self.assertRaises(adzerkreporting.report.ReportFailedException):
+            adzerkreporting._fetch_report(
+                "report", queued_date, "link", "t3_1")
+        self.assertFalse(self.sleep.called)
+
+
+class TestProcessDailyLinkReports(RedditTestCase):
+
+    def setUp(self):
+        self.session = self.autopatch(adzerkreporting, "Session")
+        self.link = MagicMock(_id=1, _fullname="t3_1",
+                              last_daily_report_run=None)
+        self.campaigns = [
+            MagicMock(_fullname="t8_%d" % i, link_id=1, target_name="pics")
+            for i in (2, 3)
+        ]
+        for campaign in self.campaigns:
+            campaign.target.is_collection = False
+        self.autopatch(adzerkreporting.PromoCampaign, "_query",
+                       return_value=self.campaigns)
+        self.queued_date = datetime(2016, 1, 3, tzinfo=pytz.utc)
+
+    def _result(self):
+        def detail(fullname, impressions):
+            return {"Title": fullname, "Impressions": impressions,
+                    "Clicks": 1, "TrueRevenue": 1.}
+
+        return {"Records": [
+            {"Date": "2016-01-01T00:00:00",
+             "Details": [detail("t8_2", 100), detail("t8_3", 50)]},
+            {"Date": "2016-01-02T00:00:00",
+             "Details": [detail("t8_2", 10)]},
+        ]}
+
+    def _process(self, **kwargs):
+        adzerkreporting._process_daily_link_reports(
+            links=[self.link], report_id="report",
+            queued_date=self.queued_date, report_result=self._result(),
+            **kwargs)
+
+    def test_rows_are_committed_once(self):
+        self._process()
+
+        # a clicks, impressions and spent row for each of 3 campaign days
+        # and 2 link days
+        self.assertEqual(self.session.merge.call_count, 3 * (3 + 2))
+        self.assertEqual(self.session.commit.call_count, 1)
+
+    def test_link_days_are_summed(self):
+        insert = self.autopatch(
+            adzerkreporting, "_insert_daily_link_reporting")
+        self._process()
+
+        impressions = {call[1]["date"].day: call[1]["impressions"]
+                       for call in insert.call_args_list}
+        self.assertEqual(impressions, {1: 150, 2: 10})
+        for call in insert.call_args_list:
+            self.assertFalse(call[1]["commit"])
+
+    def test_watermarks_are_updated(self):
+        self._process()
+
+        self.assertEqual(self.link.last_daily_report, "report")
+        self.assertEqual(self.link.last_daily_report_run, self.queued_date)
+        self.assertEqual(self.link._commit.call_count, 1)
+
+    def test_watermarks_can_be_left_alone(self):
+        self._process(update_watermarks=False)
+
+        self.assertIsNone(self.link.last_daily_report_run)
+        self.assertFalse(self.link._commit.called)
+
+    def test_watermarks_are_not_moved_back(self):
+        later = self.queued_date + timedelta(days=1)
+        self.link.last_daily_report_run = later
+        self._process()
+
+        self.assertEqual(self.link.last_daily_report_run, later)
+        self.assertFalse(self.link._commit.called)
@@ -0,0 +1,66 @@
+import shutil
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from reddit_adzerk.lib import archive
+
+
+DAILY_REPORT = {
+    "Records": [{
+        "Date": "2016-01-01T00:00:00",
+        "Impressions": 30,
+        "Details": [{
+            "Title": "t8_1",
+            "Grouping": {"OptionId": 11, "CampaignId": 1},
+            "Impressions": 10,
+            "Clicks": 1,
+            "TrueRevenue": 0.01,
+        }, {
+            "Title": "t8_2",
+            "Grouping": {"OptionId": 12, "CampaignId": 1},
+            "Impressions": 20,
+            "Clicks": 0,
+            "TrueRevenue": 0.02,
+        }],
+    }, {
+        "Date": "2016-01-02T00:00:00",
+        "Impressions": 5,
+        "Details": [{
+            "Title": "t8_1",
+            "Grouping": {"OptionId": 11, "CampaignId": 1},
+            "Impressions": 5,
+            "Clicks": 0,
+            "TrueRevenue": 0.005,
+        }],
+    }],
+}
+
+
+class TestReportArchive(TestCase):
+
+    def setUp(self):
+        self.archive_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.archive_dir)
+
+    def test_encode_round_trip(self):
+        encoded = archive.encode_report(DAILY_REPORT)
+        self.assertEqual(
+            encoded["details"]["columns"]["Title"]["dictionary"],
+            ["t8_1", "t8_2"],
+        )
+        self.assertEqual(archive.decode_report(encoded), DAILY_REPORT)
+
+    def test_archive_and_load(self):
+        start = datetime(2016, 1, 1)
+        end = datetime(2016, 1, 3)
+        path = archive.archive_report("123", DAILY_REPORT, start, end,
+            metadata={"link_ids": [1]}, archive_dir=self.archive_dir)
+
+        self.assertEqual(archive.list_archives(self.archive_dir), [path])
+        report_result, archived = archive.load_report(path)
+        self.assertEqual(report_result, DAILY_REPORT)
+        self.assertEqual(archived["report_id"], "123")
+        self.assertEqual(archived["metadata"], {"link_ids": [1]})
@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+import pytz
+from mock import MagicMock
+
+from r2.tests import RedditTestCase
+
+from reddit_adzerk import backfill
+
+
+class TestCheckpoint(RedditTestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.path = os.path.join(self.tmp_dir, "backfill.json")
+
+        self.start = datetime(2016, 1, 1, tzinfo=pytz.utc)
+        self.end = datetime(2016, 1, 10, tzinfo=pytz.utc)
+
+    def test_missing_checkpoint(self):
+        self.assertEqual(
+            backfill.load_checkpoint(self.path, self.start, self.end), set())
+        self.assertEqual(
+            backfill.load_checkpoint(None, self.start, self.end), set())
+
+    def test_round_trip(self):
+        backfill.save_checkpoint(self.path, self.start, self.end, {3, 1, 2})
+        self.assertEqual(
+            backfill.load_checkpoint(self.path, self.start, self.end),
+            {1, 2, 3})
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+    def test_other_range_is_not_resumed(self):
+        backfill.save_checkpoint(self.path, self.start, self.end, {1})
+        other_end = datetime(2016, 2, 1, tzinfo=pytz.utc)
+
+        with self.assertRaises(ValueError):
+            backfill.load_checkpoint(self.path, self.start, other_end)
+
+
+class TestBackfillLinkReports(RedditTestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.path = os.path.join(self.tmp_dir, "backfill.json")
+
+        self.start = datetime(2016, 1, 1, tzinfo=pytz.utc)
+        self.end = datetime(2016, 1, 10, tzinfo=pytz.utc)
+        self.good = ([MagicMock(_id=1)], [MagicMock()], self.start, self.end)
+        self.bad = ([MagicMock(_id=2)], [MagicMock()], self.start, self.end)
+        self.get_reports = self.autopatch(
+            backfill, "_get_backfill_reports",
+            return_value=[self.good, self.bad])
+
+        queued_date = datetime(2016, 2, 1, tzinfo=pytz.utc)
+        results = {
+            id(self.good): (self.good, "report", queued_date, {"Records": []}),
+            id(self.bad): (self.bad, None, None, None),
+        }
+        self.autopatch(backfill, "_generate_report",
+                       side_effect=lambda r: results[id(r)])
+        self.autopatch(backfill.adzerkreporting, "_archive_report")
+        self.process = self.autopatch(
+            backfill.adzerkreporting, "_process_daily_link_reports")
+
+    def _backfill(self):
+        return backfill.backfill_link_reports(
+            self.start, self.end, link_ids=[1, 2], concurrency=2,
+            checkpoint_path=self.path)
+
+    def test_writes_reports_without_watermarks(self):
+        result = self._backfill()
+
+        self.assertEqual(result, {
+            "reports": 1,
+            "links": 1,
+            "failed_link_ids": [2],
+        })
+        self.assertEqual(self.process.call_count, 1)
+        self.assertFalse(self.process.call_args[1]["update_watermarks"])
+        self.assertEqual(self.process.call_args[1]["report_result"],
+                         {"Records": []})
+
+    def test_resumes_from_checkpoint(self):
+        self._backfill()
+        self.assertEqual(
+            backfill.load_checkpoint(self.path, self.start, self.end), {1})
+
+        self.get_reports.return_value = [self.bad]
+        self._backfill()
+        completed = self.get_reports.call_args[0][4]
+        self.assertEqual(completed, {1})
+
+    def test_checkpoint_from_other_range_is_refused(self):
+        self._backfill()
+
+        with self.assertRaises(ValueError):
+            backfill.backfill_link_reports(
+                self.start, datetime(2016, 2, 1, tzinfo=pytz.utc),
+                link_ids=[1, 2], checkpoint_path=self.path)
+        self.assertEqual(self.get_reports.call_count, 1)
@@ -0,0 +1,166 @@
+import json
+
+import requests
+from mock import patch
+
+from r2.tests import RedditTestCase
+
+from reddit_adzerk import adzerk_api
+from reddit_adzerk.tests import emulator
+
+
+class EmulatorTestCase(RedditTestCase):
+
+    emulator_kwargs = {}
+
+    def setUp(self):
+        self.emulator = emulator.AdzerkEmulator(seed=0,
+                                                **self.emulator_kwargs)
+        self.emulator.start()
+        self.addCleanup(self.emulator.stop)
+        self.url = self.emulator.management_url
+
+    def _create(self, name, **item):
+        response = requests.post("%s/%s" % (self.url, name),
+                                 data={name: json.dumps(item)})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def _queue_report(self, **criteria):
+        response = requests.post("%s/report/queue" % self.url,
+                                 data="criteria=%s" % json.dumps(criteria))
+        return response.json()["Id"]
+
+    def _fetch_report(self, report_id):
+        return requests.get(
+            "%s/report/queue/%s" % (self.url, report_id)).json()
+
+
+class TestEmulatorManagement(EmulatorTestCase):
+
+    def test_list_pagination(self):
+        flights = [self._create("flight", Name="t8_%d" % i, IsActive=True)
+                   for i in xrange(5)]
+
+        pages = [requests.get("%s/flight" % self.url, params={
+            "isActive": True, "page": page, "pageSize": 2}).json()
+            for page in (1, 2, 3)]
+
+        self.assertEqual([page["totalPages"] for page in pages], [3, 3, 3])
+        self.assertEqual([page["totalItems"] for page in pages], [5, 5, 5])
+        self.assertEqual(
+            [item["Id"] for page in pages for item in page["items"]],
+            [flight["Id"] for flight in flights])
+
+    def test_iter_list_reads_every_page(self):
+        self._create("flight", Name="t8_1", IsActive=True)
+        self._create("flight", Name="t8_2", IsActive=False)
+        self._create("flight", Name="t8_3", IsActive=True)
+        self._create("flight", Name="t8_4", IsActive=True)
+
+        with patch.object(adzerk_api.Base, "_base_url", self.url), \
+                patch.object(adzerk_api.ratelimit, "acquire"):
+            pages = list(adzerk_api.Flight.iter_list(is_active=True,
+                                                     page_size=2))
+
+        self.assertEqual([[flight.Name for flight in page] for page in pages],
+                         [["t8_1", "t8_3"], ["t8_4"]])
+
+    def test_unpaged_list_returns_everything(self):
+        for i in xrange(3):
+            self._create("advertiser", Title="advertiser %d" % i)
+
+        response = requests.get("%s/advertiser" % self.url).json()
+        self.assertEqual(len(response["items"]), 3)
+        self.assertNotIn("totalPages", response)
+
+    def test_campaign_get_embeds_flights(self):
+        campaign = self._create("campaign", Name="t3_1")
+        flight = self._create("flight", Name="t8_1",
+                              CampaignId=campaign["Id"])
+
+        url = "%s/campaign/%d" % (self.url, campaign["Id"])
+        embedded = requests.get(url, params={"excludeFlights": "false"}).json()
+        excluded = requests.get(url, params={"excludeFlights": "true"}).json()
+
+        self.assertEqual([f["Id"] for f in embedded["Flights"]],
+                         [flight["Id"]])
+        self.assertEqual(excluded["Flights"], [])
+
+    def test_missing_object(self):
+        response = requests.get("%s/flight/1" % self.url)
+        self.assertEqual(response.status_code, 404)
+
+
+class TestEmulatorReports(EmulatorTestCase):
+
+    emulator_kwargs = {"report_pending_polls": 2}
+
+    def test_report_is_pending_then_complete(self):
+        flight = self._create("flight", Name="t8_1", Price=5.)
+        report_id = self._queue_report(
+            StartDate="01/01/2016", EndDate="01/02/2016",
+            GroupBy=["optionId", "day"],
+            Parameters=[{"flightId": flight["Id"]}])
+
+        statuses = [self._fetch_report(report_id)["Status"]
+                    for _ in xrange(3)]
+        self.assertEqual(statuses, [
+            emulator.REPORT_STATUS_PENDING,
+            emulator.REPORT_STATUS_PENDING,
+            emulator.REPORT_STATUS_COMPLETE,
+        ])
+
+        result = self._fetch_report(report_id)["Result"]
+        self.assertEqual(len(result["Records"]), 2)
+        [detail] = result["Records"][0]["Details"]
+        self.assertEqual(detail["Grouping"]["OptionId"], flight["Id"])
+        # completed reports don't change when fetched again
+        self.assertEqual(self._fetch_report(report_id)["Result"], result)
+
+    def test_unknown_report(self):
+        response = requests.get("%s/report/queue/nope" % self.url)
+        self.assertEqual(response.status_code, 404)
+
+
+class TestEmulatorErrors(EmulatorTestCase):
+
+    def test_fail_next(self):
+        self.emulator.fail_next(status=429, body="slow down")
+        self.emulator.fail_next(status=503)
+
+        statuses = [requests.get("%s/flight" % self.url).status_code
+                    for _ in xrange(3)]
+        self.assertEqual(statuses, [429, 503, 200])
+
+    def test_fail_next_by_endpoint_class(self):
+        self.emulator.fail_next(status=500,
+                                endpoint_class=emulator.REPORTING)
+
+        management = requests.get("%s/flight" % self.url)
+        criteria = json.dumps({"StartDate": "01/01/2016",
+                               "EndDate": "01/01/2016"})
+        reports = [requests.post("%s/report/queue" % self.url,
+                                 data="criteria=%s" % criteria)
+                   for _ in xrange(2)]
+
+        self.assertEqual(management.status_code, 200)
+        self.assertEqual([r.status_code for r in reports], [500, 200])
+
+    def test_calls_are_counted(self):
+        requests.get("%s/flight" % self.url)
+        requests.get("%s/flight/1" % self.url)
+
+        self.assertEqual(self.emulator.calls[("GET", "list")], 1)
+        self.assertEqual(self.emulator.calls[("GET", "get")], 1)
+        self.assertEqual(
+            self.emulator.calls_by_class[emulator.MANAGEMENT], 2)
+
+
+class TestEmulatorErrorRate(EmulatorTestCase):
+
+    emulator_kwargs = {"error_rate": 1, "error_status": 502}
+
+    def test_error_rate(self):
+        response = requests.get("%s/flight" % self.url)
+        self.assertEqual(response.status_code, 502)
@@ -1,7 +1,13 @@
 from unittest import TestCase
 
-from reddit_adzerk.adzerk_utils import (get_mobile_targeting_query,
-                                        get_version_query)
+from reddit_adzerk.adzerk_utils import (DeviceContexts,
+                                        ZerkelParseError,
+                                        estimate_reach,
+                                        evaluate_query,
+                                        get_mobile_targeting_query,
+                                        get_version_query,
+                                        parse_query,
+                                        query_matches)
 
 
 class ZerkelRangeQueryTest(TestCase):
@@ -92,6 +98,30 @@ class ZerkelRangeQueryTest(TestCase):
         output = get_version_query(input)
         self.assertEqual(output, expected)
 
+    def test_within_one_min_minor_zero(self):
+        """Assert a lower minor of 0 is merged into a whole major range"""
+        input = ['5.0', '6.1']
+        expected = ('($device.osVersion.major >= 5 AND ' +
+                    '$device.osVersion.major <= 5) ' +
+                    'OR ' +
+                    '($device.osVersion.major = 6 AND ' +
+                    '$device.osVersion.minor <= 1)')
+        output = get_version_query(input)
+        self.assertEqual(output, expected)
+
+    def test_same_major_min_minor_zero(self):
+        """Assert a redundant `minor >= 0` clause is dropped"""
+        input = ['5.0', '5.3']
+        expected = ('($device.osVersion.major = 5 AND ' +
+                    '$device.osVersion.minor <= 3)')
+        output = get_version_query(input)
+        self.assertEqual(output, expected)
+
+    def test_upper_none(self):
+        """Assert a missing upper bound matches an empty one"""
+        self.assertEqual(get_version_query(['3.3', None]),
+                         get_version_query(['3.3', '']))
+
 
 class ZerkelMobileTargetingQueryTest(TestCase):
 
@@ -102,8 +132,8 @@ class ZerkelMobileTargetingQueryTest(TestCase):
         devices = ['iPhone', 'iPad']
         versions = ['1.1', '']
         expected = ('($device.os = "iOS" AND ' +
-                    '($device.modelName CONTAINS "iPhone" OR ' +
-                    '$device.modelName CONTAINS "iPad") AND ' +
+                    '($device.modelName CONTAINS "iPad" OR ' +
+                    '$device.modelName CONTAINS "iPhone") AND ' +
                     '(($device.osVersion.major >= 2) OR ' +
                     '($device.osVersion.major = 1 AND ' +
                     '$device.osVersion.minor >= 1)))')
@@ -125,6 +155,14 @@ class ZerkelMobileTargetingQueryTest(TestCase):
                                             versions)
         self.assertEqual(output, expected)
 
+    def test_canonical_devices(self):
+        """Assert device order and duplicates don't change the query"""
+        versions = ['1.1', '']
+        output = get_mobile_targeting_query('iOS', 'modelName',
+                                            ['iPhone', 'iPad'], versions)
+        self.assertEqual(output, get_mobile_targeting_query(
+            'iOS', 'modelName', ['iPad', 'iPhone', 'iPad'], versions))
+
     def test_ios_generic_targeting(self):
         """Assert output when targeting all iOS"""
         os_str = 'iOS'
@@ -138,3 +176,74 @@ class ZerkelMobileTargetingQueryTest(TestCase):
         expected = '($device.os = "Android")'
         output = get_mobile_targeting_query(os_str)
         self.assertEqual(output, expected)
+
+
+class ZerkelEvaluatorTest(TestCase):
+
+    def _version_contexts(self):
+        return DeviceContexts.from_rows(
+            {'os': 'iOS', 'osVersion.major': major, 'osVersion.minor': minor}
+            for major in range(0, 10)
+            for minor in range(0, 10)
+        )
+
+    def test_round_trip(self):
+        """Assert compiled queries parse back to the same query"""
+        query = get_mobile_targeting_query('iOS', 'modelName',
+                                           ['iPhone', 'iPad'], ['2.4', '5.1'])
+        self.assertEqual(parse_query(query).compile(), query)
+
+    def test_version_query_exhaustive(self):
+        """Assert version queries match exactly the versions in range"""
+        contexts = self._version_contexts()
+        bounds = ['%d.%d' % (major, minor)
+                  for major in range(1, 9) for minor in range(0, 9, 2)]
+
+        for lower in bounds:
+            for upper in bounds + ['']:
+                low = tuple(int(v) for v in lower.split('.'))
+                high = tuple(int(v) for v in upper.split('.')) if upper else None
+                if high and high < low:
+                    continue
+
+                mask = evaluate_query(get_version_query([lower, upper]),
+                                      contexts)
+                matched = {(row['osVersion.major'], row['osVersion.minor'])
+                           for row in contexts.rows(mask)}
+                expected = {(major, minor)
+                            for major in range(0, 10)
+                            for minor in range(0, 10)
+                            if low <= (major, minor) and
+                               (high is None or (major, minor) <= high)}
+                self.assertEqual(matched, expected, (lower, upper))
+
+    def test_estimate_reach(self):
+        """Assert reach is weighted by the number of identical contexts"""
+        contexts = DeviceContexts()
+        contexts.add({'os': 'iOS', 'modelName': 'iPhone8,1'}, count=300)
+        contexts.add({'os': 'iOS', 'modelName': 'iPad5,3'}, count=20)
+        contexts.add({'os': 'Android', 'formFactor': 'tablet'}, count=7)
+        contexts.add({'os': 'iOS', 'modelName': 'iPhone8,1'}, count=5)
+
+        self.assertEqual(len(contexts), 3)
+        self.assertEqual(estimate_reach('', contexts), 332)
+        self.assertEqual(estimate_reach(
+            '$device.os = "iOS" AND $device.modelName CONTAINS "iPhone"',
+            contexts), 305)
+        self.assertEqual(estimate_reach(
+            '($device.os = "Android") OR ($device.modelName CONTAINS "iPad")',
+            contexts), 27)
+
+    def test_query_matches(self):
+        """Assert a single context can be matched"""
+        query = '($device.formFactor CONTAINS "desktop")'
+        self.assertTrue(query_matches(query, {'formFactor': 'desktop'}))
+        self.assertFalse(query_matches(query, {'formFactor': 'tablet'}))
+        self.assertFalse(query_matches(query, {}))
+
+    def test_parse_error(self):
+        """Assert malformed queries raise ZerkelParseError"""
+        for query in ('($device.os = "iOS"', '$device.os "iOS"',
+                      '$device.os = "iOS" AND', '$user.age = 1'):
+            with self.assertRaises(ZerkelParseError):
+                parse_query(query)
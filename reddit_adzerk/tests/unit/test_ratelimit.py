@@ -0,0 +1,64 @@
+from unittest import TestCase
+
+from reddit_adzerk.lib.ratelimit import LocalCounters, TokenBucket
+
+
+class FakeClock(object):
+    def __init__(self, now):
+        self.now = now
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class TestTokenBucket(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock(1000.25)
+        self.counters = LocalCounters()
+
+    def _bucket(self, rate):
+        return TokenBucket("management", rate, self.counters,
+                           clock=self.clock, sleep=self.clock.sleep)
+
+    def test_budget_per_window(self):
+        bucket = self._bucket(3)
+        waits = [bucket.try_acquire() for _ in xrange(4)]
+        self.assertEqual(waits[:3], [0, 0, 0])
+        self.assertAlmostEqual(waits[3], 0.75)
+
+        # the next window is refilled
+        self.clock.now = 1001.
+        self.assertEqual(bucket.try_acquire(), 0)
+
+    def test_buckets_are_shared(self):
+        first = self._bucket(1)
+        second = self._bucket(1)
+        self.assertEqual(first.try_acquire(), 0)
+        self.assertTrue(second.try_acquire() > 0)
+
+    def test_acquire_waits_for_refill(self):
+        bucket = self._bucket(1)
+        self.assertEqual(bucket.acquire(), 0)
+
+        waited = bucket.acquire()
+        self.assertTrue(waited >= 0.75)
+        self.assertEqual(len(self.clock.slept), 1)
+        self.assertTrue(self.clock.now >= 1001.)
+
+    def test_unavailable_counters_allow_calls(self):
+        class DownCounters(object):
+            def add(self, key, value, time=0):
+                return False
+
+            def incr(self, key, delta=1):
+                return None
+
+        bucket = TokenBucket("report", 1, DownCounters(), clock=self.clock)
+        self.assertEqual(bucket.try_acquire(), 0)
+        self.assertEqual(bucket.try_acquire(), 0)
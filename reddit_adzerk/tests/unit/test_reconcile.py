@@ -0,0 +1,212 @@
+from mock import MagicMock
+
+from r2.tests import RedditTestCase
+
+from reddit_adzerk import reconcile
+
+
+class TestDeactivateOrphanedFlights(RedditTestCase):
+
+    def setUp(self):
+        self.autopatch(reconcile.g, "stats")
+        self.autopatch(reconcile, "queue_alert_report")
+        self.autopatch(reconcile.PromoCampaignByFlightIdCache, "add_multi")
+        self.autopatch(reconcile.g, "blank_campaign_ids", [])
+        self.deactivate = self.autopatch(
+            reconcile.adzerkpromote, "_deactivate_orphaned_flight")
+
+    def _flights(self, count, first_id=1):
+        return [MagicMock(Id=i, CampaignId=i * 10)
+                for i in xrange(first_id, first_id + count)]
+
+    def _patch_lookups(self, pages, flight_ids_with_campaigns,
+                       external_campaign_ids=(), unknown_campaign_ids=()):
+        self.autopatch(reconcile.adzerk_api.Flight, "iter_list",
+                       return_value=iter(pages))
+        self.autopatch(
+            reconcile, "get_campaigns_by_flight_id",
+            side_effect=lambda flight_ids: {
+                i: MagicMock() for i in flight_ids
+                if i in flight_ids_with_campaigns
+            },
+        )
+        self.autopatch(
+            reconcile, "_get_links_by_campaign_id",
+            side_effect=lambda campaign_ids: {
+                i: MagicMock(external=i in external_campaign_ids)
+                for i in campaign_ids if i not in unknown_campaign_ids
+            },
+        )
+        self.autopatch(reconcile.promote, "is_external",
+                       side_effect=lambda link: link.external)
+
+    def test_orphans_are_deactivated(self):
+        pages = [self._flights(50), self._flights(50, first_id=51)]
+        has_campaign = set(xrange(1, 101)) - {7, 60, 61}
+        # flight 61 belongs to an external promo
+        self._patch_lookups(pages, has_campaign, external_campaign_ids=[610])
+
+        orphaned = reconcile.deactivate_orphaned_flights()
+
+        self.assertEqual(orphaned, [7, 60])
+        self.assertEqual([call[0][0] for call in
+                          self.deactivate.call_args_list], [7, 60])
+
+    def test_blank_campaign_flights_are_not_orphaned(self):
+        self.autopatch(reconcile.g, "blank_campaign_ids", [20])
+        self._patch_lookups([self._flights(3)], {1})
+
+        self.assertEqual(reconcile.deactivate_orphaned_flights(dry_run=True),
+                         [3])
+
+    def test_flights_in_other_campaigns_are_not_orphaned(self):
+        # flight 2's adzerk campaign wasn't created by reddit
+        self._patch_lookups([self._flights(3)], {1},
+                            unknown_campaign_ids=[20])
+
+        self.assertEqual(reconcile.deactivate_orphaned_flights(dry_run=True),
+                         [3])
+
+    def test_dry_run(self):
+        self._patch_lookups([self._flights(2)], {1})
+
+        self.assertEqual(reconcile.deactivate_orphaned_flights(dry_run=True),
+                         [2])
+        self.assertFalse(self.deactivate.called)
+
+    def test_too_many_orphans(self):
+        self._patch_lookups([self._flights(100)], set(xrange(1, 51)))
+
+        orphaned = reconcile.deactivate_orphaned_flights()
+
+        self.assertEqual(len(orphaned), 50)
+        self.assertFalse(self.deactivate.called)
+        self.assertTrue(reconcile.queue_alert_report.called)
+
+
+class TestDiffFlight(RedditTestCase):
+
+    def _desired(self, location=None, site_targeting=None, **data):
+        flight_data = {
+            "StartDate": "/Date(1451606400000)/",
+            "Keywords": "s.pics\ns.funny",
+            "IsActive": True,
+            "IsFreqCap": None,
+            "Price": 1.5,
+            "BehavioralTargeting": {
+                "onClick": {"stopShowingAdsFromFlight": False},
+            },
+        }
+        flight_data.update(data)
+        return {
+            "data": flight_data,
+            "site_targeting": site_targeting,
+            "location": location,
+        }
+
+    def _actual(self, **fields):
+        actual = {
+            "StartDate": "/Date(1451606400000-0500)/",
+            "Keywords": "s.funny\ns.pics",
+            "IsActive": True,
+            "IsFreqCap": False,
+            "Price": 1.5000001,
+            "BehavioralTargeting": {
+                "onClick": {"stopShowingAdsFromFlight": False},
+                "onConversion": {},
+            },
+            "SiteZoneTargeting": [],
+            "GeoTargeting": [],
+        }
+        actual.update(fields)
+        return actual
+
+    def test_no_drift(self):
+        self.assertEqual(
+            reconcile.diff_flight(self._desired(), self._actual()), [])
+
+    def test_drifted_fields(self):
+        actual = self._actual(
+            IsActive=False,
+            Keywords="s.pics",
+            GeoTargeting=[{"CountryCode": "US", "Region": None,
+                           "MetroCode": None, "IsExclude": False}],
+        )
+        self.assertEqual(
+            sorted(reconcile.diff_flight(self._desired(), actual)),
+            ["GeoTargeting", "IsActive", "Keywords"])
+
+    def test_targeting(self):
+        desired = self._desired(
+            location=("US", "CA", 807),
+            site_targeting=[{"SiteId": 1, "IsExclude": False, "ZoneId": None}],
+        )
+        actual = self._actual(
+            SiteZoneTargeting=[{"Id": 5, "FlightId": 2, "SiteId": 1,
+                                "IsExclude": False, "ZoneId": None}],
+            GeoTargeting=[{"LocationId": 9, "CountryCode": "US",
+                           "Region": "CA", "MetroCode": 807,
+                           "IsExclude": False}],
+        )
+        self.assertEqual(reconcile.diff_flight(desired, actual), [])
+
+        actual["SiteZoneTargeting"][0]["SiteId"] = 2
+        self.assertEqual(reconcile.diff_flight(desired, actual),
+                         ["SiteZoneTargeting"])
+
+    def test_fields_missing_from_listing_are_skipped(self):
+        actual = self._actual()
+        del actual["IsActive"]
+        del actual["GeoTargeting"]
+        desired = self._desired(IsActive=False, location=("US", None, None))
+        self.assertEqual(reconcile.diff_flight(desired, actual), [])
+
+
+class TestReconcileFlights(RedditTestCase):
+
+    def setUp(self):
+        self.autopatch(reconcile.g, "stats")
+        self.sync = self.autopatch(reconcile, "_sync_flight")
+
+        self.link = MagicMock(_id=1)
+        self.in_sync = MagicMock(link_id=1, _fullname="t8_1")
+        self.drifted = MagicMock(link_id=1, _fullname="t8_2")
+        page = (
+            [MagicMock(Id=10), MagicMock(Id=20)],
+            {10: self.in_sync, 20: self.drifted},
+            {1: self.link},
+        )
+        self.autopatch(reconcile, "_iter_active_flight_pages",
+                       return_value=iter([page]))
+        self.autopatch(reconcile, "_iter_scheduled_flight_pages",
+                       return_value=iter([]))
+        self.autopatch(reconcile, "_get_diff_tasks", return_value=[
+            (10, {}, {"drift": []}),
+            (20, {}, {"drift": ["IsActive", "Keywords"]}),
+        ])
+        self.autopatch(reconcile, "diff_flight",
+                       side_effect=lambda desired, actual: actual["drift"])
+
+    def test_only_drifted_flights_are_synced(self):
+        report = reconcile.reconcile_flights(workers=1)
+
+        self.assertEqual(report["flights"], 2)
+        self.assertEqual(report["drifted"], 1)
+        self.assertEqual(report["fields"], {"IsActive": 1, "Keywords": 1})
+        self.sync.assert_called_once_with(self.link, self.drifted)
+        self.assertEqual(report["synced"], ["t8_2"])
+
+    def test_dry_run(self):
+        report = reconcile.reconcile_flights(workers=1, dry_run=True)
+
+        self.assertEqual(report["drifted"], 1)
+        self.assertFalse(self.sync.called)
+
+    def test_unsynced_drift_is_left_to_the_next_sync(self):
+        clear = self.autopatch(reconcile.adzerkpromote,
+                               "_clear_flight_fingerprint")
+        report = reconcile.reconcile_flights(workers=1, max_updates=0)
+
+        self.assertFalse(self.sync.called)
+        self.assertEqual(report["synced"], [])
+        clear.assert_called_once_with(self.drifted)
@@ -0,0 +1,255 @@
+from datetime import date, timedelta
+
+from r2.tests import RedditTestCase
+
+from reddit_adzerk import report
+from reddit_adzerk.lib.cache import LocationReportPartialCache
+
+
+class FakeCache(dict):
+    def __init__(self):
+        self.ttls = {}
+
+    def get_multi(self, keys, stale=False):
+        return {key: self[key] for key in keys if key in self}
+
+    def set_multi(self, mapping, time=0):
+        self.update(mapping)
+        self.ttls.update(dict.fromkeys(mapping, time))
+
+    def expire(self, seconds):
+        """Drop the keys that expire within `seconds`."""
+        for key, ttl in self.ttls.items():
+            if ttl and ttl <= seconds:
+                del self[key]
+                del self.ttls[key]
+
+
+class TestColumnarReport(RedditTestCase):
+
+    def _report(self):
+        columnar = report.ColumnarReport()
+        columnar.append(("a",), date(2016, 1, 1), date(2016, 1, 1), 10, 1)
+        columnar.append(("b",), date(2016, 1, 1), date(2016, 1, 1), 5, 2)
+        columnar.append(("a",), date(2016, 1, 2), date(2016, 1, 2), 7, 3)
+        return columnar
+
+    def test_rows(self):
+        columnar = self._report()
+        self.assertEqual(len(columnar), 3)
+        self.assertEqual(columnar.groups, [("a",), ("b",)])
+        self.assertEqual(list(columnar.rows()), [
+            (("a",), date(2016, 1, 1), date(2016, 1, 1), 10, 1),
+            (("b",), date(2016, 1, 1), date(2016, 1, 1), 5, 2),
+            (("a",), date(2016, 1, 2), date(2016, 1, 2), 7, 3),
+        ])
+
+    def test_to_items(self):
+        items = self._report().to_items()
+        self.assertEqual(items[("a",)], [
+            report.ReportItem(date(2016, 1, 1), date(2016, 1, 1), 10, 1),
+            report.ReportItem(date(2016, 1, 2), date(2016, 1, 2), 7, 3),
+        ])
+        self.assertEqual(len(items[("b",)]), 1)
+
+    def test_group_min(self):
+        columnar = self._report()
+        self.assertEqual(columnar.group_min(), {("a",): 7, ("b",): 5})
+        self.assertEqual(columnar.group_min("clicks"), {("a",): 1, ("b",): 2})
+
+    def test_group_sum(self):
+        columnar = self._report()
+        self.assertEqual(columnar.group_sum(), {("a",): 17, ("b",): 5})
+        self.assertEqual(columnar.group_sum("clicks"), {("a",): 4, ("b",): 2})
+
+    def test_extend(self):
+        columnar = self._report()
+        other = report.ColumnarReport()
+        other.append(("c",), date(2016, 1, 3), date(2016, 1, 3), 1, 0)
+        other.append(("a",), date(2016, 1, 3), date(2016, 1, 3), 2, 0)
+
+        columnar.extend(other)
+
+        self.assertEqual(columnar.groups, [("a",), ("b",), ("c",)])
+        self.assertEqual(list(columnar.rows())[3:], [
+            (("c",), date(2016, 1, 3), date(2016, 1, 3), 1, 0),
+            (("a",), date(2016, 1, 3), date(2016, 1, 3), 2, 0),
+        ])
+        self.assertEqual(columnar.group_min(),
+                         {("a",): 2, ("b",): 5, ("c",): 1})
+
+    def test_map_groups(self):
+        columnar = self._report()
+        columnar.map_groups(lambda group: group + ("x",))
+        self.assertEqual(columnar.groups, [("a", "x"), ("b", "x")])
+
+        # appends after the rename share the renamed group
+        columnar.append(("a", "x"), date(2016, 1, 3), date(2016, 1, 3), 1, 0)
+        self.assertEqual(columnar.groups, [("a", "x"), ("b", "x")])
+        self.assertEqual(columnar.group_min(), {("a", "x"): 1, ("b", "x"): 5})
+
+    def test_map_groups_merges(self):
+        columnar = self._report()
+        columnar.map_groups(lambda group: ("all",))
+        self.assertEqual(columnar.groups, [("all",)])
+        self.assertEqual(list(columnar.group_ids), [0, 0, 0])
+        self.assertEqual(columnar.group_min(), {("all",): 5})
+
+
+def _location_report(rows):
+    columnar = report.ColumnarReport()
+    for group, day, impressions in rows:
+        columnar.append(group, day, day, impressions, 0)
+    return columnar
+
+
+class TestGetLocationPartials(RedditTestCase):
+
+    def setUp(self):
+        self.cache = FakeCache()
+        self.autopatch(report.g, "gencache", self.cache)
+        self.get_location_reports = self.autopatch(
+            report, "get_location_reports")
+
+    def _cache_partial(self, scope, day, impressions_by_location):
+        partial = _location_report([
+            (location, day, impressions)
+            for location, impressions in impressions_by_location.iteritems()
+        ])
+        key = LocationReportPartialCache._cache_key("pics", scope, day)
+        self.cache[key] = partial
+
+    def _impressions_by_day(self, columnar):
+        return {(group, start): impressions for group, start, end,
+                impressions, clicks in columnar.rows()}
+
+    def test_cached_days_are_not_fetched(self):
+        self._cache_partial(None, date(2016, 1, 1), {None: 10})
+        self._cache_partial(None, date(2016, 1, 2), {None: 20})
+
+        reports = report.get_location_partials(
+            date(2016, 1, 1), date(2016, 1, 2), "pics", scopes=(None,))
+
+        self.assertFalse(self.get_location_reports.called)
+        self.assertEqual(self._impressions_by_day(reports[None]), {
+            (None, date(2016, 1, 1)): 10,
+            (None, date(2016, 1, 2)): 20,
+        })
+
+    def test_missing_days_are_fetched_and_cached(self):
+        self._cache_partial(None, date(2016, 1, 1), {None: 10})
+        self.get_location_reports.return_value = {
+            None: _location_report([
+                (("pics",), date(2016, 1, 2), 20),
+                (("pics",), date(2016, 1, 3), 30),
+            ]),
+        }
+
+        reports = report.get_location_partials(
+            date(2016, 1, 1), date(2016, 1, 3), "pics", scopes=(None,))
+
+        start, end = self.get_location_reports.call_args[0]
+        self.assertEqual((start, end), (date(2016, 1, 2), date(2016, 1, 3)))
+        self.assertEqual(self._impressions_by_day(reports[None]), {
+            (None, date(2016, 1, 1)): 10,
+            (None, date(2016, 1, 2)): 20,
+            (None, date(2016, 1, 3)): 30,
+        })
+        self.assertEqual(reports[None].group_min(), {None: 10})
+
+        key = LocationReportPartialCache._cache_key(
+            "pics", None, date(2016, 1, 3))
+        self.assertEqual(self._impressions_by_day(self.cache[key]),
+                         {(None, date(2016, 1, 3)): 30})
+
+    def test_next_run_only_fetches_the_new_day(self):
+        def fetch(start, end, **kw):
+            return {None: _location_report([
+                (("pics",), day, 10) for day in report._daterange(start, end)
+            ])}
+        self.get_location_reports.side_effect = fetch
+        lag = timedelta(days=LocationReportPartialCache.CORRECTION_DAYS)
+
+        today = date(2016, 1, 20)
+        end = today - lag
+        report.get_location_partials(end - timedelta(days=14), end, "pics",
+                                     scopes=(None,), today=today)
+
+        # a day passes, anything that isn't final has expired
+        self.cache.expire(60 * 60 * 24)
+        today += timedelta(days=1)
+        end = today - lag
+        reports = report.get_location_partials(
+            end - timedelta(days=14), end, "pics", scopes=(None,),
+            today=today)
+
+        self.assertEqual(self.get_location_reports.call_count, 2)
+        self.assertEqual(self.get_location_reports.call_args[0], (end, end))
+        self.assertEqual(len(reports[None]), 15)
+
+    def test_scopes_share_one_fetch_window(self):
+        self._cache_partial("countryCode", date(2016, 1, 2), {"US": 5})
+        self.get_location_reports.return_value = {
+            None: _location_report([
+                (("pics",), date(2016, 1, 1), 10),
+                (("pics",), date(2016, 1, 2), 20),
+            ]),
+            "countryCode": _location_report([
+                (("pics", "US"), date(2016, 1, 1), 4),
+                (("pics", "US"), date(2016, 1, 2), 5),
+            ]),
+        }
+
+        reports = report.get_location_partials(
+            date(2016, 1, 1), date(2016, 1, 2), "pics",
+            scopes=(None, "countryCode"))
+
+        scopes = self.get_location_reports.call_args[1]["scopes"]
+        self.assertEqual(sorted(scopes), [None, "countryCode"])
+        self.assertEqual(self._impressions_by_day(reports["countryCode"]), {
+            ("US", date(2016, 1, 1)): 4,
+            ("US", date(2016, 1, 2)): 5,
+        })
+
+
+class TestLocationReportPartialCache(RedditTestCase):
+
+    def test_recent_days_expire_quickly(self):
+        set_multi = self.autopatch(report.g.gencache, "set_multi")
+        today = date(2016, 1, 20)
+        old = date(2016, 1, 1)
+        last_final = date(2016, 1, 18)
+        recent = date(2016, 1, 19)
+
+        LocationReportPartialCache.set_multi(
+            "pics", None, {old: {None: 1}, last_final: {None: 2},
+                           recent: {None: 3}},
+            today=today)
+
+        ttls = {}
+        for (mapping,), kw in set_multi.call_args_list:
+            for key in mapping:
+                ttls[key.rsplit(":", 1)[1]] = kw["time"]
+        self.assertEqual(ttls, {
+            old.isoformat(): LocationReportPartialCache.FINAL_TTL,
+            last_final.isoformat(): LocationReportPartialCache.FINAL_TTL,
+            recent.isoformat(): LocationReportPartialCache.RECENT_TTL,
+        })
+
+
+class TestGetLocationReports(RedditTestCase):
+
+    def test_fetches_every_scope(self):
+        get_report = self.autopatch(
+            report, "get_location_columnar_report",
+            side_effect=lambda start, end, location_scope, **kw: location_scope)
+
+        reports = report.get_location_reports(
+            date(2016, 1, 1), date(2016, 1, 2), keywords=["pics"],
+            timeout=10)
+
+        self.assertEqual(reports, {scope: scope
+                                   for scope in report.LOCATION_SCOPES})
+        self.assertEqual(get_report.call_count, len(report.LOCATION_SCOPES))
+        for call in get_report.call_args_list:
+            self.assertEqual(call[1]["timeout"], 10)
@@ -0,0 +1,138 @@
+import json
+
+from mock import MagicMock
+
+from r2.lib.db.thing import NotFound
+from r2.tests import RedditTestCase
+
+from reddit_adzerk.adzerk_api import AdzerkError
+from reddit_adzerk.lib import retry
+
+
+class TestIsPermanentError(RedditTestCase):
+
+    def test_client_errors_are_permanent(self):
+        self.assertTrue(retry.is_permanent_error(AdzerkError(400, "bad")))
+        self.assertTrue(retry.is_permanent_error(AdzerkError(404, "")))
+        self.assertTrue(retry.is_permanent_error(NotFound("t3_1")))
+
+    def test_transient_errors(self):
+        self.assertFalse(retry.is_permanent_error(AdzerkError(429, "")))
+        self.assertFalse(retry.is_permanent_error(AdzerkError(503, "")))
+        self.assertFalse(retry.is_permanent_error(IOError()))
+
+    def test_retry_delay_backs_off(self):
+        delays = [retry.get_retry_delay(attempt) for attempt in xrange(1, 9)]
+        self.assertEqual(delays[:3], [60, 120, 240])
+        self.assertEqual(delays[-1], retry.RETRY_MAX_SECONDS)
+
+
+class TestHandleWithRetries(RedditTestCase):
+
+    def setUp(self):
+        self.add_item = self.autopatch(retry.amqp, "add_item")
+        self.autopatch(retry.g, "stats")
+        self.autopatch(retry, "get_max_attempts", return_value=3)
+
+    def _handle(self, data, error):
+        handler = MagicMock(side_effect=error)
+        message = MagicMock(body=json.dumps(data))
+        retry.handle_with_retries("adzerk_q", message, handler)
+        return handler
+
+    def _queued(self):
+        return [(call[0][0], json.loads(call[0][1]))
+                for call in self.add_item.call_args_list]
+
+    def test_success(self):
+        handler = self._handle({"action": "update_adzerk"}, None)
+        handler.assert_called_once_with({"action": "update_adzerk"})
+        self.assertFalse(self.add_item.called)
+
+    def test_lag_is_recorded(self):
+        self.autopatch(retry.queues.time, "time", return_value=100.)
+        self._handle({"action": "update_adzerk", "enqueued_at": 95.}, None)
+
+        timings = [call[0] for call in
+                   retry.g.stats.simple_timing.call_args_list]
+        self.assertEqual(timings, [
+            ("adzerk.queue_lag.adzerk_q.update_adzerk", 5000.),
+            ("adzerk.queue_handled.adzerk_q.update_adzerk", 5000.),
+        ])
+
+    def test_lag_of_retry_excludes_delay(self):
+        self.autopatch(retry.queues.time, "time", return_value=100.)
+        self._handle({"action": "update_adzerk", "enqueued_at": 20.,
+                      "requeued_at": 95.}, None)
+
+        timings = [call[0] for call in
+                   retry.g.stats.simple_timing.call_args_list]
+        self.assertEqual(timings, [
+            ("adzerk.queue_lag.adzerk_q.update_adzerk", 5000.),
+            ("adzerk.queue_handled.adzerk_q.update_adzerk", 80000.),
+        ])
+
+    def test_transient_error_is_retried(self):
+        self._handle({"action": "update_adzerk"}, AdzerkError(503, ""))
+
+        [(queue, retried)] = self._queued()
+        self.assertEqual(queue, retry.RETRY_Q)
+        self.assertEqual(retried["queue"], "adzerk_q")
+        self.assertEqual(json.loads(retried["body"]),
+                         {"action": "update_adzerk", "attempt": 2})
+
+    def test_permanent_error_is_dead_lettered(self):
+        self._handle({"action": "update_adzerk"}, AdzerkError(400, ""))
+
+        [(queue, dead)] = self._queued()
+        self.assertEqual(queue, retry.DEAD_LETTER_Q)
+        self.assertEqual(dead["attempt"], 1)
+
+    def test_last_attempt_is_dead_lettered(self):
+        self._handle({"action": "update_adzerk", "attempt": 3},
+                     AdzerkError(503, ""))
+
+        [(queue, dead)] = self._queued()
+        self.assertEqual(queue, retry.DEAD_LETTER_Q)
+        self.assertEqual(dead["attempt"], 3)
+
+    def test_malformed_message_is_dead_lettered(self):
+        handler = MagicMock()
+        retry.handle_with_retries("adzerk_q", MagicMock(body="{"), handler)
+
+        self.assertFalse(handler.called)
+        self.assertEqual(self.add_item.call_args[0][0], retry.DEAD_LETTER_Q)
+
+
+class TestRequeueRetries(RedditTestCase):
+
+    def setUp(self):
+        self.add_item = self.autopatch(retry.amqp, "add_item")
+        self.autopatch(retry.amqp, "worker")
+        self.autopatch(retry.g, "stats")
+        self.autopatch(retry.time, "time", return_value=100.)
+        self.autopatch(retry.queues.time, "time", return_value=100.)
+
+    def _requeue(self, *retries):
+        items = [MagicMock(body=json.dumps(r)) for r in retries]
+        self.autopatch(retry.amqp, "handle_items",
+                       side_effect=lambda queue, fn, **kw: fn(items, None))
+        return retry.requeue_retries()
+
+    def test_due_retries_are_stamped(self):
+        counts = self._requeue(
+            {"queue": "adzerk_q", "retry_at": 90.,
+             "body": json.dumps({"action": "update_adzerk", "attempt": 2})},
+            {"queue": "adzerk_q", "retry_at": 200., "body": "{}"},
+        )
+
+        self.assertEqual(counts, {"requeued": 1, "waiting": 1})
+        (queue, body), _ = self.add_item.call_args_list[0]
+        self.assertEqual(queue, "adzerk_q")
+        self.assertEqual(json.loads(body), {
+            "action": "update_adzerk",
+            "attempt": 2,
+            "requeued_at": 100.,
+        })
+        self.assertEqual(self.add_item.call_args_list[1][0][0],
+                         retry.RETRY_Q)